@@ -25,6 +25,8 @@ sys.path.append(os.path.abspath('sphinxext'))
 extensions = ['sphinx.ext.autodoc',
               'sphinx.ext.doctest',
               'sphinx.ext.mathjax',
+              # Before the extensions it times; off unless build_trace is set
+              'build_trace',
               'notebook_sphinxext',
               'plot_directive',
               'math_dollar']
@@ -0,0 +1,276 @@
+""" Record where Sphinx build time goes, as a Chrome trace
+
+Set ``build_trace`` in ``conf.py``, or with ``sphinx-build -D
+build_trace=trace.json``, to a file name relative to the configuration
+directory.  We then time:
+
+* each Sphinx event, such as ``source-read`` or ``doctree-resolved``, and
+  the reading and writing of each document;
+* the plot directive, and the plot code, rendering and ``savefig`` within it;
+* the notebook directive, and notebook evaluation and html conversion within
+  it.
+
+Each span records the document being read or written.  Cache lookups of the
+plot and notebook directives also record a hit or miss marker.  At the end of
+the build, we write the spans in the Chrome trace event format, for
+``chrome://tracing`` or https://ui.perfetto.dev, and a table of total time
+per span name next to it, with extension ``.txt``.
+
+List this extension before the extensions it traces, so it starts first.
+With ``sphinx-build -j``, documents read in parallel send their spans back
+with the environment, under the id of the process that read them.  Spans
+from parallel writes, and from worker processes such as ``plot_jobs`` and
+``notebook_jobs`` prebuilds, show only as the time of the Sphinx event or
+document that runs them.
+"""
+import os
+import io
+import sys
+import json
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from timeit import default_timer as clock
+
+# (module name, object name, method name or None, category) of functions to
+# time.  Modules that Sphinx has not loaded are skipped.
+TRACED = (('plot_directive', 'run', None, 'plot'),
+          ('plot_directive', 'render_figures', None, 'plot'),
+          ('plot_directive', 'run_code', None, 'plot'),
+          ('plot_directive', 'save_figure', None, 'plot'),
+          ('notebook_sphinxext', 'NotebookDirective', 'run', 'notebook'),
+          ('notebook_sphinxext', 'run_isolated', None, 'notebook'),
+          ('notebook_sphinxext', 'evaluate_notebook', None, 'notebook'),
+          ('notebook_sphinxext', 'evaluate_to_cache', None, 'notebook'),
+          ('notebook_sphinxext', 'nb_to_html', None, 'notebook'))
+
+# Number of rows in the summary printed at the end of the build
+SUMMARY_ROWS = 15
+
+
+class BuildTrace(object):
+    """ Collect timed spans and markers for a Chrome trace """
+
+    def __init__(self):
+        self.events = []
+        self.docname = None
+        self.pid = os.getpid()
+        self._t0 = clock()
+        self._lock = threading.Lock()
+
+    def _now(self):
+        # Trace times are in microseconds
+        return (clock() - self._t0) * 1e6
+
+    def _add(self, event):
+        event.update(pid=os.getpid(), tid=threading.current_thread().ident)
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, cat, docname=None):
+        """Record time in ``with`` block as span `name` in category `cat`"""
+        if docname is None:
+            docname = self.docname
+        start = self._now()
+        try:
+            yield
+        finally:
+            self._add(dict(name=name, cat=cat, ph='X', ts=start,
+                           dur=self._now() - start,
+                           args=dict(doc=docname)))
+
+    def marker(self, name, cat):
+        """Record instant event `name`, such as a cache hit"""
+        self._add(dict(name=name, cat=cat, ph='i', s='t', ts=self._now(),
+                       args=dict(doc=self.docname)))
+
+    def traced(self, func, name, cat):
+        """Return `func` wrapped to record its calls as spans"""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.span(name, cat):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def take_process_events(self):
+        """Remove and return events recorded in this process
+
+        A forked reader starts with a copy of the events of the main process,
+        which we leave out.
+        """
+        pid = os.getpid()
+        with self._lock:
+            ours = [event for event in self.events if event['pid'] == pid]
+            self.events = [event for event in self.events
+                           if event['pid'] != pid]
+        return ours
+
+    def write(self, path):
+        """Write events to `path` as Chrome trace JSON"""
+        with io.open(path, 'wt', encoding='utf-8') as f:
+            f.write(json.dumps(dict(traceEvents=self.events,
+                                    displayTimeUnit='ms'),
+                               ensure_ascii=False))
+
+    def summary(self, n=None):
+        """Return table of span time by name, largest total first
+
+        Span times include the spans within them.  Markers are counted.
+        """
+        totals = {}
+        markers = {}
+        for event in self.events:
+            if event['ph'] == 'i':
+                markers[event['name']] = markers.get(event['name'], 0) + 1
+                continue
+            count, total, longest = totals.get(event['name'], (0, 0., 0.))
+            dur = event['dur'] / 1e6
+            totals[event['name']] = (count + 1, total + dur,
+                                     max(longest, dur))
+        rows = sorted(totals.items(), key=lambda item: item[1][1],
+                      reverse=True)
+        if n is not None:
+            rows = rows[:n]
+        lines = ['{0:>9} {1:>6} {2:>9} {3:>9}  {4}'.format(
+            'total (s)', 'count', 'mean (s)', 'max (s)', 'span')]
+        for name, (count, total, longest) in rows:
+            lines.append('{0:9.2f} {1:6d} {2:9.3f} {3:9.3f}  {4}'.format(
+                total, count, total / count, longest, name))
+        for name in sorted(markers):
+            lines.append('{0:>9} {1:6d} {2:>9} {3:>9}  {4}'.format(
+                '', markers[name], '', '', name))
+        return '\n'.join(lines)
+
+
+def _patch(owner, attr, make_wrapper):
+    """Replace `attr` of `owner` with ``make_wrapper(original)``
+
+    We wrap the original, not the wrapper from an earlier build in this
+    process.
+    """
+    func = getattr(owner, attr)
+    func = getattr(func, '_build_trace_original', func)
+    wrapper = make_wrapper(func)
+    wrapper._build_trace_original = func
+    setattr(owner, attr, wrapper)
+
+
+def _marking_lookup(trace, name, cat, is_miss):
+    """Return wrapper maker for cache lookups, marking hits and misses"""
+    def make_wrapper(lookup):
+        @wraps(lookup)
+        def wrapper(*args, **kwargs):
+            result = lookup(*args, **kwargs)
+            trace.marker('{0} {1}'.format(
+                name, 'miss' if is_miss(result) else 'hit'), cat)
+            return result
+        return wrapper
+    return make_wrapper
+
+
+def _trace_cache_lookups(trace, modules):
+    """Wrap cache lookups of plot and notebook directives to mark hits"""
+    plot_directive = modules.get('plot_directive')
+    if plot_directive is not None:
+        _patch(plot_directive, 'find_images',
+               _marking_lookup(trace, 'plot cache', 'plot',
+                               lambda result: result[0] is None))
+    notebook_sphinxext = modules.get('notebook_sphinxext')
+    if notebook_sphinxext is not None:
+        _patch(notebook_sphinxext, 'cache_lookup',
+               _marking_lookup(trace, 'notebook cache', 'notebook',
+                               lambda result: result is None))
+
+
+def _doc_span(trace, name, send_events=False):
+    """Return wrapper maker for methods taking docname first
+
+    The wrapper records a span for the document.  With `send_events`, the
+    method is ``read_doc`` of the builder or, for older Sphinx, of the
+    environment, and in a parallel reader we pass the events back to the
+    main process with the environment (see ``merge_trace``).
+    """
+    def make_wrapper(method):
+        @wraps(method)
+        def wrapper(self, docname, *args, **kwargs):
+            trace.docname = docname
+            with trace.span(name, 'sphinx', docname):
+                result = method(self, docname, *args, **kwargs)
+            if send_events and os.getpid() != trace.pid:
+                env = getattr(self, 'env', self)
+                env.build_trace_events = (
+                    getattr(env, 'build_trace_events', []) +
+                    trace.take_process_events())
+            return result
+        return wrapper
+    return make_wrapper
+
+
+def start_trace(app):
+    """Wrap Sphinx events and directive functions in spans, if enabled"""
+    if not app.config.build_trace:
+        return
+    trace = BuildTrace()
+    setup.trace = trace
+    emit = app.emit
+
+    def traced_emit(event, *args):
+        if event == 'source-read' and args:
+            trace.docname = args[0]
+        with trace.span('event ' + event, 'sphinx'):
+            return emit(event, *args)
+    app.emit = traced_emit
+    # Patch the classes; the environment must still pickle.  Sphinx 1.6
+    # moved ``read_doc`` from the environment to the builder.
+    for owner in (app.builder, app.env):
+        if hasattr(owner, 'read_doc'):
+            _patch(type(owner), 'read_doc', _doc_span(trace, 'read', True))
+            break
+    if hasattr(app.builder, 'write_doc'):
+        _patch(type(app.builder), 'write_doc', _doc_span(trace, 'write'))
+    for mod_name, obj_name, method, cat in TRACED:
+        module = sys.modules.get(mod_name)
+        if module is None or not hasattr(module, obj_name):
+            continue
+        owner, attr = module, obj_name
+        if method is not None:
+            owner, attr = getattr(module, obj_name), method
+        name = '{0}.{1}'.format(obj_name, method) if method else obj_name
+        _patch(owner, attr,
+               lambda func, name=name, cat=cat: trace.traced(func, name, cat))
+    _trace_cache_lookups(trace, sys.modules)
+
+
+def merge_trace(app, env, docnames, other):
+    """Add events from documents read in parallel to the trace"""
+    trace = getattr(setup, 'trace', None)
+    events = getattr(other, 'build_trace_events', None)
+    if trace is not None and events:
+        trace.events.extend(events)
+
+
+def write_trace(app, exception):
+    """Write trace and summary table at end of build"""
+    trace = getattr(setup, 'trace', None)
+    if trace is None:
+        return
+    trace_path = os.path.join(app.confdir, app.config.build_trace)
+    trace.write(trace_path)
+    summary_path = os.path.splitext(trace_path)[0] + '.txt'
+    with io.open(summary_path, 'wt', encoding='utf-8') as f:
+        f.write(trace.summary() + '\n')
+    sys.stderr.write('Build time by span (trace in {0}, table in {1}):\n'
+                     '{2}\n'.format(trace_path, summary_path,
+                                    trace.summary(SUMMARY_ROWS)))
+    setup.trace = None
+
+
+def setup(app):
+    app.add_config_value('build_trace', None, '')
+
+    app.connect('builder-inited', start_trace)
+    app.connect('env-merge-info', merge_trace)
+    app.connect('build-finished', write_trace)
+
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
@@ -0,0 +1,184 @@
+""" Limits on run time and memory of notebook evaluation
+
+A ``CellBudget`` is a cell monitor (see ``kernel_pool.run_cell``).  While a
+cell runs, a watchdog thread checks the time the cell has taken, the time the
+whole notebook has taken, and the resident memory of the kernel process.  If
+the cell goes over the time limits, we interrupt the kernel, and kill it if it
+has not stopped after ``KILL_GRACE`` seconds.  If the kernel goes over the
+memory limit, we kill it straight away.  Either way, the cell raises a
+``BudgetExceeded`` error naming the cell, and the kernel pool replaces the
+kernel, ready for the next notebook.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+from kernel_pool import (kernel_pid, interrupt_kernel, kill_kernel,
+                         code_cells, can_stop)
+from cell_profile import rss
+
+# Seconds to wait for an interrupted kernel before killing it
+KILL_GRACE = 5.
+
+# Seconds between watchdog checks, and between polls for the cell reply
+POLL_INTERVAL = 0.1
+
+
+class BudgetExceeded(RuntimeError):
+    """ Error when a cell goes over a time or memory limit """
+
+
+class _Watchdog(threading.Thread):
+    """Thread interrupting or killing kernel of `runner` over its limits"""
+
+    def __init__(self, runner, time_limit=None, max_memory=None,
+                 time_message='ran too long'):
+        super(_Watchdog, self).__init__()
+        self.daemon = True
+        self.runner = runner
+        self.time_limit = time_limit
+        self.time_message = time_message
+        self.max_memory = max_memory
+        self.pid = kernel_pid(runner)
+        self.reason = None
+        self.killed = False
+        self._stop_event = threading.Event()
+
+    def run(self):
+        t0 = time.time()
+        interrupted_at = None
+        while not self._stop_event.wait(POLL_INTERVAL):
+            now = time.time()
+            if interrupted_at is not None:
+                if now - interrupted_at > KILL_GRACE:
+                    self._kill()
+                    return
+                continue
+            if self.time_limit is not None and now - t0 > self.time_limit:
+                self.reason = self.time_message
+                interrupt_kernel(self.runner)
+                interrupted_at = now
+                continue
+            if self.max_memory is not None and self.pid is not None:
+                memory = rss(self.pid)
+                if memory is not None and memory > self.max_memory:
+                    self.reason = 'used more than {0:.0f} MB memory'.format(
+                        self.max_memory / 2. ** 20)
+                    self._kill()
+                    return
+
+    def _kill(self):
+        self.killed = True
+        kill_kernel(self.runner)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+@contextmanager
+def _polling_shell(runner, watchdog):
+    """Make ``runner`` wait for cell reply in short polls, for `watchdog`
+
+    ``NotebookRunner.run_cell`` waits for the reply without a timeout, so
+    would wait forever for a killed kernel.  Runners without a kernel client
+    check for themselves.
+    """
+    kc = getattr(runner, 'kc', None)
+    if kc is None:
+        yield
+        return
+    get_shell_msg = kc.get_shell_msg
+
+    def polling_get_shell_msg(*args, **kwargs):
+        while True:
+            try:
+                return get_shell_msg(timeout=POLL_INTERVAL)
+            except Empty:
+                if watchdog.killed or not runner.km.is_alive():
+                    raise RuntimeError('Kernel died')
+
+    kc.get_shell_msg = polling_get_shell_msg
+    try:
+        yield
+    finally:
+        del kc.get_shell_msg
+
+
+class CellBudget(object):
+    """ Monitor limiting run time and memory of cells in one notebook
+
+    Use a new instance for each notebook.
+
+    Parameters
+    ----------
+    nb : notebook node
+        Notebook (format 3) whose cells we will run.
+    cell_timeout : None or float, optional
+        Maximum seconds for any one cell.
+    notebook_timeout : None or float, optional
+        Maximum seconds for all the cells we run in the notebook.
+    max_memory : None or int, optional
+        Maximum resident memory of the kernel process, in bytes.
+    """
+
+    def __init__(self, nb, cell_timeout=None, notebook_timeout=None,
+                 max_memory=None):
+        self.cell_timeout = cell_timeout
+        self.notebook_timeout = notebook_timeout
+        self.max_memory = max_memory
+        self.elapsed = 0.
+        self._indices = dict((id(cell), i)
+                             for i, cell in enumerate(code_cells(nb)))
+
+    def time_limit(self):
+        """Return seconds the next cell may run, and message for overrun
+
+        The seconds are None for no limit.
+        """
+        limit, message = None, None
+        if self.cell_timeout is not None:
+            limit = self.cell_timeout
+            message = 'ran for more than {0:g} seconds'.format(limit)
+        if self.notebook_timeout is not None:
+            remaining = self.notebook_timeout - self.elapsed
+            if limit is None or remaining < limit:
+                limit = remaining
+                message = 'took notebook past {0:g} seconds'.format(
+                    self.notebook_timeout)
+        return limit, message
+
+    @contextmanager
+    def cell(self, runner, cell):
+        if not can_stop(runner):
+            # Interrupting this process could stop anything, not the cell
+            raise RuntimeError('Time and memory limits need a kernel, or '
+                               'an exec engine that can fork')
+        lines = cell.input.strip().splitlines()
+        where = 'Cell {0} ({1!r})'.format(self._indices.get(id(cell)),
+                                          lines[0] if lines else '')
+        time_limit, time_message = self.time_limit()
+        if time_limit is not None and time_limit <= 0:
+            raise BudgetExceeded(
+                '{0} not run; notebook ran for more than {1:g} seconds'.format(
+                    where, self.notebook_timeout))
+        watchdog = _Watchdog(runner, time_limit, self.max_memory,
+                             time_message)
+        t0 = time.time()
+        watchdog.start()
+        try:
+            with _polling_shell(runner, watchdog):
+                yield
+        except Exception:
+            if watchdog.reason is None:
+                raise
+        finally:
+            watchdog.stop()
+            self.elapsed += time.time() - t0
+        if watchdog.reason is not None:
+            raise BudgetExceeded('{0} {1}'.format(where, watchdog.reason))
@@ -0,0 +1,403 @@
+""" Cache of code cell outputs for incremental notebook evaluation
+
+Each code cell gets a key that is a chained hash of its own source and the
+sources of all the code cells before it, so the key changes if the cell, or
+anything run before it, changes.  We store the outputs of each cell under its
+key.
+
+To start evaluation part way through a notebook, the kernel needs the
+namespace that the earlier cells would have made.  After cells that have
+taken a while to run, we save a checkpoint of the kernel namespace under the
+cell key.  On the next evaluation, we fill outputs from the cache up to the
+first changed cell, restore the namespace from the nearest checkpoint before
+it, and run the kernel only from there.
+
+We only save a checkpoint when every variable in the namespace can be pickled
+(with ``dill`` if the kernel has it, otherwise ``pickle``); imported modules
+are stored by name.  Without ``dill``, we store functions defined in the
+notebook as their source code; IPython does not keep the source of classes,
+so notebooks defining classes need ``dill`` for checkpoints.  The checkpoint
+also stores the state of the ``random`` and ``numpy.random`` generators.  Line
+magics such as ``%matplotlib inline`` from skipped cells are run again after
+restoring a checkpoint.
+
+Skipped cells do not run, so anything else they did is lost: files they wrote
+to the working directory, matplotlib ``rcParams``, numpy print and error
+settings, the environment, and so on.  We never restart after a cell that
+looks as if it does something like this (see ``has_side_effect``); the
+notebook runs from that cell or earlier.  We find these cells by the calls
+and assignments in their source code, so we miss effects hidden inside
+functions from other modules.
+"""
+import os
+import io
+import re
+import ast
+import json
+import time
+import hashlib
+
+from lazy_import import LazyModule
+from fsutil import makedirs
+from kernel_pool import code_cells, run_code, run_cell, renumber_prompts
+
+# IPython before and after the big split; imported on first use
+nbformat = LazyModule(('nbformat', 'IPython.nbformat'))
+
+# Seconds of cell run time after which to save a checkpoint
+DEFAULT_CHECKPOINT_INTERVAL = 2.
+
+# regexp for line magics, that change kernel state outside the namespace
+line_magic_re = re.compile(r'^%(?!%).*$', re.M)
+
+# Calls with effects that a checkpoint does not restore: writing files, and
+# changing matplotlib, numpy or process settings.  We match the called name,
+# with or without a module or object before it, as in ``np.save(...)``.
+SIDE_EFFECT_CALLS = frozenset((
+    'savefig', 'savetxt', 'save', 'savez', 'savez_compressed', 'tofile',
+    'to_csv', 'to_excel', 'to_hdf', 'to_json', 'to_pickle', 'to_parquet',
+    'write_text', 'write_bytes', 'dump', 'rc', 'rc_file', 'rcdefaults',
+    'rc_context', 'use', 'seterr', 'set_printoptions', 'mkdir', 'makedirs',
+    'rmdir', 'unlink', 'touch', 'chdir', 'putenv', 'unsetenv'))
+
+# Calls that are side effects from ``os``, but common, harmless methods of
+# other objects, such as ``str.replace`` or ``list.remove``
+OS_CALLS = frozenset(('remove', 'rename', 'replace', 'symlink', 'link',
+                      'system'))
+
+# Modules where any call may change files or process state
+SIDE_EFFECT_MODULES = frozenset(('shutil', 'subprocess'))
+
+# Modules whose ``open`` takes the mode second, like the builtin
+OPEN_MODULES = frozenset(('io', 'codecs', 'gzip', 'bz2', 'lzma'))
+
+# Global state we restore from no checkpoint; setting or updating these, or
+# their items, is a side effect
+SIDE_EFFECT_STATE = frozenset(('rcParams', 'environ', 'path'))
+
+# Methods that change the object they are called on
+MUTATING_METHODS = frozenset(('update', 'setdefault', 'pop', 'popitem',
+                              'clear', 'append', 'extend', 'insert',
+                              'remove'))
+
+try:
+    string_types = (basestring,)
+except NameError:  # Python 3
+    string_types = (str,)
+
+# Run in the kernel to save namespace checkpoint to `path`.  Skip names that
+# IPython put into the namespace.  Write nothing if any value will not pickle.
+SAVE_TEMPLATE = """\
+def _save_checkpoint(path):
+    import os, sys, types, inspect, pickle, random
+    try:
+        import dill as pickler
+    except ImportError:
+        pickler = pickle
+    modules = {{}}
+    sources = {{}}
+    values = {{}}
+    hidden = get_ipython().user_ns_hidden
+    for name, value in list(get_ipython().user_ns.items()):
+        if name.startswith('_') or hidden.get(name, hidden) is value:
+            continue
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+            continue
+        if (pickler is pickle and
+            isinstance(value, (types.FunctionType, type)) and
+            value.__module__ == '__main__'):
+            # Pickle stores these by reference to a module; the new kernel
+            # will not have them
+            try:
+                sources[name] = inspect.getsource(value)
+            except (IOError, TypeError):
+                return
+            continue
+        try:
+            values[name] = pickler.dumps(value, 2)
+        except Exception:
+            return
+    state = dict(modules=modules, sources=sources, values=values,
+                 random=random.getstate())
+    if 'numpy' in sys.modules:
+        state['numpy_random'] = sys.modules['numpy'].random.get_state()
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f, 2)
+    os.rename(path + '.tmp', path)
+_save_checkpoint({path!r})
+del _save_checkpoint
+"""
+
+# Run in the kernel to restore namespace from checkpoint at `path`
+RESTORE_TEMPLATE = """\
+def _restore_checkpoint(path):
+    import sys, pickle, random
+    try:
+        import dill as pickler
+    except ImportError:
+        pickler = pickle
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    ns = get_ipython().user_ns
+    for name, mod_name in state['modules'].items():
+        __import__(mod_name)
+        ns[name] = sys.modules[mod_name]
+    for name, source in state['sources'].items():
+        exec(source, ns)
+    for name, value in state['values'].items():
+        ns[name] = pickler.loads(value)
+    random.setstate(state['random'])
+    if 'numpy_random' in state:
+        import numpy
+        numpy.random.set_state(state['numpy_random'])
+_restore_checkpoint({path!r})
+del _restore_checkpoint
+"""
+
+
+def _string(node):
+    """Return string value of constant `node`, or None"""
+    value = getattr(node, 'value', getattr(node, 's', None))
+    return value if isinstance(value, string_types) else None
+
+
+def _name(node):
+    """Return name of Name or attribute `node`, or None"""
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    return None
+
+
+def _is_state(node):
+    """True if `node` is, or is an item of, state in ``SIDE_EFFECT_STATE``"""
+    while isinstance(node, ast.Subscript):
+        node = node.value
+    name = _name(node)
+    if name == 'path':  # Only ``sys.path``, not any variable called path
+        return (isinstance(node, ast.Attribute) and
+                _name(node.value) == 'sys')
+    return name in SIDE_EFFECT_STATE
+
+
+def _opens_for_writing(call):
+    """True if `call` of ``open`` may write, or we cannot tell"""
+    func = call.func
+    mode_index = 0
+    if isinstance(func, ast.Name) or (
+            isinstance(func.value, ast.Name) and
+            func.value.id in OPEN_MODULES):
+        mode_index = 1  # ``Path(...).open`` takes the mode first
+    modes = [kw.value for kw in call.keywords if kw.arg == 'mode']
+    if len(call.args) > mode_index:
+        modes.append(call.args[mode_index])
+    if not modes:
+        return False
+    mode = _string(modes[0])
+    return mode is None or bool(set('wax+') & set(mode))
+
+
+def _call_has_side_effect(call):
+    func = call.func
+    name = _name(func)
+    if name is None:
+        return False
+    if name in SIDE_EFFECT_CALLS:
+        return True
+    if name == 'open':
+        return _opens_for_writing(call)
+    if isinstance(func, ast.Name):
+        return name in OS_CALLS
+    if name in MUTATING_METHODS and _is_state(func.value):
+        return True
+    module = _name(func.value) if isinstance(func.value, ast.Name) else None
+    return (module in SIDE_EFFECT_MODULES or
+            module == 'os' and name in OS_CALLS)
+
+
+def has_side_effect(source):
+    """True if cell `source` may have effects we cannot replay
+
+    These are calls in ``SIDE_EFFECT_CALLS``, ``OS_CALLS`` and
+    ``SIDE_EFFECT_MODULES``, opening files for writing, and setting or updating ``rcParams``,
+    ``os.environ`` or ``sys.path``.  Line magics are fine; we run them again
+    after restoring a checkpoint.  Cells that are not plain Python, such as
+    those with shell commands or cell magics, may do anything.
+    """
+    try:
+        tree = ast.parse(line_magic_re.sub('', source))
+    except SyntaxError:
+        return True
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            if _call_has_side_effect(node):
+                return True
+        elif isinstance(node, (ast.Assign, ast.AugAssign, ast.Delete)):
+            targets = getattr(node, 'targets', None) or [node.target]
+            if any(_is_state(target) for target in targets):
+                return True
+    return False
+
+
+def first_side_effect(sources):
+    """Return index of first of cell `sources` with effects we cannot replay
+
+    Return the number of sources if none has; see ``has_side_effect``.
+    """
+    for i, source in enumerate(sources):
+        if has_side_effect(source):
+            return i
+    return len(sources)
+
+
+def chain_keys(sources, seed=''):
+    """Return list of chained hashes, one per code cell source in `sources`
+
+    `seed` goes into the first hash, and so into all hashes.  Use it for
+    anything else that can change the outputs, such as library versions.
+    """
+    keys = []
+    previous = hashlib.sha256(seed.encode('utf-8')).hexdigest()
+    for source in sources:
+        hasher = hashlib.sha256(previous.encode('ascii'))
+        hasher.update(source.encode('utf-8'))
+        previous = hasher.hexdigest()
+        keys.append(previous)
+    return keys
+
+
+class CellCache(object):
+    """ On-disk store of code cell outputs and kernel checkpoints
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory in which to store outputs and checkpoints.
+    checkpoint_interval : float, optional
+        Save a checkpoint after cells have run for this many seconds in
+        total since the last checkpoint.  Lower values give finer restart
+        points, at the cost of pickling the namespace more often.
+    """
+
+    def __init__(self, cache_dir, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.cache_dir = cache_dir
+        self.checkpoint_interval = checkpoint_interval
+
+    def _path(self, key, ext):
+        return os.path.join(self.cache_dir, key[:2], key + ext)
+
+    def has_outputs(self, key):
+        return os.path.isfile(self._path(key, '.json'))
+
+    def has_checkpoint(self, key):
+        return os.path.isfile(self._path(key, '.pkl'))
+
+    def load_outputs(self, key, cell):
+        """Fill outputs and prompt number of `cell` from cache"""
+        with io.open(self._path(key, '.json'), 'rt', encoding='utf-8') as f:
+            stored = json.load(f)
+        cell.outputs = [nbformat.from_dict(output)
+                        for output in stored['outputs']]
+        if stored['prompt_number'] is not None:
+            cell.prompt_number = stored['prompt_number']
+
+    def store_outputs(self, key, cell):
+        path = self._path(key, '.json')
+        makedirs(os.path.dirname(path))
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with io.open(tmp_path, 'wt', encoding='utf-8') as f:
+            f.write(json.dumps(dict(outputs=cell.outputs,
+                                    prompt_number=cell.get('prompt_number')),
+                               ensure_ascii=False))
+        os.rename(tmp_path, path)
+
+    def save_checkpoint(self, runner, key):
+        """Save checkpoint of `runner` kernel namespace; True if saved"""
+        path = self._path(key, '.pkl')
+        run_code(runner, SAVE_TEMPLATE.format(path=path))
+        return os.path.isfile(path)
+
+    def restore_checkpoint(self, runner, key):
+        """Restore `runner` kernel namespace from checkpoint; True if done"""
+        try:
+            run_code(runner, RESTORE_TEMPLATE.format(
+                path=self._path(key, '.pkl')))
+        except RuntimeError:
+            run_code(runner, '%reset -f')
+            return False
+        return True
+
+    def resume_point(self, nb, seed=''):
+        """Return cell keys for `nb`, and index of first code cell to run
+
+        All code cells before the returned index have cached outputs, and,
+        unless the index is 0, there is a checkpoint for the cell just before
+        it.  If the index is the number of code cells, all outputs are
+        cached, and nothing needs to run.  Otherwise, the index is no later
+        than the first cell with effects we cannot replay (see
+        ``first_side_effect``), so that cell runs again.
+        """
+        sources = [cell.input for cell in code_cells(nb)]
+        keys = chain_keys(sources, seed)
+        n_cached = 0
+        while n_cached < len(keys) and self.has_outputs(keys[n_cached]):
+            n_cached += 1
+        if n_cached == len(keys):
+            return keys, n_cached
+        n_cached = min(n_cached, first_side_effect(sources))
+        for start in range(n_cached, 0, -1):
+            if self.has_checkpoint(keys[start - 1]):
+                return keys, start
+        return keys, 0
+
+    def fill_outputs(self, nb, keys, stop):
+        """Fill outputs of first `stop` code cells of `nb` from cache"""
+        for i, cell in enumerate(code_cells(nb)):
+            if i == stop:
+                break
+            self.load_outputs(keys[i], cell)
+
+    def run_notebook(self, runner, nb, seed='', monitors=()):
+        """Run code cells of `nb` in `runner` from first changed cell
+
+        Parameters
+        ----------
+        runner : ``NotebookRunner`` instance
+            Runner with reset kernel, e.g. from ``KernelPool.kernel``.
+        nb : notebook node
+            Notebook (format 3) to evaluate.  Outputs are filled in place.
+        seed : str, optional
+            Seed for cell keys, see ``chain_keys``.
+        monitors : sequence, optional
+            Cell monitors; see ``kernel_pool.run_cell``.
+
+        Returns
+        -------
+        nb : notebook node
+            The evaluated input notebook.
+        """
+        runner.nb = nb
+        cells = list(code_cells(nb))
+        keys, start = self.resume_point(nb, seed)
+        if 0 < start < len(cells):
+            if self.restore_checkpoint(runner, keys[start - 1]):
+                magics = [line for cell in cells[:start]
+                          for line in line_magic_re.findall(cell.input)]
+                if magics:
+                    run_code(runner, '\n'.join(magics))
+            else:
+                start = 0
+        self.fill_outputs(nb, keys, start)
+        run_time = 0.
+        for key, cell in zip(keys[start:], cells[start:]):
+            t0 = time.time()
+            run_cell(runner, cell, monitors)
+            run_time += time.time() - t0
+            self.store_outputs(key, cell)
+            if (run_time >= self.checkpoint_interval and
+                self.save_checkpoint(runner, key)):
+                run_time = 0.
+        renumber_prompts(nb)
+        return nb
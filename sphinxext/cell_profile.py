@@ -0,0 +1,167 @@
+""" Record run time and memory use of notebook cells
+
+A ``CellProfiler`` is a cell monitor (see ``kernel_pool.run_cell``).  For
+each code cell it runs, it records the wall clock time, the CPU time used by
+the kernel process, and the peak resident memory of the kernel process while
+the cell was running.  Memory is sampled from a background thread, so very
+short spikes may not show.
+
+``write_report`` writes records from any number of notebooks as JSON, and
+``summary`` gives a table of the slowest cells, for tracking the heaviest
+notebooks across commits.
+
+We use ``psutil`` if available, otherwise ``/proc``; where neither works,
+CPU time and memory are None.
+"""
+import os
+import io
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from kernel_pool import kernel_pid
+
+# Seconds between memory samples while a cell runs
+SAMPLE_INTERVAL = 0.02
+
+
+def cpu_time(pid):
+    """Return user + system CPU seconds of process `pid`, or None"""
+    if psutil is not None:
+        try:
+            times = psutil.Process(pid).cpu_times()
+        except psutil.Error:
+            return None
+        return times.user + times.system
+    try:
+        with open('/proc/{0}/stat'.format(pid), 'rt') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, OSError):
+        return None
+    # utime, stime are fields 14, 15 of stat; we dropped the first two
+    return (int(fields[11]) + int(fields[12])) / float(
+        os.sysconf('SC_CLK_TCK'))
+
+
+def rss(pid):
+    """Return resident memory in bytes of process `pid`, or None"""
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        with open('/proc/{0}/statm'.format(pid), 'rt') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+class _PeakSampler(threading.Thread):
+    """Thread sampling resident memory of `pid` until stopped"""
+
+    def __init__(self, pid):
+        super(_PeakSampler, self).__init__()
+        self.daemon = True
+        self.pid = pid
+        self.peak = rss(pid)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(SAMPLE_INTERVAL):
+            self._sample()
+
+    def _sample(self):
+        value = rss(self.pid)
+        if value is not None and (self.peak is None or value > self.peak):
+            self.peak = value
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self._sample()
+        return self.peak
+
+
+class CellProfiler(object):
+    """ Monitor recording run time and memory of each cell in a notebook
+
+    Parameters
+    ----------
+    name : str
+        Name of notebook, for the report.
+    nb : notebook node
+        Notebook (format 3) whose cells we will profile.
+    store_metadata : bool, optional
+        If True, also store the timings in the ``profile`` field of the
+        metadata of each cell.
+    """
+
+    def __init__(self, name, nb, store_metadata=False):
+        self.name = name
+        self.store_metadata = store_metadata
+        self.records = []
+        self._indices = {}
+        index = 0
+        for ws in nb.worksheets:
+            for cell in ws.cells:
+                if cell.cell_type == 'code':
+                    self._indices[id(cell)] = index
+                    index += 1
+
+    @contextmanager
+    def cell(self, runner, cell):
+        pid = kernel_pid(runner)
+        cpu0 = None if pid is None else cpu_time(pid)
+        sampler = None
+        if pid is not None:
+            sampler = _PeakSampler(pid)
+            sampler.start()
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            wall = time.time() - t0
+            peak = None if sampler is None else sampler.stop()
+            cpu1 = None if pid is None else cpu_time(pid)
+            record = dict(wall=wall,
+                          cpu=None if None in (cpu0, cpu1) else cpu1 - cpu0,
+                          peak_rss=peak)
+            if self.store_metadata:
+                cell.metadata['profile'] = dict(record)
+            lines = cell.input.strip().splitlines()
+            record.update(notebook=self.name,
+                          cell=self._indices.get(id(cell)),
+                          first_line=lines[0] if lines else '')
+            self.records.append(record)
+
+
+def write_report(records, path):
+    """Write profile `records` as JSON to `path`, slowest cells first"""
+    records = sorted(records, key=lambda r: r['wall'], reverse=True)
+    with io.open(path, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps(dict(cells=records), indent=1,
+                           ensure_ascii=False))
+
+
+def summary(records, n=10):
+    """Return table of the `n` slowest cells in profile `records`"""
+    records = sorted(records, key=lambda r: r['wall'], reverse=True)[:n]
+    lines = ['{0:>8} {1:>8} {2:>9}  {3}'.format(
+        'wall (s)', 'cpu (s)', 'peak (MB)', 'notebook / cell')]
+    for record in records:
+        cpu = '-' if record['cpu'] is None else '{0:.2f}'.format(
+            record['cpu'])
+        peak = '-' if record['peak_rss'] is None else '{0:.1f}'.format(
+            record['peak_rss'] / 2. ** 20)
+        lines.append('{0:8.2f} {1:>8} {2:>9}  {3}[{4}]: {5}'.format(
+            record['wall'], cpu, peak, record['notebook'], record['cell'],
+            record['first_line'][:40]))
+    return '\n'.join(lines)
@@ -0,0 +1,548 @@
+""" Run notebook cells with ``exec``, without an IPython kernel
+
+An IPython kernel is a separate process that gets each cell, and sends back
+each output, as ZMQ messages.  For notebooks that only need plain Python,
+numpy and matplotlib, we can run the cells with ``exec`` in a fresh
+namespace, and build the same notebook outputs ourselves:
+
+* writes to ``sys.stdout`` and ``sys.stderr`` become stream outputs;
+* the value of a final expression becomes a ``pyout`` output, with rich
+  representations from ``_repr_html_``, ``_repr_png_`` and friends, and
+  ``display(obj)`` gives display data in the same way;
+* after ``%matplotlib inline`` or ``%pylab inline``, open matplotlib figures
+  are drawn with Agg, as PNG (or SVG, see ``%config``) display data, at the
+  end of the cell or on ``plt.show()``;
+* errors become ``pyerr`` outputs, and raise ``kernel_pool.NotebookError``,
+  so the engine does not need runipy.
+
+We understand the line magics in ``MAGICS`` below.  Notebooks with other
+magics, cell magics or shell commands need a kernel; ``exec_supported``
+checks for these.
+
+An ``ExecEngine`` has the same ``kernel`` context manager as
+``kernel_pool.KernelPool``, giving runners with the same ``run_cell`` method
+as ``NotebookRunner``.  By default, each notebook runs in a child process
+forked from this one, so it starts with the modules we have already imported,
+and cannot change our state.  Without fork (e.g. on Windows), cells run in
+this process; we put back the streams, working directory and ``sys.path``
+after each cell, and matplotlib's rcParams, backend and figures after each
+notebook.  We cannot then stop a cell from outside, so notebooks with
+time or memory limits (see ``cell_budget``) need a forked child or a kernel.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import re
+import ast
+import io
+import base64
+import signal
+import pprint
+import linecache
+import traceback
+import multiprocessing
+from contextlib import contextmanager
+
+from lazy_import import LazyModule
+from kernel_pool import DEFAULT_PREIMPORTS, NotebookError
+
+# IPython before and after the big split; slow to import, so imported on first
+# use
+nbf = LazyModule(('nbformat.v3', 'IPython.nbformat.v3'))
+
+try:
+    string_types = (basestring,)
+except NameError:  # Python 3
+    string_types = (str,)
+
+# Notebook output attributes for mime types, as for ``NotebookRunner``
+MIME_MAP = {
+    'image/jpeg': 'jpeg',
+    'image/png': 'png',
+    'image/svg+xml': 'svg',
+    'text/plain': 'text',
+    'text/html': 'html',
+    'text/latex': 'latex',
+    'application/javascript': 'html',
+}
+
+# Rich representation methods, in the order IPython uses them
+REPR_METHODS = (('text/html', '_repr_html_'),
+                ('image/svg+xml', '_repr_svg_'),
+                ('image/png', '_repr_png_'),
+                ('image/jpeg', '_repr_jpeg_'),
+                ('text/latex', '_repr_latex_'),
+                ('application/javascript', '_repr_javascript_'))
+
+# Line magics we can do without a kernel
+MAGICS = ('matplotlib', 'pylab', 'config', 'reset')
+
+# matplotlib settings of the IPython inline backend
+INLINE_RC = {'figure.figsize': (6.0, 4.0),
+             'figure.facecolor': (1, 1, 1, 0),
+             'figure.edgecolor': (1, 1, 1, 0),
+             'font.size': 10,
+             'figure.dpi': 72,
+             'figure.subplot.bottom': .125}
+
+# regexp for line magics, allowing indentation
+magic_re = re.compile(r'^(\s*)%(?!%)(\w+)(.*)$')
+
+# regexp for code that needs IPython: cell magics, shell commands, help
+ipython_re = re.compile(r'^\s*(%%|!|\?)|\?\s*$', re.M)
+
+# regexp for InlineBackend configuration
+figure_format_re = re.compile(
+    r'^\s*InlineBackend\.figure_formats?\s*=\s*(.+)$')
+
+# Seconds between checks that a forked child is still alive
+POLL_INTERVAL = 0.1
+
+
+def exec_supported(nb):
+    """Return True if we can run all code cells of v3 notebook `nb`"""
+    for ws in nb.worksheets:
+        for cell in ws.cells:
+            if cell.cell_type != 'code':
+                continue
+            if ipython_re.search(cell.input):
+                return False
+            for line in cell.input.splitlines():
+                match = magic_re.match(line)
+                if match is not None and match.group(2) not in MAGICS:
+                    return False
+    return True
+
+
+def translate(source):
+    """Replace line magics in `source` with calls to ``_engine_magic``"""
+    lines = []
+    for line in source.splitlines():
+        match = magic_re.match(line)
+        if match is not None:
+            indent, name, args = match.groups()
+            if name not in MAGICS:
+                raise NotebookError(
+                    'Magic %{0} needs an IPython kernel'.format(name))
+            line = '{0}_engine_magic({1!r}, {2!r})'.format(
+                indent, name, args.strip())
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def format_data(obj):
+    """Return dict of mime type: data for `obj`, like IPython's formatter"""
+    data = {'text/plain': pprint.pformat(obj)}
+    for mime, method_name in REPR_METHODS:
+        method = getattr(obj, method_name, None)
+        if method is None:
+            continue
+        try:
+            value = method()
+        except Exception:
+            continue
+        if value is None:
+            continue
+        if mime in ('image/png', 'image/jpeg'):
+            value = base64.b64encode(value).decode('ascii')
+        data[mime] = value
+    return data
+
+
+class _Stream(object):
+    """File-like object adding what it gets to stream outputs"""
+
+    encoding = 'utf-8'
+
+    def __init__(self, runner, name):
+        self.runner = runner
+        self.name = name
+
+    def write(self, text):
+        if isinstance(text, bytes):
+            text = text.decode(self.encoding, 'replace')
+        if not text:
+            return
+        outputs = self.runner.outputs
+        if (outputs and outputs[-1].output_type == 'stream' and
+            outputs[-1].stream == self.name):
+            outputs[-1].text += text
+        else:
+            outputs.append(nbf.new_output('stream', stream=self.name,
+                                          output_text=text))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class _Shell(object):
+    """Just enough of IPython's ``get_ipython()`` for the cell cache"""
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.user_ns_hidden = {}
+
+    @property
+    def user_ns(self):
+        return self.runner.namespace
+
+
+class InProcessRunner(object):
+    """ Run notebook cells with ``exec`` in this process
+
+    There is no separate process to interrupt or kill, so this runner has no
+    ``interrupt`` or ``kill`` methods; see ``kernel_pool.can_stop``.
+
+    Parameters
+    ----------
+    nb : None or notebook node, optional
+        Notebook, for compatibility with ``NotebookRunner``.
+    working_dir : None or str, optional
+        Directory in which to run cells.  Defaults to current directory.
+    path : sequence, optional
+        Directories to put at the front of ``sys.path`` while running cells.
+    """
+
+    def __init__(self, nb=None, working_dir=None, path=()):
+        self.nb = nb
+        if working_dir is None:
+            working_dir = os.getcwd()
+        self.working_dir = os.path.abspath(working_dir)
+        self.path = [self.working_dir] + [os.path.abspath(p) for p in path]
+        self.pid = os.getpid()
+        self.outputs = []
+        self.execution_count = 0
+        self.inline = False
+        self.figure_formats = ('png',)
+        self._modules = set(sys.modules)
+        self._mpl_state = self._matplotlib_state()
+        self.shell = _Shell(self)
+        self.namespace = {}
+        self.reset()
+
+    def reset(self):
+        """Clear user namespace"""
+        self.namespace.clear()
+        self.namespace.update({'__name__': '__main__',
+                               '__builtins__': __builtins__,
+                               'display': self.display,
+                               'get_ipython': lambda: self.shell,
+                               '_engine_magic': self.magic})
+        self.shell.user_ns_hidden = dict(self.namespace)
+
+    def magic(self, name, args=''):
+        """Do line magic `name` with argument string `args`"""
+        if name == 'matplotlib':
+            self.enable_inline()
+        elif name == 'pylab':
+            self.enable_inline()
+            exec('import numpy\n'
+                 'import matplotlib\n'
+                 'from matplotlib import pylab, mlab, pyplot\n'
+                 'np = numpy\n'
+                 'plt = pyplot\n'
+                 'from pylab import *\n'
+                 'from numpy import *\n', self.namespace)
+        elif name == 'config':
+            match = figure_format_re.match(args)
+            if match is None:
+                raise ValueError('Cannot do %config ' + args)
+            formats = ast.literal_eval(match.group(1))
+            if isinstance(formats, string_types):
+                formats = (formats,)
+            self.figure_formats = tuple(
+                'svg' if fmt == 'svg' else 'png' for fmt in formats)
+        elif name == 'reset':
+            self.reset()
+        else:
+            raise ValueError('Cannot do %' + name)
+
+    def enable_inline(self):
+        import matplotlib
+        if 'matplotlib.pyplot' in sys.modules:
+            sys.modules['matplotlib.pyplot'].switch_backend('agg')
+        else:
+            matplotlib.use('agg')
+        matplotlib.rcParams.update(INLINE_RC)
+        self.inline = True
+
+    def display(self, *objs):
+        """Add display data outputs for `objs`"""
+        for obj in objs:
+            self.outputs.append(self._data_output('display_data',
+                                                  format_data(obj)))
+
+    def _data_output(self, output_type, data, **kwargs):
+        output = nbf.new_output(output_type, **kwargs)
+        for mime, value in data.items():
+            if mime in MIME_MAP:
+                setattr(output, MIME_MAP[mime], value)
+        return output
+
+    def flush_figures(self):
+        """Add display data outputs for open figures, then close them"""
+        if not self.inline or 'matplotlib.pyplot' not in sys.modules:
+            return
+        plt = sys.modules['matplotlib.pyplot']
+        for num in plt.get_fignums():
+            fig = plt.figure(num)
+            data = {'text/plain': '<matplotlib.figure.Figure at {0:#x}>'.format(
+                id(fig))}
+            for fmt in self.figure_formats:
+                buf = io.BytesIO()
+                fig.savefig(buf, format=fmt, bbox_inches='tight')
+                if fmt == 'svg':
+                    data['image/svg+xml'] = buf.getvalue().decode('utf-8')
+                else:
+                    data['image/png'] = base64.b64encode(
+                        buf.getvalue()).decode('ascii')
+            self.outputs.append(self._data_output('display_data', data))
+        plt.close('all')
+
+    @contextmanager
+    def _cell_context(self):
+        """Capture output, work in our directory and path, for one cell"""
+        saved = (sys.stdout, sys.stderr, list(sys.path), os.getcwd())
+        plt = sys.modules.get('matplotlib.pyplot')
+        show = None if plt is None else plt.show
+        sys.stdout = _Stream(self, 'stdout')
+        sys.stderr = _Stream(self, 'stderr')
+        sys.path[:0] = self.path
+        os.chdir(self.working_dir)
+        if plt is not None and self.inline:
+            plt.show = lambda *args, **kwargs: self.flush_figures()
+        try:
+            yield
+        finally:
+            sys.stdout, sys.stderr, sys.path[:], cwd = saved
+            os.chdir(cwd)
+            if show is not None:
+                plt.show = show
+
+    def run_cell(self, cell):
+        """Run a notebook cell and update the output of that cell in-place"""
+        self.execution_count += 1
+        count = self.execution_count
+        self.outputs = []
+        fname = '<ipython-input-{0}>'.format(count)
+        error = None
+        try:
+            source = translate(cell.input)
+            # For tracebacks, and ``inspect.getsource``
+            linecache.cache[fname] = (len(source), None,
+                                      source.splitlines(True), fname)
+            with self._cell_context():
+                tree = ast.parse(source, fname)
+                last = None
+                if tree.body and isinstance(tree.body[-1], ast.Expr):
+                    last = ast.Expression(tree.body.pop().value)
+                exec(compile(tree, fname, 'exec'), self.namespace)
+                if last is not None:
+                    value = eval(compile(last, fname, 'eval'), self.namespace)
+                    if value is not None:
+                        self.namespace['_'] = value
+                        self.outputs.append(self._data_output(
+                            'pyout', format_data(value), prompt_number=count))
+                self.flush_figures()
+        except (Exception, KeyboardInterrupt):
+            etype, evalue, tb = sys.exc_info()
+            # Drop our own frame from the traceback
+            lines = traceback.format_exception(etype, evalue, tb.tb_next)
+            error = nbf.new_output('pyerr', ename=etype.__name__,
+                                   evalue=str(evalue), traceback=lines)
+            self.outputs.append(error)
+        cell.outputs = self.outputs
+        cell.prompt_number = count
+        if error is not None:
+            raise NotebookError(
+                'Cell raised uncaught exception: \n' +
+                ''.join(error.traceback))
+
+    @staticmethod
+    def _matplotlib_state():
+        """Return rcParams and open figure numbers, or None without matplotlib
+        """
+        matplotlib = sys.modules.get('matplotlib')
+        if matplotlib is None:
+            return None
+        plt = sys.modules.get('matplotlib.pyplot')
+        # dict methods, so we do not validate, or resolve the backend
+        return (dict(dict.items(matplotlib.rcParams)),
+                set() if plt is None else set(plt.get_fignums()))
+
+    def _restore_matplotlib(self):
+        """Close figures of the notebook, put back rcParams and backend
+
+        If matplotlib was not loaded when the notebook started, the rcParams
+        go back to those matplotlib loaded with.
+        """
+        matplotlib = sys.modules.get('matplotlib')
+        if matplotlib is None:
+            return
+        if self._mpl_state is not None:
+            rcparams, fignums = self._mpl_state
+        elif hasattr(matplotlib, 'rcParamsOrig'):
+            rcparams = dict(dict.items(matplotlib.rcParamsOrig))
+            fignums = set()
+        else:
+            return
+        plt = sys.modules.get('matplotlib.pyplot')
+        if plt is not None:
+            for num in set(plt.get_fignums()) - fignums:
+                plt.close(num)
+            # Not the automatic backend, that pyplot resolves on first use
+            backend = rcparams.get('backend')
+            if (isinstance(backend, string_types) and
+                backend != dict.get(matplotlib.rcParams, 'backend')):
+                plt.switch_backend(backend)
+        dict.update(matplotlib.rcParams, rcparams)
+
+    def shutdown_kernel(self):
+        """Restore matplotlib state, and forget modules imported from outside
+        the Python installation
+
+        Each cell runs with our streams, working directory and ``sys.path``
+        put back after it (see ``_cell_context``).
+        """
+        self._restore_matplotlib()
+        for name in set(sys.modules) - self._modules:
+            fname = getattr(sys.modules[name], '__file__', None) or ''
+            if not fname.startswith((sys.prefix, sys.exec_prefix)):
+                del sys.modules[name]
+
+
+def _serve(conn, working_dir, path):
+    """Run cells from `conn` in forked child, send back outputs"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    runner = InProcessRunner(working_dir=working_dir, path=path)
+    while True:
+        source = conn.recv()
+        if source is None:
+            break
+        cell = nbf.new_code_cell(input=source)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            runner.run_cell(cell)
+            error = None
+        except NotebookError as err:
+            error = str(err)
+        finally:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+        conn.send((cell.outputs, cell.prompt_number, error))
+
+
+class ForkedRunner(object):
+    """ Run notebook cells with ``exec`` in a child process forked from this
+
+    Parameters are as for ``InProcessRunner``.
+    """
+
+    def __init__(self, nb=None, working_dir=None, path=()):
+        self.nb = nb
+        self._conn, child_conn = multiprocessing.Pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:  # child
+            self._conn.close()
+            status = 0
+            try:
+                _serve(child_conn, working_dir, path)
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        child_conn.close()
+
+    def is_alive(self):
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except OSError:
+            return False
+        return pid == 0
+
+    def run_cell(self, cell):
+        """Run a notebook cell and update the output of that cell in-place"""
+        try:
+            self._conn.send(cell.input)
+            while not self._conn.poll(POLL_INTERVAL):
+                if not self.is_alive():
+                    raise EOFError
+            outputs, prompt_number, error = self._conn.recv()
+        except (EOFError, IOError, OSError):
+            raise RuntimeError('Kernel died')
+        cell.outputs = outputs
+        cell.prompt_number = prompt_number
+        if error is not None:
+            raise NotebookError(error)
+
+    def interrupt(self):
+        os.kill(self.pid, signal.SIGINT)
+
+    def kill(self):
+        os.kill(self.pid, signal.SIGKILL)
+
+    def shutdown_kernel(self):
+        try:
+            self._conn.send(None)
+        except (IOError, OSError):
+            pass
+        self._conn.close()
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+
+
+class ExecEngine(object):
+    """ Engine running notebooks with ``exec``, used like a ``KernelPool``
+
+    Parameters
+    ----------
+    fork : bool, optional
+        If True, and the platform can fork, run each notebook in a child
+        process forked from this one.  Otherwise run cells in this process.
+    preimports : sequence, optional
+        Names of modules to import into this process, so forked children
+        start with them.  Missing modules are skipped.
+    """
+
+    def __init__(self, fork=True, preimports=DEFAULT_PREIMPORTS):
+        self.fork = fork and hasattr(os, 'fork')
+        for name in preimports:
+            try:
+                __import__(name)
+            except ImportError:
+                pass
+
+    def supports(self, nb, limits=False):
+        """Return True if we can run `nb`
+
+        With `limits`, the cells run with time or memory limits, so we must
+        be able to stop them; we can only do that in a forked child.
+        """
+        return (self.fork or not limits) and exec_supported(nb)
+
+    @contextmanager
+    def kernel(self, working_dir=None, path=()):
+        """Context manager giving a runner for one notebook
+
+        See ``KernelPool.acquire`` for parameters.
+        """
+        runner_class = ForkedRunner if self.fork else InProcessRunner
+        runner = runner_class(working_dir=working_dir, path=path)
+        try:
+            yield runner
+        finally:
+            runner.shutdown_kernel()
+
+    def shutdown(self):
+        pass
@@ -0,0 +1,78 @@
+""" File and thread pool helpers shared by the extensions
+
+The plot and notebook extensions write into shared cache and build
+directories, from several processes and threads at once, so directory
+creation has to allow for another process getting there first.  Files in the
+build are hard links to the cache where possible, and we leave unchanged files
+alone, so their modification times do not change.
+"""
+import os
+import shutil
+import atexit
+import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# Digests of files by (path, mtime, size)
+_digests = {}
+
+
+def makedirs(path):
+    """Make directory `path` and its parents, if it does not exist"""
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:  # Another process made it
+            pass
+
+
+def file_digest(fname):
+    """Return hash of contents of file `fname`, or None if it does not exist
+
+    We remember digests by modification time and size, so we only read each
+    version of a file once.
+    """
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    stamp = (fname, st.st_mtime, st.st_size)
+    if stamp not in _digests:
+        with open(fname, 'rb') as fobj:
+            _digests[stamp] = hashlib.sha256(fobj.read()).hexdigest()
+    return _digests[stamp]
+
+
+def same_contents(fname1, fname2):
+    """Return True if files `fname1` and `fname2` have the same contents"""
+    return (os.path.samefile(fname1, fname2) or
+            (os.path.getsize(fname1) == os.path.getsize(fname2) and
+             file_digest(fname1) == file_digest(fname2)))
+
+
+def link_or_copy(src, dst):
+    """Hard link `src` to `dst` if possible, otherwise copy
+
+    Leave `dst` alone if it already has the contents of `src`.  Return True
+    if we wrote `dst`.
+    """
+    if os.path.exists(dst):
+        if same_contents(src, dst):
+            return False
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):  # Other filesystem, or Windows on Py2
+        shutil.copyfile(src, dst)
+    return True
+
+
+def thread_pool(n_threads=None):
+    """Return new thread pool with `n_threads` threads, closed at exit
+
+    `n_threads` of None means one per CPU.
+    """
+    pool = ThreadPool(n_threads or multiprocessing.cpu_count())
+    # Avoid errors from the pool at interpreter exit
+    atexit.register(pool.close)
+    return pool
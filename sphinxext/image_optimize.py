@@ -0,0 +1,201 @@
+""" Make image files smaller, for lighter pages
+
+An ``ImageOptimizer`` recompresses PNG images losslessly, with the slowest
+zlib level and PIL's search over PNG filters.  It can also reduce PNG images
+to a palette of a few colours, which suits line plots, but loses shading.  It
+minifies SVG images by dropping comments, metadata and line breaks between
+tags, and can round long decimals in coordinates.  We only keep the result if
+it is smaller than the original.
+
+Optimizing PNG images needs PIL, which we import when we first make an
+optimizer; without PIL, PNG images stay as they are.
+The optimizer counts the bytes before and after, for a report at the end of
+the build.
+"""
+import os
+import io
+import re
+import threading
+
+from fsutil import thread_pool
+from lazy_import import LazyModule, is_available
+
+Image = LazyModule('PIL.Image')
+
+svg_comment_re = re.compile(r'<!--.*?-->', re.S)
+svg_metadata_re = re.compile(r'<metadata>.*?</metadata>', re.S)
+svg_newline_re = re.compile(r'>\s*\n\s*<')
+
+
+class ImageOptimizer(object):
+    """ Losslessly recompress PNG, and minify SVG, images
+
+    Parameters
+    ----------
+    png : bool, optional
+        If True, recompress PNG images, keeping every pixel.
+    colors : None or int, optional
+        If not None, reduce PNG images to a palette of at most this many
+        colours.
+    svg : bool, optional
+        If True, minify SVG images.
+    svg_precision : None or int, optional
+        If not None, round decimals in SVG images with more than this many
+        digits after the point.  Must be 1 or more.
+    threads : None or int, optional
+        Number of threads for ``optimize_files`` and ``map``.  None means one
+        per CPU.
+    """
+
+    def __init__(self, png=True, colors=None, svg=True, svg_precision=None,
+                 threads=None):
+        if svg_precision is not None and svg_precision < 1:
+            raise ValueError('svg_precision should be 1 or more')
+        self.png = png and is_available(Image)
+        self.colors = colors
+        self.svg = svg
+        self.svg_precision = svg_precision
+        self.threads = threads
+        self.stats = dict(files=0, before=0, after=0)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        if svg_precision is not None:
+            self._svg_number_re = re.compile(
+                r'(-?\d+\.\d{{{0},}})'.format(svg_precision + 1))
+
+    def signature(self):
+        """Return string of options, for cache keys"""
+        return 'png={0}, colors={1}, svg={2}, svg_precision={3}'.format(
+            self.png, self.colors, self.svg, self.svg_precision)
+
+    def _optimize_png(self, data):
+        image = Image.open(io.BytesIO(data))
+        kwargs = dict(optimize=True)
+        if 'dpi' in image.info:
+            kwargs['dpi'] = image.info['dpi']
+        if self.colors is not None and image.mode != 'P':
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            image = image.quantize(self.colors, method=Image.FASTOCTREE)
+        out = io.BytesIO()
+        image.save(out, 'PNG', **kwargs)
+        return out.getvalue()
+
+    def _round_number(self, match):
+        text = '{0:.{1}f}'.format(float(match.group(1)), self.svg_precision)
+        return text.rstrip('0').rstrip('.')
+
+    def _optimize_svg(self, data):
+        text = data.decode('utf-8')
+        text = svg_comment_re.sub('', text)
+        text = svg_metadata_re.sub('', text)
+        text = svg_newline_re.sub('><', text)
+        if self.svg_precision is not None:
+            text = self._svg_number_re.sub(self._round_number, text)
+        return text.encode('utf-8')
+
+    def handles(self, ext):
+        """Return True if we optimize images with file extension `ext`"""
+        ext = ext.lower()
+        return (ext == '.png' and self.png) or (ext == '.svg' and self.svg)
+
+    def optimize_bytes(self, data, ext):
+        """Return optimized image `data`, for file extension `ext`
+
+        Return `data` unchanged if we do not handle `ext`, or cannot make
+        the image smaller.
+        """
+        if not self.handles(ext):
+            return data
+        if ext.lower() == '.png':
+            optimized = self._optimize_png(data)
+        else:
+            optimized = self._optimize_svg(data)
+        if len(optimized) >= len(data):
+            optimized = data
+        with self._lock:
+            self.stats['files'] += 1
+            self.stats['before'] += len(data)
+            self.stats['after'] += len(optimized)
+        return optimized
+
+    def optimize_file(self, fname):
+        """Optimize image file `fname` in place"""
+        if not self.handles(os.path.splitext(fname)[1]):
+            return
+        with io.open(fname, 'rb') as f:
+            data = f.read()
+        optimized = self.optimize_bytes(data, os.path.splitext(fname)[1])
+        if optimized is data:
+            return
+        tmp_path = '{0}.{1}.tmp'.format(fname, os.getpid())
+        with io.open(tmp_path, 'wb') as f:
+            f.write(optimized)
+        os.rename(tmp_path, fname)
+
+    def map(self, func, args):
+        """Return list of `func` applied to `args`, run on thread pool
+
+        PIL and zlib release the GIL while they work, so images optimize in
+        parallel.  Forked processes make their own pool.
+        """
+        if len(args) < 2:
+            return [func(arg) for arg in args]
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = thread_pool(self.threads)
+            self._pool_pid = os.getpid()
+        return self._pool.map(func, args)
+
+    def optimize_files(self, fnames):
+        """Optimize image files `fnames` in place, in parallel"""
+        self.map(self.optimize_file, list(fnames))
+
+    def take_stats(self):
+        """Return stats so far, and start counting again from zero"""
+        with self._lock:
+            stats = self.stats
+            self.stats = dict(files=0, before=0, after=0)
+        return stats
+
+    def add_stats(self, stats):
+        """Add `stats` from another optimizer, e.g. in a worker process"""
+        with self._lock:
+            for name in self.stats:
+                self.stats[name] += stats[name]
+
+    def report(self):
+        """Return summary of bytes saved, or None if no images"""
+        stats = self.stats
+        if not stats['files']:
+            return None
+        saved = stats['before'] - stats['after']
+        return 'optimized {0} images, saved {1} bytes ({2:.1f}%)'.format(
+            stats['files'], saved, 100. * saved / max(stats['before'], 1))
+
+    def __getstate__(self):
+        # Pickle options only, for worker processes
+        state = self.__dict__.copy()
+        for name in ('_lock', '_pool', '_pool_pid'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.stats = dict(files=0, before=0, after=0)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+
+
+def optimizer_from_config(value):
+    """Return ``ImageOptimizer`` for configuration `value`, or None
+
+    `value` is False or None for no optimization, True for the default
+    options, or a dict of keyword arguments for ``ImageOptimizer``.
+    """
+    if not value:
+        return None
+    if value is True:
+        return ImageOptimizer()
+    return ImageOptimizer(**value)
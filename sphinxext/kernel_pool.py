@@ -0,0 +1,332 @@
+""" Pool of warm IPython kernels for evaluating notebooks
+
+Starting a kernel, and importing numpy, scipy, matplotlib and friends into it,
+is a large fixed cost for each notebook we evaluate.  A ``KernelPool`` starts
+its kernels once, imports a list of modules into each, and hands the kernels
+out to notebooks in turn.  Between notebooks, the kernel namespace is reset,
+and any modules imported from notebook directories are dropped, so the next
+notebook starts clean, but with the heavy modules already in ``sys.modules``.
+
+Use like this::
+
+    pool = KernelPool(n_kernels=2)
+    try:
+        with pool.kernel(working_dir='some/dir') as runner:
+            run_notebook(runner, nb)
+    finally:
+        pool.shutdown()
+"""
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from lazy_import import LazyModule, is_available
+
+# IPython before and after the big split.  These are slow to import, so we
+# import them when we first start a kernel or run a cell.
+nbf = LazyModule(('nbformat.v3', 'IPython.nbformat.v3'))
+
+
+def _handle_svg(module):
+    # Tell notebook runner how to handle SVG
+    module.NotebookRunner.MIME_MAP['image/svg+xml'] = 'svg'
+
+
+notebook_runner = LazyModule('runipy.notebook_runner', on_import=_handle_svg)
+
+# Modules to import into each kernel when it starts
+DEFAULT_PREIMPORTS = ('numpy', 'scipy', 'matplotlib', 'matplotlib.pyplot',
+                      'sympy')
+
+# Run in the kernel once after start, and after importing `preimports`.
+# Record which modules belong to the warm kernel.
+WARM_TEMPLATE = """\
+import sys as _sys
+_name = None
+for _name in {preimports!r}:
+    try:
+        __import__(_name)
+    except ImportError:
+        pass
+_sys._kernel_pool_modules = set(_sys.modules)
+_sys._kernel_pool_path = list(_sys.path)
+del _sys, _name
+"""
+
+# Run in the kernel before each notebook.  Clear the user namespace, forget
+# modules imported by the previous notebook from outside the Python
+# installation, restore matplotlib defaults, move to the working directory
+# and put it, and any extra paths, at the front of ``sys.path``.
+RESET_TEMPLATE = """\
+%reset -f
+import os as _os, sys as _sys
+_name = _file = None
+for _name in list(_sys.modules):
+    if _name in _sys._kernel_pool_modules:
+        continue
+    _file = getattr(_sys.modules[_name], '__file__', None) or ''
+    if not _file.startswith((_sys.prefix, _sys.exec_prefix)):
+        del _sys.modules[_name]
+if 'matplotlib.pyplot' in _sys.modules:
+    _sys.modules['matplotlib.pyplot'].close('all')
+    _sys.modules['matplotlib'].rcdefaults()
+_sys.path[:] = {sys_path!r} + _sys._kernel_pool_path
+_os.chdir({working_dir!r})
+del _os, _sys, _name, _file
+"""
+
+
+class NotebookError(Exception):
+    """Error from a cell run without runipy, such as by ``exec_engine``"""
+
+
+def notebook_errors():
+    """Return exception classes that runners raise for failed cells
+
+    These are our ``NotebookError`` and, if runipy is installed, runipy's.
+    """
+    if is_available(notebook_runner):
+        return (NotebookError, notebook_runner.NotebookError)
+    return (NotebookError,)
+
+
+def run_code(runner, code):
+    """Run `code` in kernel of `runner`, discarding outputs"""
+    cell = nbf.new_code_cell(input=code)
+    try:
+        runner.run_cell(cell)
+    except notebook_errors() as err:
+        raise RuntimeError('Kernel setup code failed: {0}'.format(err))
+
+
+def code_cells(nb):
+    for ws in nb.worksheets:
+        for cell in ws.cells:
+            if cell.cell_type == 'code':
+                yield cell
+
+
+def renumber_prompts(nb):
+    """Number prompts in `nb` from 1, as for a freshly started kernel
+
+    A pooled kernel has already executed setup code, and maybe other
+    notebooks, so its execution counts do not start at 1.
+    """
+    count = 0
+    for cell in code_cells(nb):
+        if 'prompt_number' not in cell:
+            continue
+        count += 1
+        cell.prompt_number = count
+        for output in cell.outputs:
+            if 'prompt_number' in output:
+                output.prompt_number = count
+
+
+def kernel_pid(runner):
+    """Return process id of kernel for `runner`, or None if not known
+
+    Runners without a kernel manager, such as those from
+    ``exec_engine.ExecEngine``, give their process id as ``pid``.
+    """
+    km = getattr(runner, 'km', None)
+    if km is None:
+        return getattr(runner, 'pid', None)
+    for owner in (getattr(km, 'kernel', None),
+                  getattr(km, 'provisioner', None)):
+        pid = getattr(owner, 'pid', None)
+        if pid is not None:
+            return pid
+    return None
+
+
+def can_stop(runner):
+    """Return True if we can interrupt and kill the kernel of `runner`
+
+    Runners that run cells in this process, such as
+    ``exec_engine.InProcessRunner``, have no kernel we can stop.
+    """
+    return getattr(runner, 'km', None) is not None or hasattr(runner, 'kill')
+
+
+def interrupt_kernel(runner):
+    """Interrupt code running in kernel of `runner`"""
+    km = getattr(runner, 'km', None)
+    if km is None:
+        runner.interrupt()
+    else:
+        km.interrupt_kernel()
+
+
+def kill_kernel(runner):
+    """Kill kernel of `runner`"""
+    km = getattr(runner, 'km', None)
+    if km is None:
+        runner.kill()
+    else:
+        km.kill_kernel()
+
+
+def run_cell(runner, cell, monitors=()):
+    """Run `cell` in `runner`, inside the ``cell`` context of each monitor
+
+    A monitor is an object with a method ``cell(runner, cell)`` returning a
+    context manager, such as ``cell_profile.CellProfiler``.
+    """
+    if not monitors:
+        runner.run_cell(cell)
+        return
+    with monitors[0].cell(runner, cell):
+        run_cell(runner, cell, monitors[1:])
+
+
+def run_notebook(runner, nb, monitors=()):
+    """Run all code cells of v3 notebook `nb` in `runner`, in place
+
+    Parameters
+    ----------
+    runner : ``NotebookRunner`` instance
+        Runner with started kernel, e.g. from ``KernelPool.kernel``.
+    nb : notebook node
+        Notebook (format 3) to evaluate.  Outputs are filled in place.
+    monitors : sequence, optional
+        Cell monitors; see ``run_cell``.
+
+    Returns
+    -------
+    nb : notebook node
+        The evaluated input notebook.
+    """
+    runner.nb = nb
+    for cell in code_cells(nb):
+        run_cell(runner, cell, monitors)
+    renumber_prompts(nb)
+    return nb
+
+
+class KernelPool(object):
+    """ Pool of started kernels with modules already imported
+
+    Parameters
+    ----------
+    n_kernels : int, optional
+        Number of kernels to start.
+    preimports : sequence, optional
+        Names of modules to import into each kernel after it starts.  Missing
+        modules are skipped.
+    max_uses : None or int, optional
+        If not None, replace a kernel with a fresh one after it has evaluated
+        this many notebooks.  Use this to limit memory growth.
+    """
+
+    def __init__(self, n_kernels=1, preimports=DEFAULT_PREIMPORTS,
+                 max_uses=None):
+        self.n_kernels = n_kernels
+        self.preimports = tuple(preimports)
+        self.max_uses = max_uses
+        self._idle = Queue()
+        self._runners = []
+        self._uses = {}
+        threads = [threading.Thread(target=self._add_runner)
+                   for i in range(n_kernels)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if len(self._runners) != n_kernels:
+            self.shutdown()
+            raise RuntimeError('Could not start {0} kernels'.format(n_kernels))
+
+    def _start_runner(self):
+        runner = notebook_runner.NotebookRunner(nb=nbf.new_notebook())
+        run_code(runner, WARM_TEMPLATE.format(preimports=self.preimports))
+        return runner
+
+    def _add_runner(self):
+        runner = self._start_runner()
+        self._runners.append(runner)
+        self._uses[id(runner)] = 0
+        self._idle.put(runner)
+
+    def acquire(self, working_dir=None, path=()):
+        """Return idle runner, with kernel reset, in directory `working_dir`
+
+        Blocks until a kernel is free, or raises RuntimeError if replacement
+        kernels failed to start and none are left.  `working_dir` defaults to
+        the current directory.  Directories in `path` go onto the kernel ``sys.path``
+        after `working_dir`, so notebooks can import modules from them.
+        """
+        if working_dir is None:
+            working_dir = os.getcwd()
+        working_dir = os.path.abspath(working_dir)
+        sys_path = [working_dir] + [os.path.abspath(p) for p in path]
+        while True:
+            runner = self._idle.get()
+            if runner is not None:
+                break
+            # A replacement kernel failed to start
+            if not self._runners:
+                self._idle.put(None)  # Wake the next waiting caller too
+                raise RuntimeError('No kernels left in pool; replacement '
+                                   'kernels failed to start')
+        try:
+            run_code(runner, RESET_TEMPLATE.format(working_dir=working_dir,
+                                                   sys_path=sys_path))
+        except Exception:
+            self._replace(runner)
+            raise
+        return runner
+
+    def release(self, runner):
+        """Return `runner` to pool, replacing kernel if it is used up"""
+        self._uses[id(runner)] += 1
+        if self.max_uses is not None and self._uses[id(runner)] >= self.max_uses:
+            self._replace(runner)
+        else:
+            self._idle.put(runner)
+
+    def _replace(self, runner):
+        self._runners.remove(runner)
+        del self._uses[id(runner)]
+        try:
+            runner.shutdown_kernel()
+        finally:
+            try:
+                self._add_runner()
+            except BaseException:
+                # Tell waiting callers, who may now wait for ever
+                self._idle.put(None)
+                raise
+
+    @contextmanager
+    def kernel(self, working_dir=None, path=()):
+        """Context manager giving a reset runner from the pool
+
+        See ``acquire`` for parameters.  If the block raises an error, the
+        kernel may be in an unknown state, so we replace it with a fresh
+        kernel.
+        """
+        runner = self.acquire(working_dir, path)
+        try:
+            yield runner
+        except BaseException:
+            self._replace(runner)
+            raise
+        self.release(runner)
+
+    def shutdown(self):
+        """Shut down all kernels in the pool"""
+        while self._runners:
+            runner = self._runners.pop()
+            try:
+                runner.shutdown_kernel()
+            except Exception as err:
+                sys.stderr.write('Error shutting down kernel: {0}\n'.format(
+                    err))
+        self._uses.clear()
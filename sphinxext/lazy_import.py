@@ -0,0 +1,105 @@
+""" Import slow modules when code first uses them
+
+Importing matplotlib, nbformat, nbconvert and runipy takes seconds, and
+Sphinx imports every extension at startup, whether or not any page uses the
+plot or notebook directives.  A ``LazyModule`` stands in for a module, and
+imports it on first attribute access.  We record how long each of these
+imports took, in ``import_times``; see ``tools/check_import_time.py`` for the
+budget on importing the extensions themselves.
+"""
+import threading
+import importlib
+from timeit import default_timer as clock
+
+try:
+    string_types = basestring
+except NameError:  # Python 3
+    string_types = str
+
+# Seconds taken by each lazy import in this process, by module name
+import_times = {}
+
+
+class LazyModule(object):
+    """ Stand-in for a module, imported on first attribute access
+
+    Parameters
+    ----------
+    names : str or sequence
+        Module name, or sequence of names to try in order, for modules that
+        have moved (e.g. ``('nbformat', 'IPython.nbformat')``).
+    requires : sequence, optional
+        ``LazyModule`` instances to import first.
+    on_import : None or callable, optional
+        If not None, call with the module just after we import it, e.g. to
+        select the matplotlib backend.
+    """
+
+    def __init__(self, names, requires=(), on_import=None):
+        if isinstance(names, string_types):
+            names = (names,)
+        # Set attributes directly, because ``__setattr__`` sets them on the
+        # module
+        self.__dict__.update(_names=tuple(names), _requires=tuple(requires),
+                             _on_import=on_import, _module=None,
+                             _lock=threading.RLock())
+
+    def __getattr__(self, name):
+        return getattr(load_module(self), name)
+
+    def __setattr__(self, name, value):
+        setattr(load_module(self), name, value)
+
+    def __repr__(self):
+        state = 'imported' if self._module is not None else 'not imported'
+        return '<LazyModule {0} ({1})>'.format(self._names[0], state)
+
+
+def load_module(module):
+    """ Return module for ``LazyModule`` `module`, importing if necessary
+
+    Return other `module` values unchanged.
+    """
+    if not isinstance(module, LazyModule):
+        return module
+    state = module.__dict__
+    if state['_module'] is not None:
+        return state['_module']
+    with state['_lock']:
+        if state['_module'] is None:
+            for required in state['_requires']:
+                load_module(required)
+            state['_module'] = _import_first(state['_names'],
+                                             state['_on_import'])
+    return state['_module']
+
+
+def is_available(module):
+    """ Return True if ``LazyModule`` `module` imports, importing it if needed
+    """
+    try:
+        load_module(module)
+    except ImportError:
+        return False
+    return True
+
+
+def _import_first(names, on_import):
+    """ Import first of module `names` that exists, run `on_import` hook
+    """
+    for name in names[:-1]:
+        try:
+            return _import(name, on_import)
+        except ImportError:
+            pass
+    return _import(names[-1], on_import)
+
+
+def _import(name, on_import):
+    start = clock()
+    module = importlib.import_module(name)
+    if on_import is not None:
+        on_import(module)
+    import_times[name] = clock() - start
+    return module
+
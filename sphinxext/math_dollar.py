@@ -8,55 +8,154 @@
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 import re
 
-def dollars_to_math(source):
-    r"""
-    Replace dollar signs with backticks.
+# Directives whose content is code or math, not text
+CODE_DIRECTIVES = ('code', 'code-block', 'sourcecode', 'literalinclude',
+                   'ipython', 'plot', 'math', 'doctest', 'testcode',
+                   'testoutput')
+
+directive_re = re.compile(r'\s*\.\.\s+([\w:-]+)::')
+# Outside math, we stop at dollars and backslash escapes
+text_token_re = re.compile(r'\\.|\$', re.S)
+# Inside math, we also track braces
+math_token_re = re.compile(r'\\.|[{}$]', re.S)
+
+
+def _math_end(text, pos):
+    """ Return index of dollar closing math starting at `pos`, or -1
+
+    Dollars inside curly braces belong to nested math, such as ``\\text{ if
+    $n$ is prime}``, and do not close the math.
+    """
+    depth = 0
+    for match in math_token_re.finditer(text, pos):
+        token = match.group()
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth = max(depth - 1, 0)
+        elif token == '$' and depth == 0:
+            return match.start()
+    return -1
 
-    More precisely, do a regular expression search.  Replace a plain
-    dollar sign ($) by a backtick (`).  Replace an escaped dollar sign
-    (\$) by a dollar sign ($).  Don't change a dollar sign preceded or
-    followed by a backtick (`$ or $`), because of strings like
-    "``$HOME``".  Don't make any changes on lines starting with
-    spaces, because those are indented and hence part of a block of
-    code or examples.
 
-    This also doesn't replaces dollar signs enclosed in curly braces,
-    to avoid nested math environments, such as ::
+def _paragraph_to_math(text):
+    """ Return paragraph `text` with ``$...$`` as ``:math:`...```
+    """
+    out = []
+    start = 0  # start of text not yet copied to `out`
+    pos = 0
+    n = len(text)
+    while True:
+        match = text_token_re.search(text, pos)
+        if match is None:
+            break
+        i = match.start()
+        pos = match.end()
+        if match.group() == '\\$':
+            out.append(text[start:i])
+            out.append('$')
+            start = pos
+            continue
+        if match.group() != '$':
+            continue
+        before = text[i - 1] if i > 0 else ''
+        after = text[pos] if pos < n else ''
+        if after == '$':  # Leave $$ alone
+            pos += 1
+            continue
+        if before == '`' or after in ('`', ''):
+            continue
+        end = _math_end(text, pos)
+        if end == -1:
+            continue
+        out.append(text[start:i])
+        out.append(':math:`%s`' % text[pos:end])
+        start = pos = end + 1
+    out.append(text[start:])
+    return ''.join(out)
+
+
+def _literal_indent(line):
+    """ Return indent if `line` starts a literal or code block, else None
+    """
+    match = directive_re.match(line)
+    if match is not None:
+        if match.group(1) not in CODE_DIRECTIVES:
+            return None
+    elif not line.rstrip().endswith('::'):
+        return None
+    return len(line) - len(line.lstrip())
+
+
+def _flush(para):
+    """ Return converted paragraph from lines in `para`, and empty `para`
+    """
+    text = ''.join(para)
+    del para[:]
+    if '$' not in text or text.lstrip().startswith('>>>'):
+        return text
+    return _paragraph_to_math(text)
+
+
+def convert_dollars(text):
+    r""" Return `text` with dollar math replaced by ``:math:`` roles
+
+    Replace ``$...$`` by ``:math:`...```, and an escaped dollar sign (\$) by
+    a dollar sign ($).  Don't change a dollar sign preceded or followed by a
+    backtick (`$ or $`), because of strings like "``$HOME``", nor a double
+    dollar sign ($$).  Don't make any changes in literal blocks (after
+    ``::``), doctest blocks, or code and math directives, because those are
+    code or examples.  Math stays within one paragraph.
+
+    A dollar sign inside curly braces in math does not end the math, to
+    allow nested math environments, such as ::
 
       $f(n) = 0 \text{ if $n$ is prime}$
 
     Thus the above line would get changed to
 
-      `f(n) = 0 \text{ if $n$ is prime}`
+      :math:`f(n) = 0 \text{ if $n$ is prime}`
+
+    We make one pass over the text, and keep no state between calls, so
+    documents can be read in parallel.
     """
-    s = "\n".join(source)
-    if s.find("$") == -1:
+    out = []
+    para = []
+    literal_indent = None
+    for line in text.splitlines(True):
+        stripped = line.strip()
+        if literal_indent is not None:
+            if not stripped or len(line) - len(line.lstrip()) > literal_indent:
+                out.append(line)
+                continue
+            literal_indent = None
+        if not stripped:
+            out.append(_flush(para))
+            out.append(line)
+            continue
+        para.append(line)
+        literal_indent = _literal_indent(line)
+        if literal_indent is not None:
+            out.append(_flush(para))
+    out.append(_flush(para))
+    return ''.join(out)
+
+
+def dollars_to_math(source):
+    r"""
+    Replace dollar math in list of strings `source`, in place.
+
+    See ``convert_dollars`` for the rules.  Leave `source` alone if it has no
+    dollar signs.  `source` is a list of lines, as for
+    ``autodoc-process-docstring``, or a list with the whole document, as for
+    ``source-read``.
+    """
+    if not any('$' in part for part in source):
         return
-    # This searches for "$blah$" inside a pair of curly braces --
-    # don't change these, since they're probably coming from a nested
-    # math environment.  So for each match, we replace it with a temporary
-    # string, and later on we substitute the original back.
-    global _data
-    _data = {}
-    def repl(matchobj):
-        global _data
-        s = matchobj.group(0)
-        t = "___XXX_REPL_%d___" % len(_data)
-        _data[t] = s
-        return t
-    s = re.sub(r"({[^{}$]*\$[^{}$]*\$[^{}]*})", repl, s)
-    # matches $...$
-    dollars = re.compile(r"(?<!\$)(?<!\\)\$([^\$]+?)\$")
-    # regular expression for \$
-    slashdollar = re.compile(r"\\\$")
-    s = dollars.sub(r":math:`\1`", s)
-    s = slashdollar.sub(r"$", s)
-    # change the original {...} things in:
-    for r in _data:
-        s = s.replace(r, _data[r])
-    # now save results in "source"
-    source[:] = [s]
-    
+    text = convert_dollars('\n'.join(source))
+    # Keep the whole document as one string for ``source-read``
+    source[:] = text.split('\n') if len(source) > 1 else [text]
+
 
 def process_dollars(app, docname, source):
     dollars_to_math(source)
@@ -65,7 +164,8 @@ def process_dollars(app, docname, source):
 def mathdollar_docstrings(app, what, name, obj, options, lines):
     dollars_to_math(lines)
 
-    
+
 def setup(app):
     app.connect("source-read", process_dollars)
     app.connect('autodoc-process-docstring', mathdollar_docstrings)
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
@@ -0,0 +1,106 @@
+""" Files and versions that an evaluated notebook depends on
+
+The notebook directive, and ``tools/write_all_ipynb.py``, only evaluate a
+notebook again when the notebook changes, or something it depends on: the
+local modules it imports, other files it uses, and the versions of Python,
+numpy and matplotlib.  This module has no Sphinx dependencies, so the tools
+can use it too.
+"""
+import os
+from os.path import basename
+import sys
+import io
+import re
+import hashlib
+
+# regexp for finding import statements in notebook code cells
+import_re = re.compile(r'^\s*(?:from\s+([\w.]+)\s+import\b|import\s+([^#;\n]+))',
+                       re.M)
+
+
+def cellgen(nb, type=None):
+    for ws in nb['worksheets']:
+        for cell in ws['cells']:
+            if type is None:
+                yield cell
+            elif cell.cell_type == type:
+                yield cell
+
+
+def local_imports(nb, nb_dir):
+    """Return sorted paths of modules in `nb_dir` imported by `nb`
+
+    Modules are found by scanning the code cells for import statements, and
+    then scanning any local modules found, in turn, for their own imports.
+    Imports that do not resolve to a ``.py`` file or package in `nb_dir` (such
+    as ``numpy``) are ignored.
+    """
+    sources = [cell.input for cell in cellgen(nb, 'code')]
+    found = set()
+    while sources:
+        for match in import_re.finditer(sources.pop()):
+            if match.group(1) is not None:
+                names = [match.group(1)]
+            else:
+                names = [name.split()[0] for name in match.group(2).split(',')
+                         if name.strip()]
+            for name in names:
+                top = name.split('.')[0]
+                for path in (os.path.join(nb_dir, top + '.py'),
+                             os.path.join(nb_dir, top, '__init__.py')):
+                    if not os.path.isfile(path) or path in found:
+                        continue
+                    found.add(path)
+                    with io.open(path, 'rt', encoding='utf-8') as f:
+                        sources.append(f.read())
+    return sorted(found)
+
+
+def package_version(name):
+    """Return installed version of package `name`, or '' if missing
+
+    We read the version from the package metadata, because importing numpy
+    or matplotlib here would take seconds.
+    """
+    try:
+        from importlib import metadata
+    except ImportError:  # Python < 3.8
+        import pkg_resources
+        try:
+            return pkg_resources.get_distribution(name).version
+        except pkg_resources.DistributionNotFound:
+            return ''
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return ''
+
+
+def runtime_signature():
+    """Return string with versions of Python and libraries notebooks use"""
+    versions = ['python ' + sys.version]
+    for name in ('numpy', 'matplotlib'):
+        versions.append(name + ' ' + package_version(name))
+    return '\n'.join(versions)
+
+
+def dependency_signature(dependencies):
+    """Return string identifying runtime and contents of `dependencies`
+
+    Parameters
+    ----------
+    dependencies : sequence
+        Paths of files (``:otherfiles:``, local modules) whose contents can
+        affect the evaluated notebook.
+
+    Returns
+    -------
+    signature : str
+        String that changes if the runtime or any of the files change.
+    """
+    parts = [runtime_signature()]
+    for path in dependencies:
+        with open(path, 'rb') as f:
+            parts.append('{0} {1}'.format(basename(path),
+                                          hashlib.sha256(f.read()).hexdigest()))
+    return '\n'.join(parts)
@@ -0,0 +1,118 @@
+""" Write notebook image outputs to files named by their contents
+
+By default, nbconvert embeds image outputs in the html as base64 data, which
+makes the page about a third bigger than the images, and means browsers
+cannot cache the images.  ``externalize_images`` writes each image output to
+a file named by a hash of its contents, and replaces the output with html for
+a lazy-loading ``<img>`` tag.  Identical images share a file.  With an
+``image_optimize.ImageOptimizer``, new image files are optimized as we write
+them, in parallel.
+"""
+import os
+import io
+import base64
+import hashlib
+import threading
+
+try:
+    from html import escape
+except ImportError:  # Python 2
+    from cgi import escape
+
+from fsutil import makedirs
+
+# Image mime types to write out, and their file extensions
+IMAGE_EXTENSIONS = (('image/png', '.png'),
+                    ('image/jpeg', '.jpg'),
+                    ('image/svg+xml', '.svg'))
+
+IMG_TEMPLATE = '<img src="{src}" alt="{alt}" loading="lazy"{size} />'
+
+
+def image_bytes(mime, data):
+    """Return bytes for image `data` of type `mime` from notebook output"""
+    if isinstance(data, list):
+        data = ''.join(data)
+    if mime == 'image/svg+xml':
+        return data.encode('utf-8')
+    return base64.b64decode(data)
+
+
+def write_image(contents, ext, image_dir, optimizer=None):
+    """Write `contents` to `image_dir` with name from hash, return name
+
+    If `optimizer` is not None, optimize new files with it.  The name then
+    also depends on the optimizer options.
+    """
+    hasher = hashlib.sha256(contents)
+    if optimizer is not None:
+        hasher.update(optimizer.signature().encode('utf-8'))
+    fname = hasher.hexdigest()[:20] + ext
+    path = os.path.join(image_dir, fname)
+    if not os.path.isfile(path):
+        if optimizer is not None:
+            contents = optimizer.optimize_bytes(contents, ext)
+        makedirs(image_dir)
+        # Threads may write the same image at the same time
+        tmp_path = '{0}.{1}.{2}.tmp'.format(
+            path, os.getpid(), threading.current_thread().ident)
+        with io.open(tmp_path, 'wb') as f:
+            f.write(contents)
+        os.rename(tmp_path, path)
+    return fname
+
+
+def externalize_images(nb, image_dir, url_prefix='', optimizer=None):
+    """Replace image outputs in `nb` with links to image files, in place
+
+    Parameters
+    ----------
+    nb : notebook node
+        Notebook, in format 4.
+    image_dir : str
+        Directory to which to write image files.
+    url_prefix : str, optional
+        Prefix for image URLs in the html, e.g. ``'images/'``.
+    optimizer : None or ``ImageOptimizer`` instance, optional
+        If not None, optimize new image files, on the optimizer thread pool.
+
+    Returns
+    -------
+    fnames : list
+        File names (without directory) of images referenced by `nb`.
+    """
+    images = []
+    for cell in nb.cells:
+        if cell.cell_type != 'code':
+            continue
+        for output in cell.outputs:
+            data = output.get('data', {})
+            for mime, ext in IMAGE_EXTENSIONS:
+                if mime in data:
+                    images.append((output, mime, ext))
+                    break
+
+    def write(image):
+        output, mime, ext = image
+        return write_image(image_bytes(mime, output['data'][mime]), ext,
+                           image_dir, optimizer)
+
+    if optimizer is None:
+        fnames = [write(image) for image in images]
+    else:
+        fnames = optimizer.map(write, images)
+    for (output, mime, ext), fname in zip(images, fnames):
+        data = output['data']
+        metadata = output.get('metadata', {}).get(mime, {})
+        size = ''.join(' {0}="{1}"'.format(dim, metadata[dim])
+                       for dim in ('width', 'height')
+                       if dim in metadata)
+        alt = data.get('text/plain', '')
+        if isinstance(alt, list):
+            alt = ''.join(alt)
+        output.data = {
+            'text/html': IMG_TEMPLATE.format(
+                src=url_prefix + fname,
+                alt=escape(alt, True),
+                size=size)}
+    return fnames
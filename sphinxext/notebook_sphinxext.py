@@ -34,49 +34,73 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 import os
 from os.path import basename
-import glob
+import posixpath
+import sys
 import io
+import copy
 import shutil
 import re
+import hashlib
+import tempfile
+import multiprocessing
+from multiprocessing.util import Finalize
 
-from sphinx.util.compat import Directive
+try:
+    from sphinx.util.compat import Directive
+except ImportError:  # Sphinx >= 1.7
+    from docutils.parsers.rst import Directive
 from docutils import nodes
 from docutils.parsers.rst import directives
 
 
-# IPython before and after the big split
-try:
-    import nbformat
-    from nbformat import v3 as nbf
-except ImportError:
-    from IPython import nbformat
-    from IPython.nbformat import v3 as nbf
-try:
-    from nbconvert import html, python
-except ImportError:
-    from IPython.nbconvert import html, python
+from lazy_import import LazyModule
+from fsutil import makedirs, link_or_copy
+from kernel_pool import (KernelPool, run_notebook, renumber_prompts,
+                         DEFAULT_PREIMPORTS)
+from cell_cache import CellCache, DEFAULT_CHECKPOINT_INTERVAL
+from notebook_images import externalize_images
+from notebook_deps import (cellgen, local_imports, dependency_signature,
+                           package_version)
+from image_optimize import optimizer_from_config
+from cell_profile import CellProfiler, write_report, summary
+from cell_budget import CellBudget, BudgetExceeded
+from exec_engine import ExecEngine
 
-from runipy.notebook_runner import NotebookRunner
+# IPython before and after the big split.  These are slow to import, so we
+# import them when the first notebook needs them; see also ``get_exporter``.
+nbformat = LazyModule(('nbformat', 'IPython.nbformat'))
+nbf = LazyModule(('nbformat.v3', 'IPython.nbformat.v3'))
 
 # Version of notebook format we are using
 NBFORMAT = 3
 
-# Tell notebook runner how to handle SVG
-NotebookRunner.MIME_MAP['image/svg+xml'] = 'svg'
-
 # regexp for removing mathjax configuration from generated html
 # We put our own mathjax configuration in the header with templates
 mathjax_config = re.compile(r'<!-- Loading mathjax macro -->.*?'
                             '<!-- End of mathjax configuration -->', re.S)
 
-def cellgen(nb, type=None):
-    for ws in nb['worksheets']:
-        for cell in ws['cells']:
-            if type is None:
-                yield cell
-            elif cell.cell_type == type:
-                yield cell
+# regexp for style blocks in generated html
+style_re = re.compile(r'<style[^>]*>(.*?)</style>', re.S)
+
+# Class of the div around each notebook in the page; see ``nb_to_html``
+NOTEBOOK_CLASS = 'ipynotebook'
 
+# regexps for css comments, and for selectors of the whole page
+css_comment_re = re.compile(r'/\*.*?\*/', re.S)
+page_selector_re = re.compile(r'^(?:html|body|:root)(?![\w-])')
+
+# Placeholder for the URL of the image directory in generated html
+IMAGE_URL_TOKEN = '__notebook_images__/'
+
+# regexp for image file names after the image URL placeholder
+image_ref_re = re.compile(re.escape(IMAGE_URL_TOKEN) + r'([0-9a-f]+\.\w+)')
+
+# Bump this when the cached html or evaluated notebook format changes
+CACHE_VERSION = 3
+
+# regexps for finding notebook directives, and their otherfiles, in sources
+directive_re = re.compile(r'^(\s*)\.\.\s+notebook::\s*(\S+)\s*$')
+otherfiles_re = re.compile(r'^\s+:otherfiles:\s*(.*)$')
 
 def clear_output(nb):
     for cell in cellgen(nb, 'code'):
@@ -85,11 +109,279 @@ def clear_output(nb):
         cell.outputs = []
 
 
+def notebook_cache_key(nb_text, dependencies, options='', template_text=None):
+    """Return hash of cleared notebook, `dependencies`, runtime and exporter
+
+    Parameters
+    ----------
+    nb_text : str
+        Notebook with outputs cleared, as JSON text.
+    dependencies : sequence
+        See ``dependency_signature``.
+    options : str, optional
+        Any configuration that changes the cached output; see
+        ``cache_options``.
+    template_text : None or str, optional
+        Text of the html template.  None means use ``template_source``.
+
+    Returns
+    -------
+    key : str
+        Hex digest that changes if any of the inputs change.
+    """
+    hasher = hashlib.sha256()
+    hasher.update('cache version {0}\n'.format(CACHE_VERSION).encode('ascii'))
+    hasher.update(dependency_signature(dependencies).encode('utf-8'))
+    hasher.update(options.encode('utf-8'))
+    # The html changes with nbconvert and its template
+    if template_text is None:
+        template_text = template_source()
+    hasher.update('nbconvert {0}\n'.format(
+        package_version('nbconvert') or package_version('ipython')).encode(
+            'utf-8'))
+    hasher.update(hashlib.sha256(template_text.encode('utf-8')).digest())
+    hasher.update(nb_text.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def cache_paths(cache_dir, key):
+    """Return paths of cached evaluated notebook and html for `key`"""
+    root = os.path.join(cache_dir, key[:2], key)
+    return root + '_evaluated.ipynb', root + '.html'
+
+
+def cache_lookup(cache_dir, key):
+    """Return (evaluated notebook path, html) for `key` or None if missing"""
+    nb_path, html_path = cache_paths(cache_dir, key)
+    if not (os.path.isfile(nb_path) and os.path.isfile(html_path)):
+        return None
+    with io.open(html_path, 'rt', encoding='utf-8') as f:
+        return nb_path, f.read()
+
+
+def _write_atomic(path, text):
+    """Write unicode `text` to `path` via a rename, so readers never see
+    partial files"""
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with io.open(tmp_path, 'wt', encoding='utf-8') as f:
+        f.write(text)
+    os.rename(tmp_path, path)
+
+
+def evaluate_to_cache(nb, cache_dir, key, nb_dir, otherfiles=(),
+                      kernel_pool=None, cell_cache=None, seed='',
+                      image_dir=None, monitors=(), optimizer=None):
+    """Evaluate `nb`, store results in cache under `key`
+
+    Returns (evaluated notebook path, html) as for ``cache_lookup``.  See
+    ``run_isolated`` and ``nb_to_html`` for the other parameters.
+    """
+    nb_path, html_path = cache_paths(cache_dir, key)
+    makedirs(os.path.dirname(nb_path))
+    html = evaluate_notebook(nb, None, kernel_pool, nb_dir, otherfiles,
+                             cell_cache, seed, image_dir, monitors,
+                             optimizer)
+    # Lookups need both files; the notebook goes in last
+    _write_atomic(html_path, html)
+    _write_atomic(nb_path, nbformat.writes(nb, NBFORMAT))
+    return nb_path, html
+
+
+def get_cache_dir(app):
+    """Return directory for evaluated notebook cache or None if disabled"""
+    if not app.config.notebook_cache:
+        return None
+    if app.config.notebook_cache_dir:
+        return os.path.join(app.confdir, app.config.notebook_cache_dir)
+    return os.path.join(os.path.dirname(app.doctreedir), 'notebook_cache')
+
+
+def cache_options(config):
+    """Return string of `config` options that change cached html"""
+    options = []
+    if config.notebook_engine == 'exec':
+        options.append('exec engine')
+    if config.notebook_external_images:
+        options.append('external images')
+        optimizer = optimizer_from_config(config.notebook_optimize_images)
+        if optimizer is not None:
+            options.append('optimized images ({0})'.format(
+                optimizer.signature()))
+    if config.notebook_profile and config.notebook_profile_metadata:
+        options.append('profile metadata')
+    return ', '.join(options)
+
+
+def get_image_dir(app):
+    """Return directory for notebook image files, or None to embed images
+
+    With the cache, images go in the cache, and we link them into the build
+    directory for each page.  Otherwise they go straight into the build.
+    """
+    if not app.config.notebook_external_images:
+        return None
+    cache_dir = get_cache_dir(app)
+    if cache_dir is None:
+        return os.path.join(app.builder.outdir, '_images')
+    return os.path.join(cache_dir, 'images')
+
+
+def publish_images(html, image_dir, out_image_dir, url_prefix):
+    """Link images referenced in `html` into build, return html with URLs
+
+    Parameters
+    ----------
+    html : str
+        Html from ``nb_to_html`` with image URLs starting with
+        ``IMAGE_URL_TOKEN``.
+    image_dir : str
+        Directory containing the image files.
+    out_image_dir : str
+        Directory in the build to which to link or copy image files.
+    url_prefix : str
+        Prefix to replace ``IMAGE_URL_TOKEN`` in `html`.
+    """
+    if os.path.abspath(image_dir) != os.path.abspath(out_image_dir):
+        makedirs(out_image_dir)
+        for fname in set(image_ref_re.findall(html)):
+            out_path = os.path.join(out_image_dir, fname)
+            if not os.path.isfile(out_path):
+                link_or_copy(os.path.join(image_dir, fname), out_path)
+    return html.replace(IMAGE_URL_TOKEN, url_prefix)
+
+
+def get_image_optimizer(app):
+    """Return optimizer for external image files, or None"""
+    if not app.config.notebook_external_images:
+        return None
+    if not hasattr(setup, 'image_optimizer'):
+        setup.image_optimizer = optimizer_from_config(
+            app.config.notebook_optimize_images)
+    return setup.image_optimizer
+
+
+def report_image_optimization(app, exception):
+    optimizer = getattr(setup, 'image_optimizer', None)
+    if exception is None and optimizer is not None:
+        for stats in app.env.notebook_image_stats.values():
+            optimizer.add_stats(stats)
+        report = optimizer.report()
+        if report is not None:
+            app.info('notebook images: ' + report)
+
+
+def get_cell_cache(app):
+    """Return cell output cache, or None if not evaluating incrementally"""
+    cache_dir = get_cache_dir(app)
+    if cache_dir is None or not app.config.notebook_incremental:
+        return None
+    return CellCache(os.path.join(cache_dir, 'cells'),
+                     app.config.notebook_checkpoint_interval)
+
+
+def get_profiler(app, nb_path, nb):
+    """Return cell profiler for notebook `nb`, or None if not profiling"""
+    if not app.config.notebook_profile:
+        return None
+    return CellProfiler(os.path.relpath(nb_path, app.srcdir), nb,
+                        app.config.notebook_profile_metadata)
+
+
+def budget_settings(config):
+    """Return keyword arguments for ``CellBudget``, or None for no limits"""
+    settings = dict(cell_timeout=config.notebook_cell_timeout,
+                    notebook_timeout=config.notebook_timeout,
+                    max_memory=None)
+    if config.notebook_max_memory is not None:
+        settings['max_memory'] = int(config.notebook_max_memory * 2 ** 20)
+    if all(value is None for value in settings.values()):
+        return None
+    return settings
+
+
+def make_monitors(nb, budget=None, profiler=None):
+    """Return cell monitors for `nb` from ``budget_settings`` and profiler"""
+    monitors = []
+    if budget is not None:
+        monitors.append(CellBudget(nb, **budget))
+    if profiler is not None:
+        monitors.append(profiler)
+    return monitors
+
+
+def add_profile_records(records):
+    if not hasattr(setup, 'profile_records'):
+        setup.profile_records = []
+    setup.profile_records.extend(records)
+
+
+def init_doc_state(app):
+    """Start collecting profile records and image stats for this build
+
+    Records and stats from the directive go in the environment by document
+    name, so that parallel readers can send theirs back in
+    ``merge_doc_state``.  Records from ``prebuild_notebooks`` stay in
+    ``setup.profile_records``.
+    """
+    app.env.notebook_profile_records = {}
+    app.env.notebook_image_stats = {}
+
+
+def merge_doc_state(app, env, docnames, other):
+    """Merge records and stats for `docnames` read in parallel into `env`
+    """
+    for name in ('notebook_profile_records', 'notebook_image_stats'):
+        ours, theirs = getattr(env, name), getattr(other, name)
+        for docname in docnames:
+            if docname in theirs:
+                ours[docname] = theirs[docname]
+
+
+def write_profile(app, exception):
+    """Write cell profile report, and summary of slowest cells"""
+    records = list(getattr(setup, 'profile_records', []))
+    for doc_records in app.env.notebook_profile_records.values():
+        records.extend(doc_records)
+    if not records:
+        return
+    report_path = os.path.join(app.confdir, app.config.notebook_profile)
+    write_report(records, report_path)
+    sys.stderr.write('Slowest notebook cells (full report in {0}):\n'
+                     '{1}\n'.format(report_path,
+                                    summary(records,
+                                            app.config.notebook_profile_top)))
+    setup.profile_records = []
+
+
+def read_cleared(nb_path):
+    """Read notebook at `nb_path`, clear outputs, return notebook"""
+    with io.open(nb_path, 'rt') as f:
+        nb = nbformat.read(f, as_version=NBFORMAT)
+    clear_output(nb)
+    return nb
+
+
+def prepare_notebook(nb_path, rst_dir, otherfiles):
+    """Return cleared notebook and its dependencies for directive in `rst_dir`
+    """
+    nb = read_cleared(nb_path)
+    dependencies = ([os.path.abspath(fn) for fn in otherfiles] +
+                    local_imports(nb, rst_dir))
+    return nb, dependencies
+
+
 class NotebookDirective(Directive):
     """Insert an evaluated notebook into a document
 
     This uses runipy and nbconvert to transform a path to an unevaluated notebook
     into html suitable for embedding in a Sphinx document.
+
+    The notebook runs in a temporary directory, with copies of the
+    ``:otherfiles:``, and links to the other files beside the notebook, so
+    files it writes do not land in the source or build directories.  Only
+    the ``:otherfiles:`` and local modules the notebook imports go into the
+    cache key, so list data files the notebook reads in ``:otherfiles:``, for
+    changes to them to run the notebook again.
     """
     required_arguments = 1
     optional_arguments = 0
@@ -127,12 +419,12 @@ class NotebookDirective(Directive):
         if not os.path.exists(dest_dir):
             os.makedirs(dest_dir)
 
-        # Make unevaluated version
-        with io.open(nb_abs_path, 'rt') as f:
-            nb = nbformat.read(f, as_version=NBFORMAT)
-        clear_output(nb)
-        with io.open(dest_path, 'wt') as f:
-            nbformat.write(nb, f, NBFORMAT)
+        # Make unevaluated version.  We parse the notebook once here, and
+        # pass the parsed notebook to the exporters.
+        nb, dependencies = prepare_notebook(nb_abs_path, rst_dir, otherfiles)
+        nb_text = nbformat.writes(nb, NBFORMAT)
+        with io.open(dest_path, 'wt', encoding='utf-8') as f:
+            f.write(nb_text)
         # Copy any other needed files
         for fn in otherfiles:
             shutil.copy2(fn, dest_dir)
@@ -141,14 +433,79 @@ class NotebookDirective(Directive):
         dest_path_script = dest_path.replace('.ipynb', '.py')
 
         # Create python script version
-        script_text = nb_to_python(nb_abs_path)
+        script_text = nb_to_python(nb)
         with open(dest_path_script, 'wb') as f:
             f.write(script_text.encode('utf-8'))
 
+        # Reuse evaluated notebook from cache if nothing has changed.  The
+        # cache may have been filled by ``prebuild_notebooks``.
+        cache_dir = get_cache_dir(setup.app)
+        image_dir = get_image_dir(setup.app)
+        profiler = get_profiler(setup.app, nb_abs_path, nb)
+        monitors = make_monitors(nb, budget_settings(setup.app.config),
+                                 profiler)
         try:
-            evaluated_text = evaluate_notebook(nb, dest_path_eval)
+            # Do not run again notebooks that went over budget in prebuild
+            budget_failures = getattr(setup, 'budget_failures', {})
+            if nb_abs_path in budget_failures:
+                raise BudgetExceeded(budget_failures[nb_abs_path])
+            if cache_dir is None:
+                evaluated_text = evaluate_notebook(
+                    nb, dest_path_eval, get_engine(setup.app, nb),
+                    rst_dir, otherfiles, image_dir=image_dir,
+                    monitors=monitors,
+                    optimizer=get_image_optimizer(setup.app))
+            else:
+                key = notebook_cache_key(nb_text, dependencies,
+                                         cache_options(setup.app.config))
+                cached = cache_lookup(cache_dir, key)
+                if cached is None:
+                    cached = evaluate_to_cache(
+                        nb, cache_dir, key, rst_dir, otherfiles,
+                        get_engine(setup.app, nb),
+                        get_cell_cache(setup.app),
+                        dependency_signature(dependencies),
+                        image_dir, monitors, get_image_optimizer(setup.app))
+                cached_eval_path, evaluated_text = cached
+                link_or_copy(cached_eval_path, dest_path_eval)
+        except BudgetExceeded as err:
+            # Report the notebook over its limits, and build the other pages
+            for path in [nb_abs_path] + dependencies:
+                self.state.document.settings.record_dependencies.add(path)
+            return [self.state_machine.reporter.error(
+                'Notebook {0} went over budget: {1}'.format(nb_path, err),
+                line=self.lineno)]
         except Exception as err:
             raise RuntimeError("{0} in notebook {1}".format(err, nb_path))
+        finally:
+            env = self.state.document.settings.env
+            if profiler is not None:
+                env.notebook_profile_records.setdefault(
+                    env.docname, []).extend(profiler.records)
+            optimizer = get_image_optimizer(setup.app)
+            if optimizer is not None:
+                stats = optimizer.take_stats()
+                doc_stats = env.notebook_image_stats.setdefault(
+                    env.docname, dict.fromkeys(stats, 0))
+                for name in stats:
+                    doc_stats[name] += stats[name]
+
+        # Put image files in the build
+        posix_rel_dir = rel_dir.replace(os.path.sep, '/')
+        if image_dir is not None:
+            evaluated_text = publish_images(
+                evaluated_text, image_dir,
+                os.path.join(setup.app.builder.outdir, '_images'),
+                posixpath.relpath('_images', posix_rel_dir) + '/')
+
+        # Link to shared notebook stylesheet
+        css_fname = notebook_stylesheet(
+            os.path.join(setup.app.builder.outdir, '_static'))
+        css_href = posixpath.relpath(posixpath.join('_static', css_fname),
+                                     posix_rel_dir)
+        evaluated_text = (
+            '<link rel="stylesheet" href="{0}" type="text/css" />\n'.format(
+                css_href) + evaluated_text)
 
         # create notebook node
         attributes = {'format': 'html', 'source': 'nb_path'}
@@ -156,15 +513,9 @@ class NotebookDirective(Directive):
         (nb_node.source, nb_node.line) = \
             self.state_machine.get_source_and_line(self.lineno)
 
-        # add dependency
-        self.state.document.settings.record_dependencies.add(nb_abs_path)
-
-        # clean up png files left behind by notebooks.
-        png_files = glob.glob("*.png")
-        fits_files = glob.glob("*.fits")
-        h5_files = glob.glob("*.h5")
-        for file in png_files:
-            os.remove(file)
+        # add dependencies
+        for path in [nb_abs_path] + dependencies:
+            self.state.document.settings.record_dependencies.add(path)
 
         # Put links underneath notebook
         para = nodes.paragraph('', '')
@@ -190,38 +541,67 @@ def list_join(spacer, in_list):
 class notebook_node(nodes.raw):
     pass
 
-def nb_to_python(nb_path):
-    """convert notebook to python script"""
-    exporter = python.PythonExporter()
-    output, resources = exporter.from_filename(nb_path)
-    return output
+# Exporters are slow to set up, so we make each one once per process
+_exporters = {}
 
+# Stylesheet file names, keyed by output static directory
+_stylesheets = {}
 
-def nb_to_html(nb_path):
-    """convert notebook to html
 
-    This html will get embedded in another html page, so we need to strip out
-    stuff that would interfere with the parent page's formatting.
+def get_exporter(kind):
+    """Return shared exporter instance; `kind` is 'html' or 'python'"""
+    if kind not in _exporters:
+        try:
+            from nbconvert import html, python
+        except ImportError:
+            from IPython.nbconvert import html, python
+        if kind == 'html':
+            _exporters[kind] = html.HTMLExporter(template_file='full')
+        else:
+            _exporters[kind] = python.PythonExporter()
+    return _exporters[kind]
+
+
+def template_source():
+    """Return text of template for html export, as the exporter finds it"""
+    exporter = get_exporter('html')
+    env = exporter.environment
+    source, fname, uptodate = env.loader.get_source(env,
+                                                    exporter.template_file)
+    return source
+
+
+def to_v4(nb):
+    """Return format 4 copy of notebook `nb`, leaving `nb` as it is
+
+    ``nbformat.convert`` upgrades a format 3 notebook in place, dropping its
+    worksheets, and we still need `nb` to evaluate and cache.
     """
-    exporter = html.HTMLExporter(template_file='full')
-    output, resources = exporter.from_filename(nb_path)
-    header = output.split('<head>', 1)[1].split('</head>',1)[0]
-    body = output.split('<body>', 1)[1].split('</body>',1)[0]
+    return nbformat.convert(copy.deepcopy(nb), 4)
 
+
+def nb_to_python(nb):
+    """convert notebook node to python script"""
+    output, resources = get_exporter('python').from_notebook_node(to_v4(nb))
+    return output
+
+
+def strip_conflicting_css(css):
+    """Remove rules from notebook `css` that fight the parent page's styles
+    """
     # http://imgur.com/eR9bMRH
-    header = header.replace('<style', '<style scoped="scoped"')
-    header = header.replace('body{background-color:#ffffff;}\n', '')
-    header = header.replace('body{background-color:white;position:absolute;'
-                            'left:0px;right:0px;top:0px;bottom:0px;'
-                            'overflow:visible;}\n', '')
-    header = header.replace('body{margin:0;'
-                            'font-family:"Helvetica Neue",Helvetica,Arial,'
-                            'sans-serif;font-size:13px;line-height:20px;'
-                            'color:#000000;background-color:#ffffff;}', '')
-    header = header.replace('\na{color:#0088cc;text-decoration:none;}', '')
-    header = header.replace(
+    css = css.replace('body{background-color:#ffffff;}\n', '')
+    css = css.replace('body{background-color:white;position:absolute;'
+                      'left:0px;right:0px;top:0px;bottom:0px;'
+                      'overflow:visible;}\n', '')
+    css = css.replace('body{margin:0;'
+                      'font-family:"Helvetica Neue",Helvetica,Arial,'
+                      'sans-serif;font-size:13px;line-height:20px;'
+                      'color:#000000;background-color:#ffffff;}', '')
+    css = css.replace('\na{color:#0088cc;text-decoration:none;}', '')
+    css = css.replace(
         'a:focus{color:#005580;text-decoration:underline;}', '')
-    header = header.replace(
+    css = css.replace(
         '\nh1,h2,h3,h4,h5,h6{margin:10px 0;font-family:inherit;font-weight:bold;'
         'line-height:20px;color:inherit;text-rendering:optimizelegibility;}'
         'h1 small,h2 small,h3 small,h4 small,h5 small,'
@@ -232,28 +612,457 @@ def nb_to_html(nb_path):
         '\nh6{font-size:11.049999999999999px;}\nh1 small{font-size:22.75px;}'
         '\nh2 small{font-size:16.25px;}\nh3 small{font-size:13px;}'
         '\nh4 small{font-size:13px;}', '')
-    header = header.replace('background-color:#ffffff;', '', 1)
+    css = css.replace('background-color:#ffffff;', '', 1)
+    return css
+
+
+def _block_end(css, start):
+    """Return index of brace closing the block opening at `start` in `css`
+    """
+    depth = 0
+    for i in range(start, len(css)):
+        if css[i] == '{':
+            depth += 1
+        elif css[i] == '}':
+            depth -= 1
+            if depth == 0:
+                return i
+    return len(css)
+
+
+def scope_selectors(selectors, scope):
+    """Return comma-separated css `selectors` limited to inside `scope`
+
+    The parent page styles the page itself, so we drop selectors such as
+    ``body``.  In longer selectors, such as ``html input``, `scope` replaces
+    the page.  Return '' if no selectors are left.
+    """
+    scoped = []
+    for selector in selectors.split(','):
+        selector = selector.strip()
+        match = page_selector_re.match(selector)
+        if match is None:
+            scoped.append(scope + ' ' + selector)
+        elif match.end() != len(selector):
+            scoped.append(scope + selector[match.end():])
+    return ','.join(scoped)
+
+
+def scope_css(css, scope):
+    """Return `css` with rules applying only to elements inside `scope`
+
+    We prefix the selectors of each rule, including rules inside ``@media``
+    and ``@supports`` blocks, with selector `scope`, and drop rules for the
+    whole page (see ``scope_selectors``).  Other at-rules, such as
+    ``@font-face`` and ``@keyframes``, stay as they are.
+    """
+    css = css_comment_re.sub('', css)
+    parts = []
+    pos = 0
+    while True:
+        start = css.find('{', pos)
+        if start == -1:
+            parts.append(css[pos:].strip())
+            break
+        # Statements such as ``@charset`` end with a semicolon
+        statements = css[pos:start].split(';')
+        parts.extend(statement.strip() + ';'
+                     for statement in statements[:-1] if statement.strip())
+        prelude = statements[-1].strip()
+        end = _block_end(css, start)
+        block = css[start + 1:end]
+        if prelude.startswith(('@media', '@supports')):
+            block = scope_css(block, scope)
+        elif not prelude.startswith('@'):
+            prelude = scope_selectors(prelude, scope)
+        if prelude:
+            parts.append('{0}{{{1}}}'.format(prelude, block))
+        pos = end + 1
+    return '\n'.join(part for part in parts if part)
+
+
+def export_html(nb):
+    """Return <head> and <body> contents of format 4 notebook `nb` as html"""
+    output, resources = get_exporter('html').from_notebook_node(nb)
+    header = output.split('<head>', 1)[1].split('</head>',1)[0]
+    body = output.split('<body>', 1)[1].split('</body>',1)[0]
+    return header, body
+
+
+def notebook_stylesheet(static_dir):
+    """Write notebook stylesheet into `static_dir`, return file name
+
+    The stylesheet is the same for all notebooks, so we make it once, from
+    an empty notebook.  It goes on every page with a notebook, so we scope
+    its rules to the div around each notebook, and they cannot restyle the
+    rest of the page.  The file name has a hash of the contents, so browsers
+    can cache it safely.
+    """
+    if static_dir not in _stylesheets:
+        header, body = export_html(nbformat.convert(nbf.new_notebook(), 4))
+        css = strip_conflicting_css('\n'.join(style_re.findall(header)))
+        css = scope_css(css, '.' + NOTEBOOK_CLASS)
+        fingerprint = hashlib.sha256(css.encode('utf-8')).hexdigest()[:12]
+        fname = 'notebook-{0}.css'.format(fingerprint)
+        css_path = os.path.join(static_dir, fname)
+        if not os.path.isfile(css_path):
+            makedirs(static_dir)
+            _write_atomic(css_path, css)
+        _stylesheets[static_dir] = fname
+    return _stylesheets[static_dir]
+
+
+def nb_to_html(nb, image_dir=None, optimizer=None):
+    """convert notebook node to html
+
+    This html will get embedded in another html page, so we strip out the
+    notebook styles (see ``notebook_stylesheet``) and mathjax configuration,
+    which would interfere with the parent page.
+
+    If `image_dir` is not None, write image outputs to files in `image_dir`
+    instead of embedding them.  Image URLs in the html then start with
+    ``IMAGE_URL_TOKEN``; see ``publish_images``.  If `optimizer` is not
+    None, use it to make the image files smaller.  `nb` itself keeps its
+    image outputs, for the evaluated notebook we offer for download.
+    """
+    nb = to_v4(nb)
+    if image_dir is not None:
+        externalize_images(nb, image_dir, IMAGE_URL_TOKEN, optimizer)
+    header, body = export_html(nb)
+    header = style_re.sub('', header)
     # Remove mathjax configuration
     header = mathjax_config.sub('', header)
     # concatenate raw html lines
-    lines = ['<div class="ipynotebook">']
+    lines = ['<div class="{0}">'.format(NOTEBOOK_CLASS)]
     lines.append(header)
     lines.append(body)
     lines.append('</div>')
     return '\n'.join(lines)
 
 
-def evaluate_notebook(nb, dest_path=None):
-    # Create evaluated version and save it to the dest path.
-    nb_runner = NotebookRunner(nb=nb)
-    nb_runner.run_notebook()
-    if dest_path is None:
-        dest_path = 'temp_evaluated.ipynb'
-    nbformat.write(nb_runner.nb, open(dest_path, 'w'), NBFORMAT)
-    ret = nb_to_html(dest_path)
-    if dest_path is 'temp_evaluated.ipynb':
-        os.remove(dest_path)
-    return ret
+def link_notebook_dir(nb_dir, work_dir):
+    """Link files and directories in `nb_dir` into `work_dir`
+
+    Notebooks can then read files from their own directory by relative path,
+    as when they ran there, but the files they make stay in `work_dir`.  We
+    leave alone entries already in `work_dir`, from ``:otherfiles:``, and
+    hidden entries.  Without symbolic links (such as on Windows without the
+    privilege), we link nothing.
+    """
+    if not hasattr(os, 'symlink'):
+        return
+    for name in os.listdir(nb_dir):
+        out_path = os.path.join(work_dir, name)
+        if name.startswith('.') or os.path.lexists(out_path):
+            continue
+        try:
+            os.symlink(os.path.join(nb_dir, name), out_path)
+        except (OSError, NotImplementedError):
+            return
+
+
+def run_isolated(nb, nb_dir=None, otherfiles=(), kernel_pool=None,
+                 cell_cache=None, seed='', monitors=()):
+    """Evaluate `nb` in place, in a new temporary working directory
+
+    Notebooks running in their own directory can run in parallel, and cannot
+    leave files behind in the directory of the build.  The working directory
+    has links to the contents of `nb_dir` (see ``link_notebook_dir``), so
+    notebooks can still read data files beside them.
+
+    Parameters
+    ----------
+    nb : notebook node
+        Notebook to evaluate.
+    nb_dir : None or str, optional
+        Directory containing notebook.  Notebook can import modules from this
+        directory.  Defaults to current directory.
+    otherfiles : sequence, optional
+        Files needed by notebook.  We copy these into the working directory
+        at the same relative path as from the current directory.
+    kernel_pool : None or ``KernelPool`` instance, optional
+        Pool from which to take a kernel.  If None, start a kernel for this
+        notebook only.
+    cell_cache : None or ``CellCache`` instance, optional
+        If not None, take outputs of unchanged cells from this cache, and
+        only run cells from the first changed cell.
+    seed : str, optional
+        Seed for cell cache keys; see ``cell_cache.chain_keys``.
+    monitors : sequence, optional
+        Monitors for each cell run, such as ``CellProfiler`` instances; see
+        ``kernel_pool.run_cell``.
+
+    Returns
+    -------
+    nb : notebook node
+        The evaluated input notebook.
+    """
+    if nb_dir is None:
+        nb_dir = os.getcwd()
+    if cell_cache is not None:
+        keys, start = cell_cache.resume_point(nb, seed)
+        if start == len(keys):  # All outputs in cache
+            cell_cache.fill_outputs(nb, keys, start)
+            renumber_prompts(nb)
+            return nb
+    own_pool = kernel_pool is None
+    if own_pool:
+        kernel_pool = KernelPool(1, preimports=())
+    work_dir = tempfile.mkdtemp(prefix='notebook_')
+    try:
+        for fn in otherfiles:
+            rel_path = os.path.normpath(fn)
+            if os.path.isabs(rel_path) or rel_path.startswith(os.pardir):
+                rel_path = basename(fn)
+            out_path = os.path.join(work_dir, rel_path)
+            makedirs(os.path.dirname(out_path))
+            shutil.copy2(fn, out_path)
+        link_notebook_dir(nb_dir, work_dir)
+        with kernel_pool.kernel(work_dir, path=[nb_dir]) as nb_runner:
+            if cell_cache is None:
+                run_notebook(nb_runner, nb, monitors)
+            else:
+                cell_cache.run_notebook(nb_runner, nb, seed, monitors)
+    finally:
+        if own_pool:
+            kernel_pool.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return nb
+
+
+def evaluate_notebook(nb, dest_path=None, kernel_pool=None, nb_dir=None,
+                      otherfiles=(), cell_cache=None, seed='', image_dir=None,
+                      monitors=(), optimizer=None):
+    # Evaluate `nb` in place, save to the dest path (if given), return html
+    run_isolated(nb, nb_dir, otherfiles, kernel_pool, cell_cache, seed,
+                 monitors)
+    if dest_path is not None:
+        with io.open(dest_path, 'wt', encoding='utf-8') as f:
+            f.write(nbformat.writes(nb, NBFORMAT))
+    return nb_to_html(nb, image_dir, optimizer)
+
+
+def source_suffixes(config):
+    """Return tuple of source file suffixes from Sphinx `config`"""
+    suffixes = config.source_suffix
+    if isinstance(suffixes, str):
+        return (suffixes,)
+    return tuple(suffixes)
+
+
+def find_notebooks(srcdir, suffixes):
+    """Find notebook directives in source files under `srcdir`
+
+    Yields (directory of source file, notebook argument, otherfiles) for each
+    ``.. notebook::`` directive found.
+    """
+    for dirpath, dirnames, filenames in os.walk(srcdir):
+        # Omit directories beginning with dots and underscores
+        dirnames[:] = [d for d in dirnames
+                       if not d.startswith('.') and not d.startswith('_')]
+        for fname in filenames:
+            if not fname.endswith(suffixes):
+                continue
+            with io.open(os.path.join(dirpath, fname), 'rt',
+                         encoding='utf-8') as f:
+                lines = f.read().splitlines()
+            for i, line in enumerate(lines):
+                match = directive_re.match(line)
+                if match is None:
+                    continue
+                indent = len(match.group(1))
+                otherfiles = []
+                for option_line in lines[i + 1:]:
+                    if (not option_line.strip() or
+                        len(option_line) - len(option_line.lstrip()) <= indent):
+                        break
+                    option_match = otherfiles_re.match(option_line)
+                    if option_match is not None:
+                        otherfiles = [fn.strip() for fn in
+                                      option_match.group(1).split(',')
+                                      if fn.strip()]
+                yield os.path.abspath(dirpath), match.group(2), otherfiles
+
+
+# Per-process state for prebuild worker processes
+_worker = {}
+
+
+def _init_prebuild_worker(preimports, max_uses, cell_cache, engine='kernel',
+                          fork=True):
+    _worker['settings'] = dict(preimports=preimports, max_uses=max_uses)
+    _worker['pool'] = None
+    _worker['exec_engine'] = None
+    if engine == 'exec':
+        _worker['exec_engine'] = ExecEngine(fork, preimports)
+    _worker['cell_cache'] = cell_cache
+
+
+def _worker_engine(nb, limits=False):
+    """Return exec engine or kernel pool for `nb` in prebuild worker
+
+    `limits` is True if cells run with time or memory limits.
+    """
+    exec_engine = _worker['exec_engine']
+    if exec_engine is not None and exec_engine.supports(nb, limits):
+        return exec_engine
+    if _worker['pool'] is None:
+        _worker['pool'] = KernelPool(1, **_worker['settings'])
+        # Shut down kernel when the worker process exits
+        Finalize(None, _worker['pool'].shutdown, exitpriority=10)
+    return _worker['pool']
+
+
+def _prebuild_worker(job):
+    """Evaluate notebook for `job` into the cache
+
+    Returns (path, error, over budget flag, profile records, image
+    optimization stats).  ``profile`` in `job` is None for no profiling, or
+    (notebook name, store metadata flag).  ``budget`` is from
+    ``budget_settings``.  ``optimizer`` is None or an ``ImageOptimizer``.
+    """
+    (nb_abs_path, rst_dir, otherfiles, cache_dir, key, seed, image_dir,
+     profile, budget, optimizer) = job
+    profiler = None
+    try:
+        nb = read_cleared(nb_abs_path)
+        if profile is not None:
+            profiler = CellProfiler(profile[0], nb, profile[1])
+        evaluate_to_cache(nb, cache_dir, key, rst_dir, otherfiles,
+                          _worker_engine(nb, budget is not None),
+                          _worker['cell_cache'], seed,
+                          image_dir, make_monitors(nb, budget, profiler),
+                          optimizer)
+    except BudgetExceeded as err:
+        return nb_abs_path, str(err), True, [], None
+    except Exception as err:
+        return nb_abs_path, str(err), False, [], None
+    return (nb_abs_path, None, False,
+            [] if profiler is None else profiler.records,
+            None if optimizer is None else optimizer.stats)
+
+
+def get_notebook_jobs(config):
+    n_jobs = config.notebook_jobs
+    if n_jobs == 'auto':
+        return multiprocessing.cpu_count()
+    return int(n_jobs)
+
+
+def prebuild_notebooks(app):
+    """Evaluate notebooks not in the cache, in parallel, before reading
+
+    Each notebook runs in its own temporary directory, in a pool of
+    ``notebook_jobs`` worker processes.  The results go into the notebook
+    cache, where ``NotebookDirective`` finds them.  Notebooks that fail here
+    get evaluated again by the directive, to report the error in context,
+    unless they went over the time or memory limits.
+    """
+    n_jobs = get_notebook_jobs(app.config)
+    cache_dir = get_cache_dir(app)
+    if n_jobs < 2 or cache_dir is None:
+        return
+    jobs = []
+    keys = set()
+    for rst_dir, nb_arg, otherfiles in find_notebooks(
+        app.srcdir, source_suffixes(app.config)):
+        nb_abs_path = os.path.join(rst_dir, basename(nb_arg))
+        if not os.path.isfile(nb_abs_path):
+            continue
+        try:
+            nb, dependencies = prepare_notebook(nb_abs_path, rst_dir,
+                                                otherfiles)
+            seed = dependency_signature(dependencies)
+            key = notebook_cache_key(nbformat.writes(nb, NBFORMAT),
+                                     dependencies, cache_options(app.config))
+        except Exception:
+            # The directive reports the error, in context
+            continue
+        if key in keys or cache_lookup(cache_dir, key) is not None:
+            continue
+        keys.add(key)
+        profile = None
+        if app.config.notebook_profile:
+            profile = (os.path.relpath(nb_abs_path, app.srcdir),
+                       app.config.notebook_profile_metadata)
+        jobs.append((nb_abs_path, rst_dir, otherfiles, cache_dir, key,
+                     seed, get_image_dir(app),
+                     profile, budget_settings(app.config),
+                     get_image_optimizer(app)))
+    if not jobs:
+        return
+    n_procs = min(n_jobs, len(jobs))
+    app.info('evaluating {0} notebooks in {1} processes'.format(
+        len(jobs), n_procs))
+    config = app.config
+    pool = multiprocessing.Pool(
+        n_procs, _init_prebuild_worker,
+        (config.notebook_kernel_preimports, config.notebook_kernel_max_uses,
+         get_cell_cache(app), config.notebook_engine,
+         config.notebook_engine_fork))
+    try:
+        for (nb_abs_path, error, over_budget, records,
+             image_stats) in pool.imap_unordered(_prebuild_worker, jobs):
+            if over_budget:
+                # The directive reports these, on the page of the notebook
+                if not hasattr(setup, 'budget_failures'):
+                    setup.budget_failures = {}
+                setup.budget_failures[nb_abs_path] = error
+            elif error is not None:
+                app.warn('Evaluating {0} failed: {1}'.format(nb_abs_path,
+                                                             error))
+            add_profile_records(records)
+            if image_stats is not None:
+                get_image_optimizer(app).add_stats(image_stats)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_kernel_pool(app):
+    """Return kernel pool for this build, starting it on first use
+
+    We start the kernels when the first notebook needs evaluating, rather than
+    at the start of the build, so builds where all notebooks come from the
+    cache do not pay for starting kernels.  Each process reading documents
+    (see ``sphinx-build -j``) starts its own kernels, and shuts them down
+    when it exits.
+    """
+    if (getattr(setup, 'kernel_pool', None) is None or
+        setup.kernel_pool_pid != os.getpid()):
+        config = app.config
+        setup.kernel_pool = KernelPool(
+            n_kernels=config.notebook_kernels,
+            preimports=config.notebook_kernel_preimports,
+            max_uses=config.notebook_kernel_max_uses)
+        setup.kernel_pool_pid = os.getpid()
+        Finalize(None, setup.kernel_pool.shutdown, exitpriority=10)
+    return setup.kernel_pool
+
+
+def get_engine(app, nb):
+    """Return exec engine or kernel pool with which to evaluate `nb`
+
+    With ``notebook_engine = 'exec'``, notebooks that the exec engine can run
+    use it, and others use the kernel pool.  Without fork, notebooks with
+    time or memory limits need the kernel pool.
+    """
+    config = app.config
+    if config.notebook_engine == 'exec':
+        if getattr(setup, 'exec_engine', None) is None:
+            setup.exec_engine = ExecEngine(config.notebook_engine_fork,
+                                           config.notebook_kernel_preimports)
+        limits = budget_settings(config) is not None
+        if setup.exec_engine.supports(nb, limits):
+            return setup.exec_engine
+    return get_kernel_pool(app)
+
+
+def shutdown_kernel_pool(app, exception):
+    pool = getattr(setup, 'kernel_pool', None)
+    if pool is not None and setup.kernel_pool_pid == os.getpid():
+        pool.shutdown()
+    setup.kernel_pool = None
 
 
 def formatted_link(path):
@@ -278,3 +1087,32 @@ def setup(app):
                  html=(visit_notebook_node, depart_notebook_node))
 
     app.add_directive('notebook', NotebookDirective)
+    app.add_config_value('notebook_cache', True, 'env')
+    app.add_config_value('notebook_cache_dir', None, 'env')
+    app.add_config_value('notebook_kernels', 1, 'env')
+    app.add_config_value('notebook_kernel_preimports',
+                         list(DEFAULT_PREIMPORTS), 'env')
+    app.add_config_value('notebook_kernel_max_uses', None, 'env')
+    app.add_config_value('notebook_jobs', 1, 'env')
+    app.add_config_value('notebook_engine', 'kernel', 'env')
+    app.add_config_value('notebook_engine_fork', True, 'env')
+    app.add_config_value('notebook_incremental', False, 'env')
+    app.add_config_value('notebook_external_images', False, 'env')
+    app.add_config_value('notebook_optimize_images', False, 'env')
+    app.add_config_value('notebook_checkpoint_interval',
+                         DEFAULT_CHECKPOINT_INTERVAL, 'env')
+    app.add_config_value('notebook_cell_timeout', None, 'env')
+    app.add_config_value('notebook_timeout', None, 'env')
+    app.add_config_value('notebook_max_memory', None, 'env')
+    app.add_config_value('notebook_profile', None, 'env')
+    app.add_config_value('notebook_profile_top', 10, 'env')
+    app.add_config_value('notebook_profile_metadata', False, 'env')
+
+    app.connect('builder-inited', init_doc_state)
+    app.connect('builder-inited', prebuild_notebooks)
+    app.connect('env-merge-info', merge_doc_state)
+    app.connect('build-finished', shutdown_kernel_pool)
+    app.connect('build-finished', write_profile)
+    app.connect('build-finished', report_image_optimization)
+
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
@@ -124,16 +124,61 @@ The plot directive has the following configuration options:
 
     plot_template
         Provide a customized template for preparing restructured text.
+
+    plot_optimize_images
+        If True, recompress PNG images losslessly, and minify SVG images
+        (see ``image_optimize.ImageOptimizer``).  A dict gives options for the
+        optimizer, such as ``{'colors': 256}`` to reduce PNG images to a
+        palette, which suits line plots.  The default, False, leaves images
+        as matplotlib writes them.
+
+    plot_jobs
+        Number of worker processes rendering plots before Sphinx reads the
+        sources, or ``'auto'`` for one per CPU.  The default, 1, renders each
+        plot as the directive meets it.
+
+Images are kept in a ``plot_cache`` directory next to the doctrees, under a
+hash of the plot code, the directory it runs in, the configuration above and
+the matplotlib version.  A manifest next to the images lists the image files
+for each part of the plot code, with their sizes, so we notice missing or
+damaged images.
+
+While a plot runs, we record the modules it imports, and the files it reads,
+from the directory of the plot code and the Sphinx source directory.  A plot
+is only run again when its code, configuration or one of these files changes.
+To see files read (Python 3.8 or later), the first plot we run installs an
+audit hook.  Python cannot remove audit hooks, so from then on, every audited
+event in the process, such as each ``open`` or ``import``, calls the hook;
+outside plots, it returns straight away.
+
+After each ``:context:`` plot we run, we also keep a checkpoint of the context
+namespace, so a change to one plot in a chain only runs the plots from the
+nearest checkpoint before it.  Values must pickle (with ``dill`` if you have
+it) for a checkpoint.
+
+With ``plot_jobs`` above 1, plots missing from the cache are rendered in
+parallel when the build starts; all the ``:context:`` plots of a document go
+to the same worker, in document order.  The directive is safe for
+``sphinx-build -j``; each document keeps its ``:context:`` namespace to
+itself.
 """
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import six
-from six.moves import xrange
+from six.moves import cPickle as pickle
 
 import sys, os, shutil, io, re, textwrap
+import site
+import sysconfig
 from os.path import relpath
 import traceback
+import hashlib
+import json
+import random
+import types
+import multiprocessing
+from contextlib import contextmanager
 
 if not six.PY3:
     import cStringIO
@@ -159,11 +204,24 @@ except ImportError:
     def format_template(template, **kw):
         return jinja.from_string(template, **kw)
 
-import matplotlib
-import matplotlib.cbook as cbook
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from matplotlib import _pylab_helpers
+from image_optimize import optimizer_from_config
+from fsutil import file_digest, link_or_copy, thread_pool
+from lazy_import import LazyModule, load_module, is_available
+
+# matplotlib is slow to import, so we import it when the first plot needs it
+# (see ``snippet_key``), and pyplot when the first plot runs
+matplotlib = LazyModule('matplotlib',
+                        on_import=lambda module: module.use('Agg'))
+cbook = LazyModule('matplotlib.cbook', requires=[matplotlib])
+plt = LazyModule('matplotlib.pyplot', requires=[matplotlib])
+_pylab_helpers = LazyModule('matplotlib._pylab_helpers',
+                            requires=[matplotlib])
+
+# dill pickles more kinds of values, such as functions defined by plot code
+pickler = LazyModule(('dill', pickle.__name__))
+
+# PIL resamples and encodes PNG images; see ``save_figure``
+PILImage = LazyModule('PIL.Image')
 
 __version__ = 2
 
@@ -266,8 +324,20 @@ def setup(app):
     app.add_config_value('plot_apply_rcparams', False, True)
     app.add_config_value('plot_working_directory', None, True)
     app.add_config_value('plot_template', None, True)
+    app.add_config_value('plot_jobs', 1, True)
+    app.add_config_value('plot_optimize_images', False, True)
 
+    app.connect(str('builder-inited'), init_doc_stats)
+    app.connect(str('builder-inited'), prebuild_plots)
     app.connect(str('doctree-read'), mark_plot_labels)
+    app.connect(str('env-merge-info'), merge_doc_stats)
+    app.connect(str('build-finished'), report_publish)
+    app.connect(str('build-finished'), report_image_optimization)
+
+    # Module state is set here, or is per process, such as ``run_code``
+    # changing the working directory; state for each document lives in the
+    # environment (see ``run``)
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
 
 #------------------------------------------------------------------------------
 # Doctest handling
@@ -407,10 +477,6 @@ Exception occurred rendering plot.
 
 """
 
-# the context of the plot for all directives specified with the
-# :context: option
-plot_context = dict()
-
 class ImageFile(object):
     def __init__(self, basename, dirname):
         self.basename = basename
@@ -438,6 +504,519 @@ class PlotError(RuntimeError):
     pass
 
 
+# Default plot_pre_code
+DEFAULT_PRE_CODE = ("import numpy as np\n"
+                    "from matplotlib import pyplot as plt\n")
+
+# Base name for images in the plot cache
+CACHE_BASE = 'plot'
+
+
+def get_plot_formats(config):
+    """
+    Return list of (suffix, dpi) tuples from ``plot_formats`` in *config*
+    """
+    default_dpi = {'png': 80, 'hires.png': 200, 'pdf': 200}
+    formats = []
+    plot_formats = config.plot_formats
+    if isinstance(plot_formats, six.string_types):
+        plot_formats = eval(plot_formats)
+    for fmt in plot_formats:
+        if isinstance(fmt, six.string_types):
+            formats.append((fmt, default_dpi.get(fmt, 80)))
+        elif type(fmt) in (tuple, list) and len(fmt)==2:
+            formats.append((str(fmt[0]), int(fmt[1])))
+        else:
+            raise PlotError('invalid image format "%r" in plot_formats' % fmt)
+    return formats
+
+
+def code_directory(code_path, config):
+    """
+    Return directory in which plot code from *code_path* runs
+
+    See ``run_code``.  Return None if *code_path* is None.
+    """
+    if config.plot_working_directory is not None:
+        return os.path.abspath(config.plot_working_directory)
+    if code_path is None:
+        return None
+    return os.path.abspath(os.path.dirname(code_path))
+
+
+def snippet_key(code, code_path, function_name, config, formats,
+                context_key=None):
+    """
+    Return hash of everything that goes into the images for one plot
+
+    That is the plot code, the directory it runs in (relative to the
+    configuration directory, as code can read data files from there), the
+    function to call, the configuration that changes the images, and the
+    matplotlib version.  *context_key* is the hash of the ``:context:`` code
+    run before this plot, or None if the plot does not use the context.
+    """
+    code_dir = code_directory(code_path, config)
+    if code_dir is not None:
+        code_dir = relpath(code_dir, setup.confdir).replace(os.path.sep, '/')
+    pre_code = config.plot_pre_code
+    if pre_code is None:
+        pre_code = DEFAULT_PRE_CODE
+    optimizer = get_image_optimizer(config)
+    parts = [__version__, matplotlib.__version__, code, code_dir,
+             function_name, pre_code, sorted(config.plot_rcparams.items()),
+             config.plot_apply_rcparams, formats, context_key,
+             None if optimizer is None else optimizer.signature()]
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+# Optimizer for plot images, made on first use
+_optimizer = {}
+
+
+def get_image_optimizer(config):
+    """
+    Return optimizer for ``plot_optimize_images`` in *config*, or None
+    """
+    value = config.plot_optimize_images
+    if 'optimizer' not in _optimizer or _optimizer['value'] != value:
+        _optimizer['value'] = value
+        _optimizer['optimizer'] = optimizer_from_config(value)
+    return _optimizer['optimizer']
+
+
+def report_image_optimization(app, exception):
+    optimizer = _optimizer.get('optimizer')
+    if exception is None and optimizer is not None:
+        for stats in app.env.plot_image_stats.values():
+            optimizer.add_stats(stats)
+        report = optimizer.report()
+        if report is not None:
+            app.info('plot directive: ' + report)
+
+
+def chain_context_key(context_key, code):
+    """
+    Return context key after running *code* in context with *context_key*
+    """
+    hasher = hashlib.sha256(context_key.encode('ascii'))
+    hasher.update(code.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+# Files opened for reading while tracing, or None when not tracing, and
+# whether we have installed the audit hook in this process
+_opened = {'files': None, 'hooked': False}
+
+
+def _audit_open(event, args, _opened=_opened):
+    # Bind _opened here; module globals are None at interpreter exit
+    files = _opened['files']
+    if files is None or event != 'open':
+        return
+    path, mode, flags = args
+    if not isinstance(path, six.string_types):
+        return
+    if mode is None:
+        reading = flags is not None and flags & 3 == os.O_RDONLY
+    else:
+        reading = not set('wax+') & set(mode)
+    if reading:
+        files.add(os.path.abspath(path))
+
+
+def _install_audit_hook():
+    """
+    Install hook recording files opened, on first use in this process
+
+    Audit hooks (Python >= 3.8) see every file opened, including by
+    libraries.  We cannot remove the hook, so only install it when a plot
+    needs tracing.
+    """
+    if not _opened['hooked'] and hasattr(sys, 'addaudithook'):
+        sys.addaudithook(_audit_open)
+        _opened['hooked'] = True
+
+
+def _under(path, dirs):
+    path = os.path.abspath(path)
+    return any(path.startswith(os.path.join(d, '')) for d in dirs)
+
+
+def _module_source(fname):
+    if fname.endswith(('.pyc', '.pyo')) and os.path.exists(fname[:-1]):
+        return fname[:-1]
+    return fname
+
+
+def local_modules(dirs):
+    """
+    Return dict of module name: source file for modules from *dirs*
+    """
+    modules = {}
+    for name, module in list(sys.modules.items()):
+        fname = getattr(module, '__file__', None)
+        if fname and _under(fname, dirs):
+            modules[name] = _module_source(os.path.abspath(fname))
+    return modules
+
+
+@contextmanager
+def _no_trace():
+    yield
+
+
+def _library_dirs():
+    """
+    Return directories of Python, its site-packages, and this extension
+
+    Modules and files from these are never plot dependencies, even when they
+    are inside the plot directories, as for a virtualenv in the project.
+    """
+    dirs = set([sys.prefix, sys.exec_prefix,
+                os.path.dirname(os.path.abspath(__file__))])
+    for name in ('stdlib', 'platstdlib', 'purelib', 'platlib'):
+        dirs.add(sysconfig.get_path(name))
+    # Old virtualenvs have a site module without these
+    if hasattr(site, 'getsitepackages'):
+        dirs.update(site.getsitepackages())
+    if hasattr(site, 'getusersitepackages'):
+        dirs.add(site.getusersitepackages())
+    return [os.path.abspath(d) for d in dirs if d]
+
+
+@contextmanager
+def trace_dependencies(dirs, exclude_dirs, deps):
+    """
+    Add local modules and data files used in ``with`` block to set *deps*
+
+    Local means from a directory in *dirs*, but not from *exclude_dirs*, nor
+    from Python, site-packages or this extension (see ``_library_dirs``).
+    Afterwards, we drop the local modules the code imported from
+    ``sys.modules``, so that the next plot imports, and so records, them
+    again.  Modules imported before, such as by ``conf.py``, stay, and are
+    not recorded.  Python versions before 3.8 cannot see files opened by the
+    code, so only record modules.
+    """
+    before = set(sys.modules)
+    _install_audit_hook()
+    _opened['files'] = files = set()
+    try:
+        yield
+    finally:
+        _opened['files'] = None
+        library_dirs = _library_dirs()
+        imported = dict((name, fname)
+                        for name, fname in local_modules(dirs).items()
+                        if name not in before and
+                        not _under(fname, library_dirs))
+        for name in imported:
+            del sys.modules[name]
+        files.update(imported.values())
+        deps.update(fname for fname in files
+                    if _under(fname, dirs) and
+                    not _under(fname, exclude_dirs) and
+                    not _under(fname, library_dirs) and
+                    os.path.isfile(fname))
+
+
+def manifest_path(image_dir, image_base):
+    return os.path.join(image_dir, image_base + '.manifest.json')
+
+
+def write_manifest(image_dir, image_base, key, results, formats, deps):
+    """
+    Write manifest for images in *results*, in *image_dir*
+
+    The manifest has the snippet *key*, the image basenames for each code
+    piece, the image *formats*, the size in bytes of each image file, and
+    the digests of the dependency files *deps*.
+    """
+    sizes = {}
+    for code_piece, images in results:
+        for img in images:
+            for fname in img.filenames():
+                sizes[os.path.basename(fname)] = os.path.getsize(fname)
+    manifest = dict(
+        key=key,
+        images=[[img.basename for img in images] for code_piece, images
+                in results],
+        formats=[format for format, dpi in formats],
+        sizes=sizes,
+        deps=dict((fname, file_digest(fname)) for fname in deps))
+    with io.open(manifest_path(image_dir, image_base), 'w',
+                 encoding='utf-8') as fobj:
+        fobj.write(six.text_type(json.dumps(manifest, sort_keys=True)))
+
+
+def read_manifest(image_dir, image_base):
+    """
+    Return manifest dict for images in *image_dir*, or None
+    """
+    try:
+        with io.open(manifest_path(image_dir, image_base), 'r',
+                     encoding='utf-8') as fobj:
+            return json.load(fobj)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def deps_changed(digests):
+    """
+    Return True if any dependency in dict *digests* has changed
+    """
+    return digests is None or any(file_digest(fname) != digest
+                                  for fname, digest in digests.items())
+
+
+# Name of checkpoint of ``:context:`` namespace, next to cached images
+CONTEXT_CHECKPOINT = 'context.pkl'
+
+
+def save_context(ns, fname):
+    """
+    Save ``:context:`` namespace *ns* to file *fname*; True if saved
+
+    Modules are stored by name; all other values must pickle, or we save
+    nothing.  We also store the state of the random number generators and
+    the rcParams, that plot code may have changed.
+    """
+    modules = {}
+    values = {}
+    for name, value in ns.items():
+        if name.startswith('__') or name == 'print':
+            continue
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+            continue
+        try:
+            values[name] = pickler.dumps(value, 2)
+        except Exception:
+            return False
+    rcparams = dict(dict.items(matplotlib.rcParams))
+    rcparams.pop('backend', None)
+    state = dict(modules=modules, values=values, random=random.getstate(),
+                 rcparams=rcparams)
+    if 'numpy' in sys.modules:
+        state['numpy_random'] = sys.modules['numpy'].random.get_state()
+    with open(fname, 'wb') as fobj:
+        pickle.dump(state, fobj, 2)
+    return True
+
+
+def load_context(ns, fname):
+    """
+    Replace contents of namespace *ns* with checkpoint in file *fname*
+    """
+    with open(fname, 'rb') as fobj:
+        state = pickle.load(fobj)
+    ns.clear()
+    for name, mod_name in state['modules'].items():
+        __import__(mod_name)
+        ns[name] = sys.modules[mod_name]
+    for name, value in state['values'].items():
+        ns[name] = pickler.loads(value)
+    random.setstate(state['random'])
+    if 'numpy_random' in state:
+        import numpy
+        numpy.random.set_state(state['numpy_random'])
+    dict.update(matplotlib.rcParams, state['rcparams'])
+
+
+def rebuild_context(ns, context_chain, code_path, config):
+    """
+    Rebuild ``:context:`` namespace *ns* after plots we did not run
+
+    Start from the latest checkpoint in *context_chain* that loads, and run
+    the code of the context plots after it; without a checkpoint, run all
+    the context code since the start or the last reset.
+    """
+    history = context_chain.get('history', [])
+    ns.clear()
+    start = 0
+    if 'checkpoint' in context_chain:
+        fname, start = context_chain['checkpoint']
+        try:
+            load_context(ns, fname)
+        except Exception:
+            ns.clear()
+            start = 0
+    for code_piece in history[start:]:
+        if config.plot_apply_rcparams:
+            clear_state(config.plot_rcparams)
+        run_code(code_piece, code_path, ns)
+    plt.close('all')
+
+
+def get_cache_dir(app):
+    """
+    Return directory for cached plot images
+    """
+    return os.path.join(os.path.dirname(app.doctreedir), 'plot_cache')
+
+
+def get_exclude_dirs(app):
+    """
+    Return build directories, that cannot contain plot dependencies
+    """
+    return (app.builder.outdir, app.doctreedir)
+
+
+# Thread pool for resampling and encoding PNG images, by process id, so
+# forked workers make their own.  PIL releases the GIL while it works.
+_encode_pools = {}
+
+
+def get_encode_pool():
+    """
+    Return thread pool for this process, one thread per CPU
+
+    In ``plot_jobs`` workers, the CPUs are shared among the workers.
+    """
+    pid = os.getpid()
+    if pid not in _encode_pools:
+        _encode_pools.clear()
+        _encode_pools[pid] = thread_pool(_worker_settings.get('threads'))
+    return _encode_pools[pid]
+
+
+def _write_png(image, fname, size, dpi):
+    """
+    Write PIL *image* to PNG file *fname*, resampled to *size* if not None
+    """
+    if size is not None and size != image.size:
+        image = image.resize(size, PILImage.LANCZOS)
+    image.save(fname, 'PNG', dpi=(dpi, dpi))
+
+
+def _run_encoder(encoder):
+    try:
+        encoder[0](*encoder[1:])
+    except Exception:
+        raise PlotError(traceback.format_exc())
+
+
+def save_figure(figure, img, formats):
+    """
+    Save *figure* in *formats* as *img*, drawing it once for all PNG formats
+
+    Agg draws the figure once, at the highest DPI of the PNG formats; each
+    PNG format is that image, resampled to its DPI.  Other formats, such as
+    PDF, get their own draw.  Return list of encoders that write the PNG
+    files, each a tuple of function and arguments, for ``start_encoders``.
+    Without PIL, or with ``savefig.bbox`` set to 'tight', where the image
+    size depends on what is drawn, all formats get their own draw, and there
+    are no encoders.
+    """
+    pngs = []
+    if (is_available(PILImage) and
+        matplotlib.rcParams['savefig.bbox'] != 'tight'):
+        pngs = [(fmt, dpi) for fmt, dpi in formats
+                if fmt.split('.')[-1] == 'png']
+    encoders = []
+    if pngs:
+        top_dpi = max(dpi for fmt, dpi in pngs)
+        buf = io.BytesIO()
+        try:
+            figure.savefig(buf, format='rgba', dpi=top_dpi)
+        except Exception as err:
+            raise PlotError(traceback.format_exc())
+        data = buf.getvalue()
+        size = tuple(int(x) for x in figure.get_size_inches() * top_dpi)
+        if len(data) == 4 * size[0] * size[1]:
+            image = PILImage.frombuffer('RGBA', size, data, 'raw', 'RGBA',
+                                        0, 1)
+        else:  # Not the figure size; draw each format after all
+            pngs = []
+    for format, dpi in formats:
+        if (format, dpi) in pngs:
+            width, height = figure.get_size_inches() * dpi
+            encoders.append((_write_png, image, img.filename(format),
+                             (int(width), int(height)), dpi))
+        else:
+            try:
+                figure.savefig(img.filename(format), dpi=dpi)
+            except Exception as err:
+                raise PlotError(traceback.format_exc())
+        img.formats.append(format)
+    return encoders
+
+
+def start_encoders(encoders):
+    """
+    Start *encoders* from ``save_figure`` on the encoding thread pool
+
+    Return result, whose ``get`` method waits for the encoders to finish.
+    """
+    return get_encode_pool().map_async(_run_encoder, encoders)
+
+
+def write_if_changed(fname, text):
+    """
+    Write unicode *text* to *fname*, unless the file already has *text*
+
+    Return True if we wrote *fname*.
+    """
+    try:
+        with io.open(fname, 'r', encoding='utf-8') as fobj:
+            if fobj.read() == text:
+                return False
+    except (IOError, OSError, UnicodeDecodeError):
+        pass
+    with io.open(fname, 'w', encoding='utf-8') as fobj:
+        fobj.write(text)
+    return True
+
+
+def note_unchanged(stats, fname):
+    stats['files'] += 1
+    stats['bytes'] += os.path.getsize(fname)
+
+
+def init_doc_stats(app):
+    """
+    Start counting published files and image optimization for this build
+
+    The counts go in the environment by document name, so that parallel
+    readers can send theirs back in ``merge_doc_stats``.
+    """
+    app.env.plot_publish_stats = {}
+    app.env.plot_image_stats = {}
+
+
+def add_doc_stats(doc_stats, docname, stats):
+    """
+    Add counts in dict *stats* to those for *docname* in *doc_stats*
+    """
+    if docname not in doc_stats:
+        doc_stats[docname] = dict(stats)
+        return
+    for name, value in stats.items():
+        doc_stats[docname][name] += value
+
+
+def merge_doc_stats(app, env, docnames, other):
+    """
+    Merge counts for *docnames* read in parallel into the main environment
+    """
+    for name in ('plot_publish_stats', 'plot_image_stats'):
+        ours, theirs = getattr(env, name), getattr(other, name)
+        for docname in docnames:
+            if docname in theirs:
+                ours[docname] = theirs[docname]
+
+
+def report_publish(app, exception):
+    """
+    Report output files we left in place, at the end of the build
+    """
+    stats = list(app.env.plot_publish_stats.values())
+    files = sum(doc_stats['files'] for doc_stats in stats)
+    n_bytes = sum(doc_stats['bytes'] for doc_stats in stats)
+    if exception is None and files:
+        app.info('plot directive: left {0} unchanged files ({1} bytes) in '
+                 'place'.format(files, n_bytes))
+
+
 def run_code(code, code_path, ns=None, function_name=None):
     """
     Import a Python module from a path, and run the function given by
@@ -490,11 +1069,8 @@ def run_code(code, code_path, ns=None, function_name=None):
             if ns is None:
                 ns = {}
             if not ns:
-                if setup.config.plot_pre_code is None:
-                    six.exec_(six.text_type("import numpy as np\n" +
-                    "from matplotlib import pyplot as plt\n"), ns)
-                else:
-                    six.exec_(six.text_type(setup.config.plot_pre_code), ns)
+                ns.update(plot_state.pre_code_namespace(
+                    setup.config.plot_pre_code))
             ns['print'] = _dummy_print
             if "__main__" in code:
                 six.exec_("__name__ = '__main__'", ns)
@@ -512,125 +1088,298 @@ def run_code(code, code_path, ns=None, function_name=None):
     return ns
 
 
+class PlotState(object):
+    """
+    Baseline matplotlib state for plots, made once and restored cheaply
+
+    ``matplotlib.rc_file_defaults`` parses the matplotlibrc file again each
+    time, and ``plot_pre_code`` imports run for each new namespace.  We do
+    each once, keep the resulting rcParams and namespace, and copy them back
+    for each plot.  Values from the pre code are shared between plots, so
+    the pre code should only import modules and define constants.
+    """
+    def __init__(self):
+        self._rc_key = None
+        self._rcparams = None
+        self._pre_code = None
+        self._namespace = None
+
+    def restore_rcparams(self, plot_rcparams):
+        """
+        Set rcParams to the matplotlibrc defaults updated by *plot_rcparams*
+        """
+        key = repr(sorted(plot_rcparams.items()))
+        if key == self._rc_key:
+            # Values were validated when we made the baseline
+            dict.update(matplotlib.rcParams, self._rcparams)
+            return
+        matplotlib.rc_file_defaults()
+        matplotlib.rcParams.update(plot_rcparams)
+        self._rcparams = dict(dict.items(matplotlib.rcParams))
+        # Leave the backend alone, as rc_file_defaults does
+        self._rcparams.pop('backend', None)
+        self._rc_key = key
+
+    def pre_code_namespace(self, pre_code):
+        """
+        Return new namespace with the names from running *pre_code*
+
+        *pre_code* of None means ``DEFAULT_PRE_CODE``.
+        """
+        if pre_code is None:
+            pre_code = DEFAULT_PRE_CODE
+        if pre_code != self._pre_code:
+            # Select the Agg backend before the pre code imports pyplot
+            load_module(matplotlib)
+            namespace = {}
+            six.exec_(six.text_type(pre_code), namespace)
+            self._namespace, self._pre_code = namespace, pre_code
+        return dict(self._namespace)
+
+
+plot_state = PlotState()
+
+
 def clear_state(plot_rcparams, close=True):
     if close:
         plt.close('all')
-    matplotlib.rc_file_defaults()
-    matplotlib.rcParams.update(plot_rcparams)
+    plot_state.restore_rcparams(plot_rcparams)
+
+
+def find_images(code_pieces, image_dir, image_base, key):
+    """
+    Return list of (code piece, images) for existing images, and manifest
+
+    Return None, None if there is no manifest for snippet *key* in
+    *image_dir*, if an image file in the manifest is missing or has changed
+    size, or if a dependency file has changed.
+    """
+    manifest = read_manifest(image_dir, image_base)
+    if (manifest is None or manifest.get('key') != key or
+        len(manifest['images']) != len(code_pieces)):
+        return None, None
+    results = []
+    for code_piece, basenames in zip(code_pieces, manifest['images']):
+        images = []
+        for basename in basenames:
+            img = ImageFile(basename, image_dir)
+            for format in manifest['formats']:
+                fname = img.filename(format)
+                try:
+                    size = os.stat(fname).st_size
+                except OSError:
+                    return None, None
+                if size != manifest['sizes'].get(os.path.basename(fname)):
+                    return None, None
+                img.formats.append(format)
+            images.append(img)
+        results.append((code_piece, images))
+    if deps_changed(manifest['deps']):
+        return None, None
+    return results, manifest
+
+
+def publish_images(results, output_dir, output_base):
+    """
+    Link images in *results* into *output_dir*, named from *output_base*
+    """
+    if output_dir is None:
+        return results
+    published = []
+    for code_piece, images in results:
+        out_images = []
+        for img in images:
+            out_img = ImageFile(output_base + img.basename[len(CACHE_BASE):],
+                                output_dir)
+            for format in img.formats:
+                link_or_copy(img.filename(format), out_img.filename(format))
+                out_img.formats.append(format)
+            out_images.append(out_img)
+        published.append((code_piece, out_images))
+    return published
 
 
 def render_figures(code, code_path, output_dir, output_base, context,
-                   function_name, config, context_reset=False):
+                   function_name, config, context_reset=False,
+                   cache_dir=None, context_chain=None, dependencies=None,
+                   exclude_dirs=()):
     """
     Run a pyplot script and save the low and high res PNGs and a PDF
     in outdir.
 
     Save the images under *output_dir* with file names derived from
     *output_base*
-    """
-    # -- Parse format list
-    default_dpi = {'png': 80, 'hires.png': 200, 'pdf': 200}
-    formats = []
-    plot_formats = config.plot_formats
-    if isinstance(plot_formats, six.string_types):
-        plot_formats = eval(plot_formats)
-    for fmt in plot_formats:
-        if isinstance(fmt, six.string_types):
-            formats.append((fmt, default_dpi.get(fmt, 80)))
-        elif type(fmt) in (tuple, list) and len(fmt)==2:
-            formats.append((str(fmt[0]), int(fmt[1])))
-        else:
-            raise PlotError('invalid image format "%r" in plot_formats' % fmt)
-
-    # -- Try to determine if all images already exist
 
+    If *cache_dir* is not None, keep the images in *cache_dir*, under a hash
+    of the code and configuration (see ``snippet_key``), and link them into
+    *output_dir*.  If *output_dir* is None, only fill the cache.
+
+    Plots with unchanged code reuse their images, whatever happened to the
+    file containing them, unless a local module or data file used by the
+    code has changed (see ``trace_dependencies``).  If *dependencies* is not
+    None, add the local files the images depend on to this set.  Files in
+    *exclude_dirs*, such as build directories, are never dependencies.
+
+    *context_chain* is a dict for state of the ``:context:`` plots in this
+    document, including their namespace.  After each one we run, we save a
+    checkpoint of the context namespace with its images, so that when a later
+    plot changes, we can rebuild the namespace from the nearest checkpoint
+    before it.
+    """
+    formats = get_plot_formats(config)
     code_pieces = split_code_at_show(code)
 
-    # Look for single-figure output files first
-    # Look for single-figure output files first
-    all_exists = True
-    img = ImageFile(output_base, output_dir)
-    for format, dpi in formats:
-        if out_of_date(code_path, img.filename(format)):
-            all_exists = False
-            break
-        img.formats.append(format)
-
-    if all_exists:
-        return [(code, [img])]
-
-    # Then look for multi-figure output files
-    results = []
-    all_exists = True
-    for i, code_piece in enumerate(code_pieces):
-        images = []
-        for j in xrange(1000):
-            if len(code_pieces) > 1:
-                img = ImageFile('%s_%02d_%02d' % (output_base, i, j), output_dir)
-            else:
-                img = ImageFile('%s_%02d' % (output_base, j), output_dir)
-            for format, dpi in formats:
-                if out_of_date(code_path, img.filename(format)):
-                    all_exists = False
-                    break
-                img.formats.append(format)
-
-            # assume that if we have one, we have them all
-            if not all_exists:
-                all_exists = (j > 0)
-                break
-            images.append(img)
-        if not all_exists:
-            break
-        results.append((code_piece, images))
+    # -- Try to determine if all images already exist
 
-    if all_exists:
-        return results
+    context_key = None
+    if context and context_chain is not None:
+        if context_reset:
+            context_chain.clear()
+        context_key = context_chain.setdefault('key', '')
+        context_chain['key'] = chain_context_key(context_key, code)
+    key = snippet_key(code, code_path, function_name, config, formats,
+                      context_key)
+    if cache_dir is None:
+        image_dir, image_base = output_dir, output_base
+    else:
+        image_dir = os.path.join(cache_dir, key[:2], key)
+        image_base = CACHE_BASE
+
+    results = None
+    if (cache_dir is not None or
+        not out_of_date(code_path, manifest_path(image_dir, image_base))):
+        results, manifest = find_images(code_pieces, image_dir, image_base,
+                                        key)
+    if results is not None:
+        digests = manifest['deps']
+        if dependencies is not None:
+            dependencies.update(digests)
+        if cache_dir is None:
+            return results
+        if context and context_chain is not None:
+            # Rebuild the namespace from here, if a later plot needs it
+            history = context_chain.setdefault('history', [])
+            history.extend(code_pieces)
+            checkpoint = os.path.join(image_dir, CONTEXT_CHECKPOINT)
+            if os.path.isfile(checkpoint):
+                context_chain['checkpoint'] = (checkpoint, len(history))
+            context_chain['live'] = False
+            # Later plots depend on what went into the context
+            context_chain.setdefault('deps', set()).update(digests)
+        return publish_images(results, output_dir, output_base)
 
     # We didn't find the files, so build them
 
+    if cache_dir is not None:
+        # Render into a temporary directory, so the cache never has a
+        # partial set of images
+        render_dir = '%s.%d.tmp' % (image_dir, os.getpid())
+        if os.path.isdir(render_dir):
+            shutil.rmtree(render_dir)
+        os.makedirs(render_dir)
+    else:
+        render_dir = image_dir
+
     results = []
-    if context:
-        ns = plot_context
+    encoding = []
+    if context and context_chain is not None:
+        # The namespace of the context plots in this document
+        ns = context_chain.setdefault('ns', {})
     else:
         ns = {}
 
     if context_reset:
         clear_state(config.plot_rcparams)
 
-    for i, code_piece in enumerate(code_pieces):
-
-        if not context or config.plot_apply_rcparams:
-            clear_state(config.plot_rcparams)
-        else:
-            plt.close('all')
-
-        run_code(code_piece, code_path, ns, function_name)
+    deps = set()
+    if context and context_chain is not None:
+        deps = context_chain.setdefault('deps', set())
+    if cache_dir is None:
+        tracer = _no_trace()
+    else:
+        tracer = trace_dependencies(
+            [code_directory(code_path, config),
+             os.path.abspath(setup.confdir)],
+            [os.path.abspath(d) for d in (cache_dir,) + tuple(exclude_dirs)],
+            deps)
 
-        images = []
-        fig_managers = _pylab_helpers.Gcf.get_all_fig_managers()
-        for j, figman in enumerate(fig_managers):
-            if len(fig_managers) == 1 and len(code_pieces) == 1:
-                img = ImageFile(output_base, output_dir)
-            elif len(code_pieces) == 1:
-                img = ImageFile("%s_%02d" % (output_base, j), output_dir)
-            else:
-                img = ImageFile("%s_%02d_%02d" % (output_base, i, j),
-                                output_dir)
-            images.append(img)
-            for format, dpi in formats:
-                try:
-                    figman.canvas.figure.savefig(img.filename(format), dpi=dpi)
-                except Exception as err:
-                    raise PlotError(traceback.format_exc())
-                img.formats.append(format)
+    try:
+        with tracer:
+            # Rebuild the context from plots we did not run
+            if (context and context_chain is not None and
+                not context_chain.get('live')):
+                rebuild_context(ns, context_chain, code_path, config)
 
-        results.append((code_piece, images))
+            for i, code_piece in enumerate(code_pieces):
 
-    if not context or config.plot_apply_rcparams:
-        clear_state(config.plot_rcparams, close=not context)
+                if not context or config.plot_apply_rcparams:
+                    clear_state(config.plot_rcparams)
+                else:
+                    plt.close('all')
+
+                run_code(code_piece, code_path, ns, function_name)
+
+                images = []
+                fig_managers = _pylab_helpers.Gcf.get_all_fig_managers()
+                for j, figman in enumerate(fig_managers):
+                    if len(fig_managers) == 1 and len(code_pieces) == 1:
+                        img = ImageFile(image_base, render_dir)
+                    elif len(code_pieces) == 1:
+                        img = ImageFile("%s_%02d" % (image_base, j),
+                                        render_dir)
+                    else:
+                        img = ImageFile("%s_%02d_%02d" % (image_base, i, j),
+                                        render_dir)
+                    images.append(img)
+                    encoding.append(start_encoders(
+                        save_figure(figman.canvas.figure, img, formats)))
+
+                results.append((code_piece, images))
+
+        for result in encoding:
+            result.get()
+        optimizer = get_image_optimizer(config)
+        if optimizer is not None:
+            optimizer.optimize_files([fname for code_piece, images in results
+                                      for img in images
+                                      for fname in img.filenames()])
 
-    return results
+        if not context or config.plot_apply_rcparams:
+            clear_state(config.plot_rcparams, close=not context)
+
+        if context and context_chain is not None:
+            context_chain.setdefault('history', []).extend(code_pieces)
+            context_chain['live'] = True
+            if cache_dir is not None:
+                # So a change to a later plot can start from here
+                save_context(ns, os.path.join(render_dir, CONTEXT_CHECKPOINT))
+
+        if cache_dir is None:
+            write_manifest(image_dir, image_base, key, results, formats, ())
+            return results
+
+        deps.discard(os.path.abspath(code_path))
+        write_manifest(render_dir, image_base, key, results, formats, deps)
+    except BaseException:
+        # Do not leave partial images in the cache directory.  Let the
+        # encoders finish first, so nothing writes there after we remove it.
+        for result in encoding:
+            result.wait()
+        if cache_dir is not None:
+            shutil.rmtree(render_dir, ignore_errors=True)
+        raise
+    if dependencies is not None:
+        dependencies.update(deps)
+    if os.path.isdir(image_dir):  # Stale, from changed dependencies
+        shutil.rmtree(image_dir, ignore_errors=True)
+    try:
+        os.rename(render_dir, image_dir)
+    except OSError:  # Another process got there first
+        shutil.rmtree(render_dir)
+    for code_piece, images in results:
+        for img in images:
+            img.dirname = image_dir
+    return publish_images(results, output_dir, output_base)
 
 
 def run(arguments, content, options, state_machine, state, lineno):
@@ -727,10 +1476,20 @@ def run(arguments, content, options, state_machine, state, lineno):
     source_link = dest_dir_link + '/' + output_base + source_ext
 
     # make figures
+    cache_dir = get_cache_dir(setup.app)
+    # Per-document state goes in the environment, not the module, so
+    # documents can be read in parallel
+    env = document.settings.env
+    context_chain = env.temp_data.setdefault('plot_context_chain', {})
+    dependencies = set()
     try:
         results = render_figures(code, source_file_name, build_dir, output_base,
                                  context, function_name, config,
-                                 context_reset=context_reset)
+                                 context_reset=context_reset,
+                                 cache_dir=cache_dir,
+                                 context_chain=context_chain,
+                                 dependencies=dependencies,
+                                 exclude_dirs=get_exclude_dirs(setup.app))
         errors = []
     except PlotError as err:
         reporter = state.memo.reporter
@@ -741,6 +1500,15 @@ def run(arguments, content, options, state_machine, state, lineno):
         results = [(code, [])]
         errors = [sm]
 
+    optimizer = get_image_optimizer(config)
+    if optimizer is not None:
+        add_doc_stats(env.plot_image_stats, env.docname,
+                      optimizer.take_stats())
+
+    # Read this document again when files used by the plot change
+    for fname in dependencies:
+        document.settings.record_dependencies.add(fname)
+
     # Properly indent the caption
     caption = '\n'.join('      ' + line.strip()
                         for line in caption.split('\n'))
@@ -802,20 +1570,235 @@ def run(arguments, content, options, state_machine, state, lineno):
     if not os.path.exists(dest_dir):
         cbook.mkdirs(dest_dir)
 
+    publish_stats = env.plot_publish_stats.setdefault(
+        env.docname, {'files': 0, 'bytes': 0})
     for code_piece, images in results:
         for img in images:
             for fn in img.filenames():
                 destimg = os.path.join(dest_dir, os.path.basename(fn))
-                if fn != destimg:
-                    shutil.copyfile(fn, destimg)
+                if fn != destimg and not link_or_copy(fn, destimg):
+                    note_unchanged(publish_stats, destimg)
 
     # copy script (if necessary)
     target_name = os.path.join(dest_dir, output_base + source_ext)
-    with io.open(target_name, 'w', encoding="utf-8") as f:
-        if source_file_name == rst_file:
-            code_escaped = unescape_doctest(code)
-        else:
-            code_escaped = code
-        f.write(code_escaped)
+    if source_file_name == rst_file:
+        code_escaped = unescape_doctest(code)
+    else:
+        code_escaped = code
+    if not write_if_changed(target_name, code_escaped):
+        note_unchanged(publish_stats, target_name)
 
     return errors
+
+
+#------------------------------------------------------------------------------
+# Rendering plots in parallel before reading
+#------------------------------------------------------------------------------
+
+# regexps for plot directives and their options in sources
+plot_directive_re = re.compile(r'^(\s*)\.\.\s+plot::(.*)$')
+plot_option_re = re.compile(r'^:([\w-]+):(.*)$')
+
+# Configuration values render_figures and run_code need in worker processes
+WORKER_CONFIG = ('plot_formats', 'plot_pre_code', 'plot_rcparams',
+                 'plot_apply_rcparams', 'plot_working_directory',
+                 'plot_optimize_images')
+
+
+class WorkerConfig(object):
+    """
+    Copy of the configuration values in ``WORKER_CONFIG``, for pickling
+    """
+    def __init__(self, config):
+        for name in WORKER_CONFIG:
+            setattr(self, name, getattr(config, name))
+
+
+def find_plots(source_path):
+    """
+    Return list of plot directives in file *source_path*
+
+    Each plot is a dict with the ``arguments`` (list), ``options`` (dict)
+    and ``content`` (list of lines) of the directive, as docutils would give
+    them.
+    """
+    with io.open(source_path, 'r', encoding='utf-8') as fobj:
+        lines = [line.expandtabs(8).rstrip() for line in fobj]
+    plots = []
+    for i, line in enumerate(lines):
+        match = plot_directive_re.match(line)
+        if match is None:
+            continue
+        indent = len(match.group(1))
+        block = []
+        for block_line in lines[i + 1:]:
+            if block_line and len(block_line) - len(block_line.lstrip()) <= indent:
+                break
+            block.append(block_line)
+        while block and not block[-1]:
+            block.pop()
+        min_indent = min([len(b) - len(b.lstrip()) for b in block if b] or [0])
+        block = [b[min_indent:] for b in block]
+        options = {}
+        while block and plot_option_re.match(block[0]):
+            name, value = plot_option_re.match(block.pop(0)).groups()
+            options[name] = value.strip() or None
+        while block and not block[0]:
+            block.pop(0)
+        plots.append(dict(arguments=match.group(2).split(),
+                          options=options,
+                          content=block))
+    return plots
+
+
+def plot_jobs(app, source_path):
+    """
+    Return render jobs for plots in *source_path* that are not in the cache
+
+    Each job is a list of (code, code path, function name, context, context
+    reset) tuples, to run in order.  All ``:context:`` plots of a document
+    go in one job.
+    """
+    config = app.config
+    cache_dir = get_cache_dir(app)
+    formats = get_plot_formats(config)
+    jobs = []
+    context_job = []
+    context_stale = False
+    context_key = ''
+    for plot in find_plots(source_path):
+        arguments, options = plot['arguments'], plot['options']
+        if arguments:
+            if not config.plot_basedir:
+                code_path = os.path.join(app.builder.srcdir, arguments[0])
+            else:
+                code_path = os.path.join(app.confdir, config.plot_basedir,
+                                         arguments[0])
+            function_name = arguments[1] if len(arguments) == 2 else None
+            try:
+                with io.open(code_path, 'r', encoding='utf-8') as fobj:
+                    code = fobj.read()
+            except IOError:
+                continue
+        else:
+            code_path = source_path
+            code = textwrap.dedent('\n'.join(plot['content']))
+            function_name = None
+        context = 'context' in options
+        context_reset = context and options['context'] == 'reset'
+        if context:
+            if context_reset:
+                context_key = ''
+            key = snippet_key(code, code_path, function_name, config,
+                              formats, context_key)
+            context_key = chain_context_key(context_key, code)
+        else:
+            key = snippet_key(code, code_path, function_name, config,
+                              formats)
+        image_dir = os.path.join(cache_dir, key[:2], key)
+        stale = find_images(split_code_at_show(code), image_dir, CACHE_BASE,
+                            key)[0] is None
+        plot_job = (code, code_path, function_name, context, context_reset)
+        if context:
+            context_job.append(plot_job)
+            context_stale = context_stale or stale
+        elif stale:
+            jobs.append([plot_job])
+    if context_stale:
+        jobs.append(context_job)
+    return jobs
+
+
+def _init_plot_worker(config, confdir, cache_dir, exclude_dirs, n_procs):
+    setup.config = config
+    setup.confdir = confdir
+    # Share the CPUs among the workers, for PNG encoding and optimizing
+    threads = max(1, multiprocessing.cpu_count() // n_procs)
+    _worker_settings.update(cache_dir=cache_dir, exclude_dirs=exclude_dirs,
+                            threads=threads)
+    optimizer = get_image_optimizer(config)
+    if optimizer is not None and optimizer.threads is None:
+        optimizer.threads = threads
+    # Run the pre code, and make the rcParams baseline, once for each worker
+    plot_state.pre_code_namespace(config.plot_pre_code)
+    plot_state.restore_rcparams(config.plot_rcparams)
+
+
+# Per-process settings for plot worker processes
+_worker_settings = {}
+
+
+def _render_job(job):
+    """
+    Render plots in *job* into the cache
+
+    Return error message or None, and image optimization stats or None.  Any
+    failure, including of the worker settings, fails only this job.
+    """
+    context_chain = {}
+    error = optimizer = None
+    code_path = 'plot worker'
+    try:
+        optimizer = get_image_optimizer(setup.config)
+        for code, code_path, function_name, context, context_reset in job:
+            render_figures(code, code_path, None, None, context,
+                           function_name, setup.config,
+                           context_reset=context_reset,
+                           cache_dir=_worker_settings['cache_dir'],
+                           context_chain=context_chain,
+                           exclude_dirs=_worker_settings['exclude_dirs'])
+    except Exception as err:
+        error = '%s: %s' % (code_path, err)
+    return error, None if optimizer is None else optimizer.take_stats()
+
+
+def get_plot_jobs(config):
+    n_jobs = config.plot_jobs
+    if n_jobs == 'auto':
+        return multiprocessing.cpu_count()
+    return int(n_jobs)
+
+
+def prebuild_plots(app):
+    """
+    Render plots not in the cache, in parallel, before reading
+
+    Plots run in a pool of ``plot_jobs`` worker processes, that each run
+    ``plot_pre_code`` once (see ``PlotState``).  The images go into the plot
+    cache, where the directive finds them.  Plots that fail here get run
+    again by the directive, to report the error in context.
+    """
+    n_jobs = get_plot_jobs(app.config)
+    if n_jobs < 2:
+        return
+    suffixes = app.config.source_suffix
+    if isinstance(suffixes, six.string_types):
+        suffixes = [suffixes]
+    jobs = []
+    for dirpath, dirnames, filenames in os.walk(app.srcdir):
+        # Omit directories beginning with dots and underscores
+        dirnames[:] = [d for d in dirnames
+                       if not d.startswith('.') and not d.startswith('_')]
+        for fname in filenames:
+            if fname.endswith(tuple(suffixes)):
+                jobs += plot_jobs(app, os.path.join(dirpath, fname))
+    if not jobs:
+        return
+    # Longest jobs first, so they do not hold up the end of the build
+    jobs.sort(key=len, reverse=True)
+    n_procs = min(n_jobs, len(jobs))
+    app.info('rendering plots for {0} jobs in {1} processes'.format(
+        len(jobs), n_procs))
+    pool = multiprocessing.Pool(
+        n_procs, _init_plot_worker,
+        (WorkerConfig(app.config), app.confdir, get_cache_dir(app),
+         get_exclude_dirs(app), n_procs))
+    try:
+        for error, image_stats in pool.imap_unordered(_render_job, jobs):
+            if error is not None:
+                app.warn('Rendering plot failed: {0}'.format(error))
+            if image_stats is not None:
+                get_image_optimizer(app.config).add_stats(image_stats)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,5 @@
+""" Put the extensions on the path, as ``conf.py`` does """
+import sys
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
@@ -0,0 +1,55 @@
+""" Tests for patching Sphinx in build_trace
+"""
+import build_trace as bt
+
+
+class Config(object):
+    build_trace = 'trace.json'
+
+
+class Env(object):
+    pass
+
+
+class OldEnv(object):
+    def read_doc(self, docname):
+        return docname
+
+
+class Builder(object):
+    def __init__(self, env):
+        self.env = env
+
+    def read_doc(self, docname):
+        return docname
+
+
+class OldBuilder(object):
+    def __init__(self, env):
+        self.env = env
+
+
+class App(object):
+    def __init__(self, builder_class, env_class):
+        self.config = Config()
+        self.env = env_class()
+        self.builder = builder_class(self.env)
+
+    def emit(self, event, *args):
+        pass
+
+
+def test_read_doc_owner(monkeypatch):
+    # We time read_doc of the builder, or of the environment in older Sphinx,
+    # and trace the build if neither has one
+    monkeypatch.setattr(bt, 'TRACED', ())
+    monkeypatch.setattr(bt.setup, 'trace', None, raising=False)
+    for builder_class, env_class in ((Builder, Env), (OldBuilder, OldEnv)):
+        app = App(builder_class, env_class)
+        owner = app.builder if builder_class is Builder else app.env
+        monkeypatch.setattr(type(owner), 'read_doc', type(owner).read_doc)
+        bt.start_trace(app)
+        assert owner.read_doc('index') == 'index'
+        assert [event['args'] for event in bt.setup.trace.events] == [
+            {'doc': 'index'}]
+    bt.start_trace(App(OldBuilder, Env))
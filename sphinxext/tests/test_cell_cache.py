@@ -0,0 +1,118 @@
+""" Tests for the cell output cache in cell_cache
+"""
+import pytest
+
+from cell_cache import (has_side_effect, first_side_effect, chain_keys,
+                        CellCache)
+
+
+@pytest.mark.parametrize('source', [
+    "np.save('x.npy', x)",
+    "numpy.savez('x.npz', a=x)",
+    "plt.savefig('fig.png')",
+    "json.dump(data, fp)",
+    "pickle.dump(data, open('x.pkl', 'wb'))",
+    "open('out.txt', 'w').write('hi')",
+    "open(fname, mode='a')",
+    "open(fname, mode)",
+    "io.open(fname, 'wt')",
+    "Path('out.txt').open('w')",
+    "Path('out.txt').write_text('hi')",
+    "with plt.rc_context({'lines.linewidth': 2}):\n    plt.plot(x)",
+    "plt.style.use('ggplot')",
+    "mpl.rcParams['font.size'] = 12",
+    "plt.rcParams.update({'font.size': 12})",
+    "os.environ['HOME'] = '/tmp'",
+    "sys.path.insert(0, 'code')",
+    "sys.path = ['code']",
+    "os.chdir('..')",
+    "os.remove('x.txt')",
+    "shutil.copy('a', 'b')",
+    "np.seterr(all='ignore')",
+    "def f():\n    np.set_printoptions(precision=3)",
+    "!ls",
+    "%%timeit\nx = 1",
+])
+def test_side_effects(source):
+    assert has_side_effect(source)
+
+
+@pytest.mark.parametrize('source', [
+    "x = np.load('x.npy')",
+    "data = open(fname, 'rb').read()",
+    "with open(fname) as fobj:\n    text = fobj.read()",
+    "io.open(fname, 'rt', encoding='utf-8')",
+    "Path('x.txt').open()",
+    "print(sys.path)",
+    "home = os.environ['HOME']",
+    "path = []\npath.append(1)",
+    "s = 'abc'.replace('a', 'b')",
+    "df = df.rename(columns=str.lower)",
+    "values.remove(3)",
+    "text = json.dumps(data)",
+    "%matplotlib inline\nplt.plot(x)",
+])
+def test_no_side_effects(source):
+    assert not has_side_effect(source)
+
+
+def test_first_side_effect():
+    assert first_side_effect(['x = 1', "plt.savefig('a.png')", 'y = 2']) == 1
+    assert first_side_effect(['x = 1', 'y = 2']) == 2
+
+
+def test_chain_keys():
+    keys = chain_keys(['a = 1', 'b = 2'])
+    assert len(set(keys)) == 2
+    # Changing a cell changes its key and all later keys
+    changed = chain_keys(['a = 2', 'b = 2'])
+    assert not set(keys) & set(changed)
+    assert chain_keys(['a = 1', 'b = 3'])[0] == keys[0]
+    assert chain_keys(['a = 1', 'b = 2'], seed='numpy 2') != keys
+
+
+def make_notebook(sources):
+    nbf = pytest.importorskip('nbformat.v3')
+    nb = nbf.new_notebook()
+    ws = nbf.new_worksheet()
+    ws.cells.extend(nbf.new_code_cell(input=source) for source in sources)
+    nb.worksheets.append(ws)
+    return nb
+
+
+def store(cache, nb, keys, n):
+    for key, cell in list(zip(keys, nb.worksheets[0].cells))[:n]:
+        cache.store_outputs(key, cell)
+
+
+def touch_checkpoint(cache, key):
+    path = cache._path(key, '.pkl')
+    with open(path, 'wb'):
+        pass
+
+
+def test_resume_point(tmpdir):
+    cache = CellCache(str(tmpdir))
+    nb = make_notebook(['a = 1', 'b = 2', 'c = 3'])
+    keys, start = cache.resume_point(nb)
+    assert (keys, start) == (chain_keys(['a = 1', 'b = 2', 'c = 3']), 0)
+    # Outputs, but no checkpoint, for the first two cells
+    store(cache, nb, keys, 2)
+    assert cache.resume_point(nb)[1] == 0
+    touch_checkpoint(cache, keys[0])
+    assert cache.resume_point(nb)[1] == 1
+    touch_checkpoint(cache, keys[1])
+    assert cache.resume_point(nb)[1] == 2
+    store(cache, nb, keys, 3)
+    assert cache.resume_point(nb)[1] == 3
+
+
+def test_resume_before_side_effect(tmpdir):
+    # A cell writing files runs again, even with a later checkpoint
+    cache = CellCache(str(tmpdir))
+    nb = make_notebook(['a = 1', "np.save('a.npy', a)", 'b = 2', 'c = 3'])
+    keys = cache.resume_point(nb)[0]
+    store(cache, nb, keys, 3)
+    for key in keys[:3]:
+        touch_checkpoint(cache, key)
+    assert cache.resume_point(nb)[1] == 1
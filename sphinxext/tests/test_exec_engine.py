@@ -0,0 +1,63 @@
+""" Tests for running notebook cells with exec_engine
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('nbformat')
+
+import kernel_pool
+from lazy_import import LazyModule
+from exec_engine import ExecEngine, nbf
+
+
+def run_notebook(engine, sources, working_dir):
+    """Run code cells `sources` with `engine`, return cells"""
+    cells = [nbf.new_code_cell(input=source) for source in sources]
+    with engine.kernel(working_dir) as runner:
+        for cell in cells:
+            runner.run_cell(cell)
+    return cells
+
+
+def test_in_process_notebooks_keep_state(tmpdir):
+    # Notebooks run in this process leave our matplotlib settings, working
+    # directory and streams as they were
+    matplotlib = pytest.importorskip('matplotlib')
+    plt = pytest.importorskip('matplotlib.pyplot')
+    rcparams = dict(matplotlib.rcParams)
+    backend = plt.get_backend()
+    cwd, stdout = os.getcwd(), sys.stdout
+    engine = ExecEngine(fork=False, preimports=())
+    run_notebook(engine, [
+        '%matplotlib inline',
+        "import matplotlib.pyplot as plt\n"
+        "plt.rcParams['lines.linewidth'] = 7\n"
+        "plt.figure()"], str(tmpdir))
+    cell, = run_notebook(engine, [
+        "import matplotlib\n"
+        "matplotlib.rcParams['font.size'] = 3\n"
+        "print(matplotlib.rcParams['lines.linewidth'])"], str(tmpdir))
+    assert cell.outputs[0].text == '{0}\n'.format(
+        rcparams['lines.linewidth'])
+    assert dict(matplotlib.rcParams) == rcparams
+    assert plt.get_backend() == backend
+    assert plt.get_fignums() == []
+    assert (os.getcwd(), sys.stdout) == (cwd, stdout)
+
+
+@pytest.mark.parametrize('fork', [True, False])
+def test_cell_error_without_runipy(tmpdir, monkeypatch, fork):
+    # Failing cells report their own traceback, whether or not we have runipy
+    monkeypatch.setattr(kernel_pool, 'notebook_runner',
+                        LazyModule('no_such_module.notebook_runner'))
+    engine = ExecEngine(fork=fork, preimports=())
+    with pytest.raises(kernel_pool.NotebookError) as excinfo:
+        run_notebook(engine, ["x = 1", "raise ValueError('bad value')"],
+                     str(tmpdir))
+    assert "ValueError: bad value" in str(excinfo.value)
+    with engine.kernel(str(tmpdir)) as runner:
+        with pytest.raises(RuntimeError) as excinfo:
+            kernel_pool.run_code(runner, "1 / 0")
+    assert 'ZeroDivisionError' in str(excinfo.value)
@@ -0,0 +1,26 @@
+""" Tests for file helpers in fsutil
+"""
+import os
+
+from fsutil import link_or_copy
+
+
+def test_link_or_copy(tmpdir):
+    src = tmpdir.join('src.png')
+    src.write_binary(b'image')
+    dst = tmpdir.join('dst.png')
+    assert link_or_copy(str(src), str(dst))
+    assert dst.read_binary() == b'image'
+    # Already linked
+    assert not link_or_copy(str(src), str(dst))
+    # A copy with the same contents stays as it is
+    other = tmpdir.join('other.png')
+    other.write_binary(b'image')
+    mtime = os.stat(str(other)).st_mtime
+    assert not link_or_copy(str(src), str(other))
+    assert os.stat(str(other)).st_mtime == mtime
+    # Different contents get replaced
+    changed = tmpdir.join('changed.png')
+    changed.write_binary(b'old image')
+    assert link_or_copy(str(src), str(changed))
+    assert changed.read_binary() == b'image'
@@ -0,0 +1,69 @@
+""" Tests for the kernel pool
+"""
+import threading
+
+import pytest
+
+pytest.importorskip('nbformat')
+
+import kernel_pool as kp
+
+
+class FakeRunner(object):
+    """Runner without a kernel, that runs nothing"""
+
+    def run_cell(self, cell):
+        pass
+
+    def shutdown_kernel(self):
+        pass
+
+
+class FlakyPool(kp.KernelPool):
+    """Pool that fails to start kernels when `fail` is True"""
+
+    fail = False
+
+    def _start_runner(self):
+        if self.fail:
+            raise RuntimeError('kernel did not start')
+        return FakeRunner()
+
+
+def test_failed_replacement():
+    # Losing the last kernel fails waiting and later callers; it does not
+    # leave them blocked for ever
+    pool = FlakyPool(n_kernels=1, preimports=())
+    runner = pool.acquire()
+    errors = []
+
+    def wait_for_kernel():
+        try:
+            pool.acquire()
+        except RuntimeError as err:
+            errors.append(err)
+
+    waiter = threading.Thread(target=wait_for_kernel)
+    waiter.daemon = True
+    waiter.start()
+    pool.fail = True
+    with pytest.raises(RuntimeError):
+        pool._replace(runner)
+    waiter.join(10)
+    assert not waiter.is_alive()
+    assert len(errors) == 1
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+    pool.shutdown()
+
+
+def test_replacement_leaves_other_kernels():
+    # A failed replacement does not stop callers using the other kernels
+    pool = FlakyPool(n_kernels=2, preimports=(), max_uses=1)
+    first = pool.acquire()
+    pool.fail = True
+    with pytest.raises(RuntimeError):
+        pool.release(first)
+    second = pool.acquire()
+    assert isinstance(second, FakeRunner) and second is not first
+    pool.shutdown()
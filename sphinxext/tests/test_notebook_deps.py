@@ -0,0 +1,36 @@
+""" Tests for notebook dependency signatures in notebook_deps
+"""
+import pytest
+
+nbf = pytest.importorskip('nbformat.v3')
+
+from notebook_deps import local_imports, dependency_signature
+
+
+def make_notebook(sources):
+    nb = nbf.new_notebook()
+    ws = nbf.new_worksheet()
+    ws.cells.extend(nbf.new_code_cell(input=source) for source in sources)
+    nb.worksheets.append(ws)
+    return nb
+
+
+def test_local_imports(tmpdir):
+    # Modules beside the notebook, and the local modules they import
+    tmpdir.join('helper.py').write('import os\nfrom tools import util\n')
+    tmpdir.mkdir('tools').join('__init__.py').write('')
+    tmpdir.join('other.py').write('')
+    nb = make_notebook(['import numpy as np, helper', 'x = 1'])
+    assert local_imports(nb, str(tmpdir)) == sorted(
+        [str(tmpdir.join('helper.py')),
+         str(tmpdir.join('tools', '__init__.py'))])
+
+
+def test_dependency_signature(tmpdir):
+    helper = tmpdir.join('helper.py')
+    helper.write('X = 1\n')
+    signature = dependency_signature([str(helper)])
+    assert signature == dependency_signature([str(helper)])
+    assert 'python ' in signature
+    helper.write('X = 2\n')
+    assert dependency_signature([str(helper)]) != signature
@@ -0,0 +1,147 @@
+""" Tests for notebook evaluation and export in notebook_sphinxext
+"""
+import io
+import os
+
+import pytest
+
+pytest.importorskip('sphinx')
+
+import notebook_sphinxext as nse
+from exec_engine import ExecEngine
+
+
+def needs_exporters():
+    """Skip test if nbconvert has no exporter modules we can import"""
+    try:
+        nse.get_exporter('html')
+    except ImportError:
+        pytest.skip('needs nbconvert with html and python modules')
+
+
+def write_notebook(tmpdir, sources):
+    """Write format 3 notebook with code cells `sources`, return path"""
+    nb = nse.nbf.new_notebook()
+    ws = nse.nbf.new_worksheet()
+    ws.cells.extend(nse.nbf.new_code_cell(input=source)
+                    for source in sources)
+    nb.worksheets.append(ws)
+    nb_path = str(tmpdir.join('test.ipynb'))
+    with io.open(nb_path, 'wt', encoding='utf-8') as f:
+        f.write(nse.nbformat.writes(nb, nse.NBFORMAT))
+    return nb_path
+
+
+def test_python_export_then_evaluate(tmpdir):
+    # The directive exports the script before it evaluates the notebook
+    needs_exporters()
+    nb = nse.read_cleared(write_notebook(tmpdir, ["print('hello')"]))
+    assert "print('hello')" in nse.nb_to_python(nb)
+    nse.run_isolated(nb, str(tmpdir), kernel_pool=ExecEngine())
+    cell, = nse.cellgen(nb, 'code')
+    assert cell.outputs[0].text == 'hello\n'
+
+
+def test_cached_notebook_keeps_images(tmpdir):
+    # Image outputs go to files for the html, not in the cached notebook
+    needs_exporters()
+    nb = nse.read_cleared(write_notebook(tmpdir, [
+        '%matplotlib inline',
+        'import matplotlib.pyplot as plt\nplt.plot([1, 2])']))
+    image_dir = str(tmpdir.join('images'))
+    nb_path, html = nse.evaluate_to_cache(
+        nb, str(tmpdir.join('cache')), 'ab12', str(tmpdir),
+        kernel_pool=ExecEngine(), image_dir=image_dir)
+    assert nse.IMAGE_URL_TOKEN in html
+    assert len(os.listdir(image_dir)) == 1
+    with io.open(nb_path, 'rt', encoding='utf-8') as f:
+        cached = nse.nbformat.read(f, as_version=4)
+    outputs = cached.cells[1].outputs
+    assert any('image/png' in output.get('data', {}) for output in outputs)
+
+
+def test_scope_css():
+    css = ('@charset "utf-8"; /* {} */ body{margin:0} '
+           'html input, p > a{color:red} '
+           '@media print{.x, :root{a:b}} @keyframes k{from{a:b}to{a:c}}')
+    assert nse.scope_css(css, '.nb').splitlines() == [
+        '@charset "utf-8";',
+        '.nb input,.nb p > a{color:red}',
+        '@media print{.nb .x{a:b}}',
+        '@keyframes k{from{a:b}to{a:c}}']
+
+
+def test_notebook_cache_key(tmpdir, monkeypatch):
+    helper = tmpdir.join('helper.py')
+    helper.write('X = 1\n')
+
+    def cache_key(nb_text='{}', deps=(str(helper),), options='exec engine',
+                  template_text='{{ nb }}'):
+        return nse.notebook_cache_key(nb_text, list(deps), options,
+                                      template_text)
+
+    key = cache_key()
+    assert key == cache_key()
+    assert key != cache_key(nb_text='{ }')
+    assert key != cache_key(options='')
+    assert key != cache_key(deps=[])
+    assert key != cache_key(template_text='{{ nb }}\n')
+    monkeypatch.setattr(nse, 'package_version', lambda name: '0.1')
+    assert key != cache_key()
+    monkeypatch.undo()
+    helper.write('X = 2\n')
+    assert key != cache_key()
+
+
+def test_template_source():
+    # By default, the key has the template the html exporter uses
+    needs_exporters()
+    template_text = nse.template_source()
+    assert template_text
+    assert (nse.notebook_cache_key('{}', []) ==
+            nse.notebook_cache_key('{}', [], '', template_text))
+
+
+def test_publish_images(tmpdir):
+    image_dir = tmpdir.mkdir('cache')
+    image_dir.join('ab12.png').write_binary(b'image')
+    html = '<img src="{0}ab12.png" />'.format(nse.IMAGE_URL_TOKEN)
+    out_dir = tmpdir.join('build', '_images')
+    assert (nse.publish_images(html, str(image_dir), str(out_dir),
+                               '../_images/') ==
+            '<img src="../_images/ab12.png" />')
+    assert out_dir.join('ab12.png').read_binary() == b'image'
+    # Images already in the build directory stay where they are
+    assert (nse.publish_images(html, str(out_dir), str(out_dir), '') ==
+            '<img src="ab12.png" />')
+
+
+def test_run_isolated_reads_notebook_dir(tmpdir):
+    # Notebooks read files beside them, and write to their own directory
+    tmpdir.join('data.txt').write('42')
+    nb = nse.read_cleared(write_notebook(tmpdir, [
+        "print(open('data.txt').read())",
+        "open('out.txt', 'w').write('x')"]))
+    nse.run_isolated(nb, str(tmpdir), kernel_pool=ExecEngine())
+    cell = list(nse.cellgen(nb, 'code'))[0]
+    assert cell.outputs[0].text == '42\n'
+    assert not tmpdir.join('out.txt').exists()
+
+
+def test_cached_run_prompts(tmpdir):
+    # Prompts from the cell cache match those from a cold run, although
+    # checkpoint code also used up execution counts
+    sources = ['x = 1', 'x', 'x + 1']
+    cache = nse.CellCache(str(tmpdir.join('cells')), checkpoint_interval=0)
+
+    def prompts():
+        nb = nse.read_cleared(write_notebook(tmpdir, sources))
+        nse.run_isolated(nb, str(tmpdir), kernel_pool=ExecEngine(),
+                         cell_cache=cache)
+        return [(cell.prompt_number,
+                 [output.get('prompt_number') for output in cell.outputs])
+                for cell in nse.cellgen(nb, 'code')]
+
+    cold = prompts()
+    assert cold == [(1, []), (2, [2]), (3, [3])]
+    assert prompts() == cold
@@ -0,0 +1,171 @@
+""" Tests for image caching and dependency tracking in plot_directive
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('sphinx')
+
+import plot_directive as pd
+
+
+def test_trace_dependencies(tmpdir, monkeypatch):
+    # Record local modules and files the code uses, and only drop the
+    # modules it imported
+    tmpdir.join('helper.py').write('X = 1\n')
+    tmpdir.join('data.txt').write('data\n')
+    monkeypatch.syspath_prepend(str(tmpdir))
+    plot_dirs = [str(tmpdir), os.path.dirname(os.path.abspath(pd.__file__))]
+    deps = set()
+    with pd.trace_dependencies(plot_dirs, [], deps):
+        import helper
+        with open(str(tmpdir.join('data.txt'))) as fobj:
+            fobj.read()
+    assert 'helper' not in sys.modules
+    assert sys.modules['plot_directive'] is pd
+    expected = set([str(tmpdir.join('helper.py'))])
+    if hasattr(sys, 'addaudithook'):
+        expected.add(str(tmpdir.join('data.txt')))
+    assert deps == expected
+
+
+def test_render_job_without_settings(monkeypatch):
+    # A worker that lost its settings fails the job, not the build
+    monkeypatch.delattr(pd.setup, 'config', raising=False)
+    monkeypatch.setattr(pd, '_worker_settings', {})
+    job = [("print('hello')", 'plot.py', None, False, False)]
+    error, image_stats = pd._render_job(job)
+    assert error.startswith('plot worker: ')
+    assert image_stats is None
+
+
+@pytest.mark.parametrize('bbox', ['standard', 'tight'])
+def test_save_figure_png_size(tmpdir, bbox):
+    # PNGs resampled from one draw match those matplotlib writes
+    PILImage = pytest.importorskip('PIL.Image')
+    plt = pytest.importorskip('matplotlib.pyplot')
+    formats = [('png', 80), ('hires.png', 200)]
+    with plt.rc_context({'savefig.bbox': bbox}):
+        figure = plt.figure(figsize=(3.3, 2.1))
+        figure.gca().plot([1, 2, 3])
+        img = pd.ImageFile('plot', str(tmpdir))
+        for encoder in pd.save_figure(figure, img, formats):
+            pd._run_encoder(encoder)
+        for format, dpi in formats:
+            figure.savefig(str(tmpdir.join('ref.png')), dpi=dpi)
+            expected = PILImage.open(str(tmpdir.join('ref.png'))).size
+            assert PILImage.open(img.filename(format)).size == expected
+        plt.close(figure)
+    assert img.formats == ['png', 'hires.png']
+
+
+def make_images(image_dir, key, deps=()):
+    """Write two images in two formats, and their manifest, to *image_dir*"""
+    formats = [('png', 80), ('pdf', 80)]
+    results = []
+    for i, code_piece in enumerate(['plot(x)', 'plot(y)']):
+        img = pd.ImageFile('%s_%02d' % (pd.CACHE_BASE, i), str(image_dir))
+        for format, dpi in formats:
+            image_dir.join('%s.%s' % (img.basename, format)).write(
+                'image %d' % i)
+            img.formats.append(format)
+        results.append((code_piece, [img]))
+    pd.write_manifest(str(image_dir), pd.CACHE_BASE, key, results, formats,
+                      deps)
+    return results
+
+
+def test_find_images(tmpdir):
+    image_dir = tmpdir.mkdir('images')
+    helper = tmpdir.join('helper.py')
+    helper.write('X = 1\n')
+    make_images(image_dir, 'ab12', [str(helper)])
+    code_pieces = ['plot(x)', 'plot(y)']
+    results, manifest = pd.find_images(code_pieces, str(image_dir),
+                                       pd.CACHE_BASE, 'ab12')
+    assert [code_piece for code_piece, images in results] == code_pieces
+    img = results[1][1][0]
+    assert img.filenames() == [str(image_dir.join('plot_01.png')),
+                               str(image_dir.join('plot_01.pdf'))]
+    assert list(manifest['deps']) == [str(helper)]
+    # Other key, other number of code pieces
+    assert pd.find_images(code_pieces, str(image_dir), pd.CACHE_BASE,
+                          'cd34') == (None, None)
+    assert pd.find_images(code_pieces[:1], str(image_dir), pd.CACHE_BASE,
+                          'ab12') == (None, None)
+    # Changed dependency
+    helper.write('X = 22\n')
+    assert pd.find_images(code_pieces, str(image_dir), pd.CACHE_BASE,
+                          'ab12') == (None, None)
+
+
+@pytest.mark.parametrize('damage', ['remove', 'resize'])
+def test_find_images_damaged(tmpdir, damage):
+    make_images(tmpdir, 'ab12')
+    image = tmpdir.join('plot_00.pdf')
+    if damage == 'remove':
+        image.remove()
+    else:
+        image.write('longer image')
+    assert pd.find_images(['plot(x)', 'plot(y)'], str(tmpdir),
+                          pd.CACHE_BASE, 'ab12') == (None, None)
+
+
+def test_publish_images(tmpdir):
+    cache_dir = tmpdir.mkdir('cache')
+    results = make_images(cache_dir, 'ab12')
+    out_dir = tmpdir.mkdir('build')
+    published = pd.publish_images(results, str(out_dir), 'fig_one')
+    assert [code_piece for code_piece, images in published] == [
+        'plot(x)', 'plot(y)']
+    img = published[0][1][0]
+    assert img.formats == ['png', 'pdf']
+    assert img.filename('png') == str(out_dir.join('fig_one_00.png'))
+    assert out_dir.join('fig_one_01.pdf').read() == 'image 1'
+    # Without an output directory, the images stay in the cache
+    assert pd.publish_images(results, None, 'fig_one') is results
+
+
+def test_save_load_context(tmpdir):
+    matplotlib = pytest.importorskip('matplotlib')
+    import random
+    fname = str(tmpdir.join(pd.CONTEXT_CHECKPOINT))
+    ns = {'__builtins__': {}, 'os': os, 'x': [1, 2], 'name': 'plot'}
+    with matplotlib.rc_context({'lines.linewidth': 5}):
+        assert pd.save_context(ns, fname)
+        expected = random.random()
+    loaded = {'stale': 1}
+    with matplotlib.rc_context():
+        pd.load_context(loaded, fname)
+        assert matplotlib.rcParams['lines.linewidth'] == 5
+    assert loaded == {'os': os, 'x': [1, 2], 'name': 'plot'}
+    assert random.random() == expected
+    # Nothing saved if a value does not pickle
+    os.remove(fname)
+    assert not pd.save_context({'values': (i for i in ns)}, fname)
+    assert not os.path.exists(fname)
+
+
+class Config(object):
+    plot_formats = [('png', 80)]
+    plot_rcparams = {}
+    plot_apply_rcparams = False
+    plot_pre_code = None
+    plot_working_directory = None
+    plot_optimize_images = False
+
+
+def test_render_error_cleans_cache(tmpdir, monkeypatch):
+    # A plot that fails leaves nothing in the cache, finished or not
+    pytest.importorskip('matplotlib')
+    config = Config()
+    monkeypatch.setattr(pd.setup, 'confdir', str(tmpdir), raising=False)
+    monkeypatch.setattr(pd.setup, 'config', config, raising=False)
+    code_path = str(tmpdir.join('plot.py'))
+    cache_dir = tmpdir.mkdir('cache')
+    code = "plt.plot([1, 2])\nplt.show()\nraise ValueError('bad plot')"
+    with pytest.raises(pd.PlotError):
+        pd.render_figures(code, code_path, None, None, False, None, config,
+                          cache_dir=str(cache_dir))
+    assert [str(path) for path in cache_dir.visit(lambda p: p.isfile())] == []
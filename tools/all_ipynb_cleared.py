@@ -5,25 +5,36 @@ DESCRIP = 'exit with 1 if any `.ipynb` notebook file has outputs or prompts'
 EPILOG = \
 """
 Looks for files in 'searchpath' with extension '.ipynb'. Opens found files as
-notebook(s) and checks for code output or prompt numbers.  exits with 1 if
-found.  exits with 0 of no outputs found in any notebook
+notebook(s) and checks for code output or prompt numbers.  Lists every cell
+with outputs or prompt numbers, and exits with 1 if found.  exits with 0 of
+no outputs found in any notebook
+
+By default we scan the JSON text of each notebook, and only parse the JSON of
+notebooks that look as if they have outputs, to find the cells.  This is much
+faster than reading the notebooks with nbformat.  Use --nbformat to read and
+validate with nbformat instead.
 """
 import os
 import sys
+import re
+import json
 
 import io
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
-
-# IPython before and after the big split
-try:
-    import nbformat
-except ImportError:
-    from IPython import nbformat
+from multiprocessing import Pool
 
 # Version of notebook format we are using
 NBFORMAT = 3
 
+# Text of notebooks that may have outputs or prompt numbers: a non-empty
+# outputs list, or a prompt number (format 3) or execution count (format 4)
+# that is not null.  This can match text in cells, but never misses a dirty
+# notebook.
+maybe_dirty_re = re.compile(r'"(?:outputs"\s*:\s*\[\s*[^\s\]]|'
+                            r'(?:prompt_number|execution_count)"'
+                            r'\s*:\s*[^\sn])')
+
 
 def cellgen(nb, type=None):
     for ws in nb.worksheets:
@@ -34,35 +45,106 @@ def cellgen(nb, type=None):
                 yield cell
 
 
-def main():
-    parser = ArgumentParser(description=DESCRIP,
-                            epilog=EPILOG,
-                            formatter_class=RawDescriptionHelpFormatter)
-    parser.add_argument('searchpath', type=str,
-                        help='directory from which to search')
-    args = parser.parse_args()
-    for dirpath, dirnames, filenames in os.walk(args.searchpath):
+def find_notebooks(searchpath):
+    for dirpath, dirnames, filenames in os.walk(searchpath):
         # Omit directories beginning with dots and underscores
         dirnames[:] = [d for d in dirnames
                        if not d.startswith('.') and not d.startswith('_')]
-        for fname in filenames:
+        for fname in sorted(filenames):
             if fname.startswith('.'):
                 continue
             if not fname.endswith('.ipynb'):
                 continue
-            fullpath = os.path.join(dirpath, fname)
-            with io.open(fullpath, 'rt') as f:
-                nb = nbformat.read(f, as_version=NBFORMAT)
-            for cell in cellgen(nb, 'code'):
-                if hasattr(cell, 'prompt_number'):
-                    sys.stderr.write(
-                        'cell prompt number {0} in {1}\n'.format(
-                            cell.prompt_number,
-                            fname))
-                    sys.exit(1)
-                if not cell.outputs == []:
-                    sys.stderr.write('cell output in {0}\n'.format(fname))
-                    sys.exit(1)
+            yield os.path.join(dirpath, fname)
+
+
+def json_cells(nb):
+    """Return list of cell dicts from notebook dict `nb`, format 3 or 4"""
+    if 'worksheets' in nb:
+        return [cell for ws in nb['worksheets'] for cell in ws['cells']]
+    return nb.get('cells', [])
+
+
+def cell_problems(index, prompt, outputs):
+    problems = []
+    if prompt is not None:
+        problems.append('cell {0} has prompt number {1}'.format(index,
+                                                                prompt))
+    if outputs:
+        problems.append('cell {0} has output'.format(index))
+    return problems
+
+
+def scan_json(fullpath):
+    """Return list of messages for cells with outputs in notebook `fullpath`
+
+    Reads the notebook as JSON, without nbformat.
+    """
+    with io.open(fullpath, 'rb') as f:
+        text = f.read().decode('utf-8')
+    if maybe_dirty_re.search(text) is None:
+        return []
+    problems = []
+    for i, cell in enumerate(json_cells(json.loads(text))):
+        if cell.get('cell_type') != 'code':
+            continue
+        prompt = cell.get('prompt_number', cell.get('execution_count'))
+        problems += cell_problems(i, prompt, cell.get('outputs'))
+    return problems
+
+
+def scan_nbformat(fullpath):
+    """Return list of messages for cells with outputs in notebook `fullpath`
+
+    Reads and validates the notebook with nbformat, as format 3.
+    """
+    # IPython before and after the big split
+    try:
+        import nbformat
+    except ImportError:
+        from IPython import nbformat
+    with io.open(fullpath, 'rt') as f:
+        nb = nbformat.read(f, as_version=NBFORMAT)
+    problems = []
+    for i, cell in enumerate(cellgen(nb)):
+        if cell.cell_type != 'code':
+            continue
+        problems += cell_problems(i, cell.get('prompt_number'),
+                                  cell.outputs != [])
+    return problems
+
+
+def main():
+    parser = ArgumentParser(description=DESCRIP,
+                            epilog=EPILOG,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('searchpath', type=str,
+                        help='directory from which to search')
+    parser.add_argument('--nbformat', action='store_true',
+                        help='read notebooks with nbformat (slower)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of processes checking notebooks')
+    args = parser.parse_args()
+    paths = list(find_notebooks(args.searchpath))
+    scan = scan_nbformat if args.nbformat else scan_json
+    if args.jobs > 1 and len(paths) > 1:
+        pool = Pool(min(args.jobs, len(paths)))
+        try:
+            results = pool.map(scan, paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [scan(path) for path in paths]
+    n_dirty = 0
+    for fullpath, problems in zip(paths, results):
+        for problem in problems:
+            sys.stderr.write('{0}: {1}\n'.format(fullpath, problem))
+        n_dirty += bool(problems)
+    if n_dirty:
+        sys.stderr.write('{0} notebooks with outputs or prompts\n'.format(
+            n_dirty))
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+DESCRIP = 'Time fixed setup cost of each plot in the plot directive'
+EPILOG = \
+"""
+Times the matplotlib state reset and ``plot_pre_code`` namespace that the plot
+directive makes before each plot, the slow way (parsing matplotlibrc and
+running the pre code each time) and the fast way (restoring the baseline
+kept by ``plot_directive.PlotState``).  For comparison, also times drawing and
+saving a small line plot.  Pre code is from PRE_CODE_FILE if given, else the
+plot directive default.
+"""
+import sys
+import io
+import timeit
+from os.path import dirname, abspath, join as pjoin
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+sys.path.insert(0, pjoin(dirname(abspath(__file__)), '..', 'sphinxext'))
+import plot_directive as pd
+
+import matplotlib
+import matplotlib.pyplot as plt
+
+
+def slow_setup(pre_code, plot_rcparams):
+    plt.close('all')
+    matplotlib.rc_file_defaults()
+    matplotlib.rcParams.update(plot_rcparams)
+    ns = {}
+    exec(pre_code, ns)
+    return ns
+
+
+def fast_setup(pre_code, plot_rcparams):
+    plt.close('all')
+    pd.plot_state.restore_rcparams(plot_rcparams)
+    return pd.plot_state.pre_code_namespace(pre_code)
+
+
+def small_plot():
+    fig = plt.figure()
+    plt.plot([1, 3, 2])
+    fig.savefig(io.BytesIO(), format='png', dpi=80)
+    plt.close(fig)
+
+
+def per_call(func, number):
+    """Return best time in milliseconds for one call of `func`"""
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1000
+
+
+def main():
+    parser = ArgumentParser(description=DESCRIP,
+                            epilog=EPILOG,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('pre_code_file', type=str, nargs='?',
+                        help='file with plot_pre_code (default: directive '
+                        'default)')
+    parser.add_argument('--number', type=int, default=100,
+                        help='number of calls for each timing (default 100)')
+    parser.add_argument('--rc', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='plot_rcparams entry; may be repeated')
+    args = parser.parse_args()
+    if args.pre_code_file is None:
+        pre_code = pd.DEFAULT_PRE_CODE
+    else:
+        with io.open(args.pre_code_file, 'rt', encoding='utf-8') as fobj:
+            pre_code = fobj.read()
+    plot_rcparams = dict(item.split('=', 1) for item in args.rc)
+    slow = per_call(lambda: slow_setup(pre_code, plot_rcparams), args.number)
+    fast = per_call(lambda: fast_setup(pre_code, plot_rcparams), args.number)
+    draw = per_call(small_plot, max(args.number // 10, 1))
+    print('Setup per plot, slow: {0:8.3f} ms'.format(slow))
+    print('Setup per plot, fast: {0:8.3f} ms'.format(fast))
+    print('Small plot draw+save: {0:8.3f} ms'.format(draw))
+    print('Speedup of setup: {0:.1f}x'.format(slow / fast))
+
+
+if __name__ == '__main__':
+    main()
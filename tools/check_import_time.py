@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+DESCRIP = 'Check time to import the Sphinx extensions against a budget'
+EPILOG = \
+"""
+Imports each extension in a new Python process, after the modules Sphinx has
+already imported by the time it loads extensions, and times the import.  Fails
+if an import takes longer than the budget, or if it imports one of the slow
+modules that the extensions should only import when a directive needs them
+(see ``sphinxext/lazy_import.py``).  Import times vary between runs, so the
+time is the best of ``--repeat`` processes.
+"""
+import sys
+import subprocess
+from os.path import dirname, abspath, join as pjoin
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+SPHINXEXT = pjoin(dirname(abspath(__file__)), '..', 'sphinxext')
+
+EXTENSIONS = ('plot_directive', 'notebook_sphinxext', 'math_dollar',
+              'build_trace')
+
+# Modules extensions should not import at startup
+SLOW_MODULES = ('matplotlib', 'matplotlib.pyplot', 'dill', 'nbformat',
+                'nbconvert', 'runipy', 'IPython.nbformat', 'IPython.nbconvert')
+
+# Sphinx has imported these before it loads extensions
+TIME_IMPORT = """\
+import sys, time
+sys.path.insert(0, {sphinxext!r})
+import sphinx, docutils.parsers.rst, jinja2
+start = time.time()
+import {extension}
+print(time.time() - start)
+print(' '.join(name for name in {slow_modules!r} if name in sys.modules))
+"""
+
+
+def time_import(extension):
+    """Return seconds to import `extension`, and slow modules it imported"""
+    code = TIME_IMPORT.format(sphinxext=SPHINXEXT, extension=extension,
+                              slow_modules=SLOW_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code])
+    lines = output.decode('utf-8').splitlines()
+    return float(lines[0]), lines[1].split() if len(lines) > 1 else []
+
+
+def main():
+    parser = ArgumentParser(description=DESCRIP,
+                            epilog=EPILOG,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('extension', type=str, nargs='*',
+                        help='extension module names (default: all)')
+    parser.add_argument('--budget', type=float, default=0.15,
+                        help='maximum seconds for each import (default 0.15)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of processes for each timing '
+                        '(default 3)')
+    args = parser.parse_args()
+    failed = False
+    for extension in args.extension or EXTENSIONS:
+        timings = [time_import(extension) for i in range(args.repeat)]
+        seconds = min(seconds for seconds, slow in timings)
+        slow = timings[0][1]
+        ok = seconds <= args.budget and not slow
+        failed = failed or not ok
+        print('{0:20} {1:6.3f} s  {2}{3}'.format(
+            extension, seconds, 'ok' if ok else 'FAIL',
+            '; imported ' + ', '.join(slow) if slow else ''))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,9 @@ from __future__ import print_function
 DESCRIP = 'run ipython notebook and check for errors'
 EPILOG = \
 """
-Each cell is submitted to the kernel, and checked for errors.
+Each cell is submitted to the kernel, and checked for errors.  A cell that
+runs for longer than the cell timeout, or past the notebook timeout, counts as
+a failure; we interrupt the kernel, and kill it if it does not stop.
 
 Thanks MinRK:
 
@@ -14,6 +16,12 @@ https://gist.github.com/minrk/2620876#file-checkipnb-py
 import os
 from os.path import abspath, dirname, isdir
 import sys
+import time
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
@@ -24,6 +32,12 @@ except ImportError:
 
 from IPython.nbformat.current import reads
 
+# Default maximum seconds for one cell
+DEFAULT_CELL_TIMEOUT = 20
+
+# Seconds to wait for an interrupted kernel before killing it
+KILL_GRACE = 5
+
 
 class chdir(object):
     """ Change directory to given directory for duration of ``with`` block
@@ -53,7 +67,26 @@ class chdir(object):
         os.chdir(self._pwd)
 
 
-def run_notebook(nb):
+def stop_cell(km, shell):
+    """Interrupt kernel running cell; kill it if it does not stop
+
+    Returns True if the kernel is still usable.
+    """
+    km.interrupt_kernel()
+    try:
+        shell.get_msg(timeout=KILL_GRACE)
+    except Empty:
+        km.kill_kernel()
+        return False
+    return True
+
+
+def run_notebook(nb, cell_timeout=DEFAULT_CELL_TIMEOUT, nb_timeout=None):
+    """Run code cells of `nb`, print failures, return number of failures
+
+    `cell_timeout` is the maximum seconds for one cell, and `nb_timeout` the
+    maximum seconds for the whole notebook.  None means no limit.
+    """
     km = KernelManager()
     km.start_kernel(stderr=open(os.devnull, 'w'))
     try:
@@ -68,13 +101,33 @@ def run_notebook(nb):
     shell.get_msg()
     cells = 0
     failures = 0
+    alive = True
+    start = time.time()
     for ws in nb.worksheets:
         for cell in ws.cells:
-            if cell.cell_type != 'code':
+            if cell.cell_type != 'code' or not alive:
                 continue
+            timeout = cell_timeout
+            if nb_timeout is not None:
+                remaining = nb_timeout - (time.time() - start)
+                if remaining <= 0:
+                    failures += 1
+                    print("\nNOTEBOOK TIMEOUT: stopped after %s s" %
+                          nb_timeout)
+                    alive = False
+                    continue
+                if timeout is None or remaining < timeout:
+                    timeout = remaining
             shell.execute(cell.input)
-            # wait for finish, maximum 20s
-            reply = shell.get_msg(timeout=20)['content']
+            # wait for finish, maximum `timeout` seconds
+            try:
+                reply = shell.get_msg(timeout=timeout)['content']
+            except Empty:
+                failures += 1
+                print("\nTIMEOUT after %.1f s:" % timeout)
+                print(cell.input)
+                alive = stop_cell(km, shell)
+                continue
             if reply['status'] == 'error':
                 failures += 1
                 print("\nFAILURE:")
@@ -92,8 +145,10 @@ def run_notebook(nb):
     if failures:
         print("    %3i cells raised exceptions" % failures)
     kc.stop_channels()
-    km.shutdown_kernel()
+    if alive:
+        km.shutdown_kernel()
     del km
+    return failures
 
 if __name__ == '__main__':
     parser = ArgumentParser(description=DESCRIP,
@@ -101,10 +156,17 @@ if __name__ == '__main__':
                             formatter_class=RawDescriptionHelpFormatter)
     parser.add_argument('filename', type=str, nargs='+',
                         help='notebook filenames')
+    parser.add_argument('--cell-timeout', type=float,
+                        default=DEFAULT_CELL_TIMEOUT,
+                        help='maximum seconds for one cell (default %(default)s)')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='maximum seconds for each notebook')
     args = parser.parse_args()
+    failures = 0
     for fname in args.filename:
         print("running %s" % fname)
         with open(fname) as f:
             nb = reads(f.read(), 'json')
         with chdir(dirname(fname)):
-            run_notebook(nb)
+            failures += run_notebook(nb, args.cell_timeout, args.timeout)
+    sys.exit(1 if failures else 0)
@@ -7,17 +7,152 @@ EPILOG = \
 Looks for files in directory INDIR with extension '.ipynb'. Opens found files
 as notebook(s).  Evaluates, writing output notebook to OUTDIR.  Writes HTML to
 OUTDIR.
+
+Skips notebooks that have not changed since we last wrote them.  A stamp file
+in OUTDIR records a hash of each notebook we wrote, with the local modules it
+imports, the versions of Python, numpy and matplotlib, the template (found as
+the html exporter finds it) and options, including time and memory limits.
+With --jobs above 1, notebooks run in a pool of worker processes, each with
+its own kernels.  A notebook that fails does not stop the others; we list the
+failures at the end.
 """
 import os
-from os.path import join as pjoin, splitext
+import io
+import sys
+import json
+import hashlib
+import multiprocessing
+from multiprocessing.util import Finalize
+from os.path import join as pjoin, splitext, isfile
 
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
-from write_ipynb import write_ipynb
+from write_ipynb import (write_ipynb, IMAGE_DIR, add_profile_arguments,
+                         report_profile, add_budget_arguments,
+                         budget_from_args, add_engine_arguments,
+                         exec_engine_from_args, template_source, nb_read,
+                         DEFAULT_READ_FORMAT)
+from kernel_pool import KernelPool
+from notebook_deps import local_imports, dependency_signature
+from cell_budget import BudgetExceeded
 
 DEFAULT_TEMPLATE = 'perrinate.tpl'
 
+# File in OUTDIR recording notebooks we have written
+STAMP_FNAME = '.write_all_ipynb.json'
+STAMP_VERSION = 3
+
+# Options that change the output files, or whether a notebook passes
+STAMP_OPTIONS = ('external_images', 'engine', 'profile_metadata',
+                 'cell_timeout', 'timeout', 'max_memory')
+
+
+def notebook_stamp(nb_path, args, template_text):
+    """Return hash of notebook at `nb_path`, what it depends on, template and
+    output options
+
+    The notebook depends on the local modules it imports, and on the versions
+    of Python and libraries, as for the cache of the notebook directive (see
+    ``notebook_deps``).  `template_text` is the text of the html template,
+    from ``template_source``.
+    """
+    with io.open(nb_path, 'rb') as f:
+        nb_bytes = f.read()
+    with io.open(nb_path, 'rt') as f:
+        nb = nb_read(f, DEFAULT_READ_FORMAT)
+    nb_dir = os.path.dirname(os.path.abspath(nb_path))
+    hasher = hashlib.sha256()
+    hasher.update(nb_bytes)
+    hasher.update(dependency_signature(local_imports(nb, nb_dir)
+                                       ).encode('utf-8'))
+    hasher.update(template_text.encode('utf-8'))
+    hasher.update(repr([args.template] +
+                       [getattr(args, name) for name in STAMP_OPTIONS]
+                       ).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def read_stamps(out_dir):
+    """Return dict of stamps by notebook file name, from `out_dir`"""
+    try:
+        with io.open(pjoin(out_dir, STAMP_FNAME), 'rt') as f:
+            contents = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if contents.get('version') != STAMP_VERSION:
+        return {}
+    return contents['stamps']
+
+
+def write_stamps(out_dir, stamps):
+    path = pjoin(out_dir, STAMP_FNAME)
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with io.open(tmp_path, 'wt') as f:
+        f.write(json.dumps(dict(version=STAMP_VERSION, stamps=stamps),
+                           indent=1, sort_keys=True))
+    os.rename(tmp_path, path)
+
+
+def up_to_date(fname, stamp, stamps, out_dir):
+    """True if notebook `fname` has `stamp`, and its outputs exist"""
+    froot, ext = splitext(fname)
+    return (stamp is not None and stamps.get(fname) == stamp and
+            isfile(pjoin(out_dir, fname)) and
+            isfile(pjoin(out_dir, froot + '.html')))
+
+
+# Per-process state for evaluating notebooks
+_worker = {}
+
+
+def _init_worker(args):
+    _worker['args'] = args
+    _worker['exec_engine'] = exec_engine_from_args(args)
+    _worker['kernel_pool'] = None
+
+
+def _worker_kernel_pool():
+    """Return kernel pool, starting it on first use, or None for exec engine
+
+    Notebooks the exec engine cannot run get a kernel each.
+    """
+    args = _worker['args']
+    if _worker['exec_engine'] is not None:
+        return None
+    if _worker['kernel_pool'] is None:
+        _worker['kernel_pool'] = KernelPool(args.kernels,
+                                            max_uses=args.kernel_max_uses)
+        # Shut down kernels when the worker process exits
+        Finalize(None, _worker['kernel_pool'].shutdown, exitpriority=10)
+    return _worker['kernel_pool']
+
+
+def _write_one(nb_path):
+    """Evaluate and write notebook at `nb_path`
+
+    Returns (path, error message or None, over budget flag, profile
+    records).
+    """
+    args = _worker['args']
+    if args.verbose:
+        print('Processing ' + nb_path)
+    profile_records = None if args.profile is None else []
+    try:
+        write_ipynb(nb_path, args.outdir, args.template,
+                    kernel_pool=_worker_kernel_pool(),
+                    external_images=args.external_images,
+                    profile_records=profile_records,
+                    profile_metadata=args.profile_metadata,
+                    budget=budget_from_args(args),
+                    exec_engine=_worker['exec_engine'])
+    except BudgetExceeded as err:
+        return nb_path, str(err), True, profile_records or []
+    except Exception as err:
+        return nb_path, '{0}: {1}'.format(type(err).__name__, err), False, \
+            profile_records or []
+    return nb_path, None, False, profile_records or []
+
 
 def main():
     parser = ArgumentParser(description=DESCRIP,
@@ -32,17 +167,79 @@ def main():
                         help='html template name')
     parser.add_argument('--verbose', action='store_true',
                         help='print more messages')
+    parser.add_argument('--kernels', type=int, default=1,
+                        help='number of kernels to keep warm, in each job')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of notebooks to evaluate in parallel')
+    parser.add_argument('--force', action='store_true',
+                        help='write all notebooks, even if unchanged')
+    parser.add_argument('--kernel-max-uses', type=int, default=None,
+                        help='restart kernel after this many notebooks')
+    parser.add_argument('--external-images', action='store_true',
+                        help='write images to files in OUTDIR/{0} instead '
+                        'of embedding them in the html'.format(IMAGE_DIR))
+    add_engine_arguments(parser)
+    add_profile_arguments(parser)
+    add_budget_arguments(parser)
     args = parser.parse_args()
-    for fname in os.listdir(args.indir):
+    try:
+        template_text = template_source(args.template)
+    except Exception as err:
+        sys.exit('Cannot find template {0}: {1}'.format(args.template, err))
+    stamps = {} if args.force else read_stamps(args.outdir)
+    todo = {}
+    for fname in sorted(os.listdir(args.indir)):
         if fname.startswith('.'):
             continue
         froot, ext = splitext(fname)
         if not ext == '.ipynb':
             continue
         fullpath = pjoin(args.indir, fname)
-        if args.verbose:
-            print('Processing ' + fullpath)
-        write_ipynb(fullpath, args.outdir, args.template)
+        try:
+            stamp = notebook_stamp(fullpath, args, template_text)
+        except Exception:  # Unreadable; writing it reports the error
+            stamp = None
+        if up_to_date(fname, stamp, stamps, args.outdir):
+            if args.verbose:
+                print('Skipping unchanged ' + fullpath)
+            continue
+        todo[fullpath] = stamp
+    profile_records = None if args.profile is None else []
+    failed = []
+    over_budget = []
+    n_procs = min(args.jobs, len(todo))
+    if n_procs > 1:
+        pool = multiprocessing.Pool(n_procs, _init_worker, (args,))
+        results = pool.imap_unordered(_write_one, sorted(todo))
+    else:
+        pool = None
+        _init_worker(args)
+        results = (_write_one(path) for path in sorted(todo))
+    try:
+        # Failed notebooks should not hold up the others
+        for nb_path, error, budget_error, records in results:
+            if profile_records is not None:
+                profile_records.extend(records)
+            if error is not None:
+                print('{0}: {1}'.format(nb_path, error), file=sys.stderr)
+                (over_budget if budget_error else failed).append(nb_path)
+                stamps.pop(os.path.basename(nb_path), None)
+                continue
+            stamps[os.path.basename(nb_path)] = todo[nb_path]
+    finally:
+        if pool is None:
+            if _worker.get('kernel_pool') is not None:
+                _worker['kernel_pool'].shutdown()
+        else:
+            pool.close()
+            pool.join()
+        write_stamps(args.outdir, stamps)
+        report_profile(profile_records, args.profile, args.profile_top)
+    if failed or over_budget:
+        for nb_path in failed + over_budget:
+            print('Failed: ' + nb_path, file=sys.stderr)
+        sys.exit('{0} notebooks failed, {1} over budget'.format(
+            len(failed), len(over_budget)))
 
 
 if __name__ == '__main__':
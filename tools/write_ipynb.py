@@ -7,7 +7,9 @@ EPILOG = \
 Opens given NBFILE as notebook.  Evaluates, writing output notebook to OUTDIR.
 Writes HTML to OUTDIR.
 """
-from os.path import join as pjoin, splitext, isdir, split as psplit
+import sys
+from os.path import (join as pjoin, splitext, isdir, split as psplit, abspath,
+                     dirname)
 
 import io
 
@@ -25,23 +27,62 @@ except ImportError:
 
 from runipy.notebook_runner import NotebookRunner
 
+# Shared notebook machinery lives with the Sphinx extensions
+sys.path.insert(0, pjoin(dirname(abspath(__file__)), '..', 'sphinxext'))
+from kernel_pool import run_notebook
+from notebook_images import externalize_images
+from cell_profile import CellProfiler, write_report, summary
+from cell_budget import CellBudget
+from exec_engine import ExecEngine
+
 DEFAULT_TEMPLATE = 'perrinate.tpl'
 DEFAULT_READ_FORMAT = 3
 DEFAULT_WRITE_FORMAT = 3
 HTML_FORMAT = 4
+# Directory in OUTDIR for image files with --external-images
+IMAGE_DIR = '_images'
 
 
-def evaluate_notebook(nb, working_dir=None):
+def evaluate_notebook(nb, working_dir=None, kernel_pool=None, monitors=()):
     # Create evaluated version and save it to the dest path.
-    nb_runner = NotebookRunner(nb=nb, working_dir=working_dir)
-    nb_runner.run_notebook()
-    return nb_runner.nb
+    if kernel_pool is None:
+        nb_runner = NotebookRunner(nb=nb, working_dir=working_dir)
+        try:
+            run_notebook(nb_runner, nb, monitors)
+        finally:
+            nb_runner.shutdown_kernel()
+        return nb_runner.nb
+    with kernel_pool.kernel(working_dir) as nb_runner:
+        return run_notebook(nb_runner, nb, monitors)
+
+
+# Exporters are slow to set up; keep one per template
+_exporters = {}
+
+
+def get_exporter(template_name=DEFAULT_TEMPLATE):
+    if template_name not in _exporters:
+        _exporters[template_name] = html.HTMLExporter(
+            template_file=template_name)
+    return _exporters[template_name]
+
+
+def template_source(template_name=DEFAULT_TEMPLATE):
+    """Return text of html template `template_name`, as the exporter finds it
+
+    The exporter looks in the current directory and in the nbconvert
+    templates.  Raises ``jinja2.TemplateNotFound`` if there is no such
+    template.
+    """
+    env = get_exporter(template_name).environment
+    source, fname, uptodate = env.loader.get_source(env, template_name)
+    return source
 
 
 def nb_to_html(nb, template_name=DEFAULT_TEMPLATE, resources=None):
     """convert notebook to html
     """
-    exporter = html.HTMLExporter(template_file=template_name)
+    exporter = get_exporter(template_name)
     full_resources = dict(metadata = nb.metadata)
     if resources is not None:
         full_resources.update(resources)
@@ -61,22 +102,121 @@ def main():
     parser.add_argument('--template', type=str,
                         default=DEFAULT_TEMPLATE,
                         help='html template name')
+    parser.add_argument('--external-images', action='store_true',
+                        help='write images to files in OUTDIR/{0} instead '
+                        'of embedding them in the html'.format(IMAGE_DIR))
+    add_engine_arguments(parser)
+    add_profile_arguments(parser)
+    add_budget_arguments(parser)
     args = parser.parse_args()
     if not isdir(args.outdir):
         raise RuntimeError('{} is not a directory'.format(args.outdir))
-    write_ipynb(args.nbfile, args.outdir, template_name=args.template)
-
-
-def write_ipynb(nb_path, out_dir, template_name=DEFAULT_TEMPLATE):
+    profile_records = None if args.profile is None else []
+    try:
+        write_ipynb(args.nbfile, args.outdir, template_name=args.template,
+                    external_images=args.external_images,
+                    profile_records=profile_records,
+                    profile_metadata=args.profile_metadata,
+                    budget=budget_from_args(args),
+                    exec_engine=exec_engine_from_args(args))
+    finally:
+        report_profile(profile_records, args.profile, args.profile_top)
+
+
+def add_budget_arguments(parser):
+    parser.add_argument('--cell-timeout', type=float, default=None,
+                        help='maximum seconds for one cell')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='maximum seconds for all cells in a notebook')
+    parser.add_argument('--max-memory', type=float, default=None,
+                        help='maximum kernel memory in MB')
+
+
+def budget_from_args(args):
+    """Return keyword arguments for ``CellBudget`` from parsed `args`
+
+    Returns None if there are no limits.
+    """
+    if (args.cell_timeout, args.timeout, args.max_memory) == (None,) * 3:
+        return None
+    max_memory = args.max_memory
+    if max_memory is not None:
+        max_memory = int(max_memory * 2 ** 20)
+    return dict(cell_timeout=args.cell_timeout,
+                notebook_timeout=args.timeout,
+                max_memory=max_memory)
+
+
+def add_engine_arguments(parser):
+    parser.add_argument('--engine', choices=('kernel', 'exec'),
+                        default='kernel',
+                        help='run cells in IPython kernel, or with exec where '
+                        'the notebook allows (default %(default)s)')
+    parser.add_argument('--no-fork', action='store_true',
+                        help='with --engine=exec, run cells in this process '
+                        'instead of a forked child; notebooks with time or '
+                        'memory limits still use a kernel')
+
+
+def exec_engine_from_args(args):
+    if args.engine != 'exec':
+        return None
+    return ExecEngine(fork=not args.no_fork)
+
+
+def add_profile_arguments(parser):
+    parser.add_argument('--profile', type=str, default=None,
+                        metavar='REPORT',
+                        help='write time and memory use of each cell as '
+                        'JSON to REPORT, and list slowest cells')
+    parser.add_argument('--profile-top', type=int, default=10,
+                        help='number of slowest cells to list with '
+                        '--profile')
+    parser.add_argument('--profile-metadata', action='store_true',
+                        help='with --profile, also store cell timings in '
+                        'the cell metadata of the output notebook')
+
+
+def report_profile(records, report_path, n=10):
+    """Write profile `records` to `report_path`, print slowest cells"""
+    if report_path is None:
+        return
+    write_report(records, report_path)
+    print(summary(records, n), file=sys.stderr)
+
+
+def write_ipynb(nb_path, out_dir, template_name=DEFAULT_TEMPLATE,
+                kernel_pool=None, external_images=False,
+                profile_records=None, profile_metadata=False, budget=None,
+                exec_engine=None):
     fpath, fname = psplit(nb_path)
     froot, ext = splitext(fname)
     with io.open(nb_path, 'rt') as f:
         nb = nb_read(f, DEFAULT_READ_FORMAT)
     nb.metadata['name'] = froot
-    nb_evaluated = evaluate_notebook(nb, working_dir=fpath)
+    monitors = []
+    if budget is not None:
+        monitors.append(CellBudget(nb, **budget))
+    if profile_records is not None:
+        monitors.append(CellProfiler(nb_path, nb, profile_metadata))
+    try:
+        if (exec_engine is not None and
+            exec_engine.supports(nb, budget is not None)):
+            kernel_pool = exec_engine
+        nb_evaluated = evaluate_notebook(nb, working_dir=fpath,
+                                         kernel_pool=kernel_pool,
+                                         monitors=monitors)
+    finally:
+        for monitor in monitors:
+            if isinstance(monitor, CellProfiler):
+                profile_records.extend(monitor.records)
     with io.open(pjoin(out_dir, fname), 'wt') as f:
         nb_write(nb, f, DEFAULT_WRITE_FORMAT)
-    nb_html = nb_to_html(nb_convert(nb_evaluated, HTML_FORMAT),
+    nb_for_html = nb_convert(nb_evaluated, HTML_FORMAT)
+    if external_images:
+        externalize_images(nb_for_html, pjoin(out_dir, IMAGE_DIR),
+                           IMAGE_DIR + '/')
+    nb_html = nb_to_html(nb_for_html,
                          template_name=template_name,
                          resources=dict(nb_fname=fname))
     with io.open(pjoin(out_dir, froot + '.html'), 'wb') as f: